@@ -2,23 +2,242 @@ import smtplib
 from email.mime.text import MIMEText
 import streamlit as st
 import requests
+import requests.adapters
 import json
-import gspread
+import math
 import datetime
+import hashlib
+import importlib
+import heapq
 import base64
 import io
+import os
+import queue
+import random
 import re
-from gtts import gTTS
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.discovery import build
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+# gspread, oauth2client, googleapiclient y gtts se importan al primer uso:
+# un turno que no los necesita no paga su importación (~0,5 s)
 
 # --- 1. DATOS DEL USUARIO ---
 TU_EMAIL_GMAIL = "juanjesusmartinsr@gmail.com"
 
+# Datos locales del proceso (spool de escrituras, cachés). El secreto
+# DIR_DATOS permite aislarlos, p. ej. en el banco de pruebas (bench/)
+try:
+    DIR_DATOS = st.secrets.get("DIR_DATOS", None)
+except:
+    DIR_DATOS = None
+DIR_DATOS = DIR_DATOS or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".asistente")
+
+# Almacén principal: "sqlite" (por defecto: chat, perfil y tareas en una base
+# local, replicada a Sheets en segundo plano) o "sheets" (todo directo contra
+# Google, como antes)
+try:
+    ALMACEN = str(st.secrets.get("ALMACEN", "sqlite")).lower()
+except:
+    ALMACEN = "sqlite"
+
+
+def secreto_si_no(nombre, defecto):
+    # Interruptor de los secrets: true/false de TOML o texto ("false", "no", "0", "off")
+    try:
+        valor = st.secrets.get(nombre, defecto)
+    except:
+        return defecto
+    if isinstance(valor, str):
+        return valor.strip().lower() not in ("false", "no", "0", "off")
+    return bool(valor)
+
+
+# Inicio del run: se mide hasta el primer pintado y hasta el final del script
+T_INICIO_RUN = time.perf_counter()
+
+
+# --- TRAZAS Y MÉTRICAS DE RENDIMIENTO ---
+
+def _percentil(valores, p):
+    ordenados = sorted(valores)
+    if not ordenados:
+        return 0.0
+    return ordenados[max(0, math.ceil(p / 100 * len(ordenados)) - 1)]
+
+
+class Traza:
+    # Fases (spans) de un run del script y llamadas a APIs externas hechas
+    # durante él. Los hilos del pool de comandos escriben en la misma traza.
+
+    def __init__(self, inicio):
+        self.inicio = inicio
+        self.spans = []  # {"fase", "ms", "error"}
+        self.llamadas = Counter()
+        self._lock = threading.Lock()
+
+    def registrar(self, medida):
+        with self._lock:
+            self.spans.append(medida)
+
+    def contar(self, api, n=1):
+        with self._lock:
+            self.llamadas[api] += n
+
+
+class Metricas:
+    # Agregados del proceso: duración de cada fase (histograma, más las
+    # últimas VENTANA muestras para p50/p95) y llamadas por API externa.
+    # Al cerrar cada run se añade una línea JSON a trazas.jsonl y se reescribe
+    # metricas.prom (formato de texto de Prometheus, apto para el textfile
+    # collector de node_exporter). Sin carpeta no exporta nada.
+
+    CUBETAS_S = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    VENTANA = 200
+    MAX_LOG_BYTES = 5 * 1024 * 1024
+
+    def __init__(self, carpeta=None):
+        self._carpeta = carpeta
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._fases = {}  # fase -> {"cubetas", "suma", "n", "errores", "ultimas"}
+        self._llamadas = Counter()
+
+    # La traza activa es por hilo: cada sesión corre el script en su hilo
+    def activar(self, traza):
+        self._local.traza = traza
+
+    def traza_actual(self):
+        return getattr(self._local, "traza", None)
+
+    def en_traza(self, traza, funcion, *args):
+        # Ejecuta funcion (p. ej. en un hilo del pool) con la traza activa
+        anterior = self.traza_actual()
+        self.activar(traza)
+        try:
+            return funcion(*args)
+        finally:
+            self.activar(anterior)
+
+    def iniciar(self, fase):
+        # Para bloques largos del script; en funciones, mejor span()
+        return {"fase": fase, "ms": 0.0, "error": None, "_t0": time.perf_counter()}
+
+    def terminar(self, medida, error=None):
+        medida["ms"] = round((time.perf_counter() - medida.pop("_t0")) * 1000, 1)
+        medida["error"] = medida["error"] or error
+        self._acumular(medida)
+        traza = self.traza_actual()
+        if traza is not None:
+            traza.registrar(medida)
+
+    @contextmanager
+    def span(self, fase):
+        # Las excepciones quedan anotadas en el span aunque luego se traguen
+        medida = self.iniciar(fase)
+        try:
+            yield medida
+        except BaseException as e:
+            medida["error"] = type(e).__name__
+            raise
+        finally:
+            self.terminar(medida)
+
+    def contar_api(self, api, n=1):
+        with self._lock:
+            self._llamadas[api] += n
+        traza = self.traza_actual()
+        if traza is not None:
+            traza.contar(api, n)
+
+    def _acumular(self, medida):
+        segundos = medida["ms"] / 1000
+        with self._lock:
+            fase = self._fases.get(medida["fase"])
+            if fase is None:
+                fase = self._fases[medida["fase"]] = {
+                    "cubetas": [0] * len(self.CUBETAS_S), "suma": 0.0, "n": 0,
+                    "errores": 0, "ultimas": deque(maxlen=self.VENTANA)}
+            for i, tope in enumerate(self.CUBETAS_S):
+                if segundos <= tope:
+                    fase["cubetas"][i] += 1  # acumulativas, como en Prometheus
+            fase["suma"] += segundos
+            fase["n"] += 1
+            fase["errores"] += 1 if medida["error"] else 0
+            fase["ultimas"].append(medida["ms"])
+
+    def resumen(self):
+        # ({fase: (n, p50_ms, p95_ms, errores)}, {api: llamadas}) del proceso
+        with self._lock:
+            fases = {nombre: (f["n"], _percentil(f["ultimas"], 50),
+                              _percentil(f["ultimas"], 95), f["errores"])
+                     for nombre, f in self._fases.items()}
+            return fases, dict(self._llamadas)
+
+    def texto_prometheus(self):
+        lineas = ["# HELP asistente_fase_segundos Duración de cada fase del script.",
+                  "# TYPE asistente_fase_segundos histogram"]
+        with self._lock:
+            for nombre, f in sorted(self._fases.items()):
+                for tope, n in zip(self.CUBETAS_S, f["cubetas"]):
+                    lineas.append(f'asistente_fase_segundos_bucket{{fase="{nombre}",le="{tope}"}} {n}')
+                lineas.append(f'asistente_fase_segundos_bucket{{fase="{nombre}",le="+Inf"}} {f["n"]}')
+                lineas.append(f'asistente_fase_segundos_sum{{fase="{nombre}"}} {f["suma"]:.6f}')
+                lineas.append(f'asistente_fase_segundos_count{{fase="{nombre}"}} {f["n"]}')
+            lineas += ["# HELP asistente_fase_errores_total Fases que terminaron con excepción.",
+                       "# TYPE asistente_fase_errores_total counter"]
+            lineas += [f'asistente_fase_errores_total{{fase="{nombre}"}} {f["errores"]}'
+                       for nombre, f in sorted(self._fases.items())]
+            lineas += ["# HELP asistente_llamadas_api_total Llamadas HTTP/SMTP a servicios externos.",
+                       "# TYPE asistente_llamadas_api_total counter"]
+            lineas += [f'asistente_llamadas_api_total{{api="{api}"}} {n}'
+                       for api, n in sorted(self._llamadas.items())]
+        return "\n".join(lineas) + "\n"
+
+    def cerrar(self, traza, fase="run", **extra):
+        # Fin del run (o de un fragmento): 'fase' con el total y exportación
+        medida = {"fase": fase, "ms": 0.0, "error": None, "_t0": traza.inicio}
+        self.terminar(medida)
+        if not self._carpeta:
+            return
+        with traza._lock:
+            linea = {"ts": round(time.time(), 3), "total_ms": medida["ms"],
+                     "spans": list(traza.spans), "llamadas": dict(traza.llamadas), **extra}
+        try:
+            os.makedirs(self._carpeta, exist_ok=True)
+            ruta_log = os.path.join(self._carpeta, "trazas.jsonl")
+            if os.path.exists(ruta_log) and os.path.getsize(ruta_log) > self.MAX_LOG_BYTES:
+                os.replace(ruta_log, ruta_log + ".1")
+            with open(ruta_log, "a", encoding="utf-8") as f:
+                f.write(json.dumps(linea, ensure_ascii=False) + "\n")
+            ruta_prom = os.path.join(self._carpeta, "metricas.prom")
+            with open(ruta_prom + ".tmp", "w", encoding="utf-8") as f:
+                f.write(self.texto_prometheus())
+            os.replace(ruta_prom + ".tmp", ruta_prom)
+        except OSError:
+            pass
+
+
+@st.cache_resource
+def obtener_metricas():
+    return Metricas(DIR_DATOS)
+
+
 # --- 2. CONFIGURACIÓN VISUAL ---
 st.set_page_config(page_title="Asistente Personal",
                    page_icon="🟣", layout="wide")
 
+# Traza de este run: cada fase y cada llamada externa queda anotada
+metricas = obtener_metricas()
+traza = Traza(T_INICIO_RUN)
+metricas.activar(traza)
+
 st.markdown("""
 <style>
     /* DERECHA (Panel Principal) */
@@ -45,6 +264,10 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# El título sale antes de cualquier E/S de red (Sheets, Gemini...)
+st.title("Tu Espacio")
+T_PRIMER_PINTADO = time.perf_counter()
+
 # --- INICIALIZACIÓN DE INSTRUCCIONES DEL SISTEMA ---
 # Esto asegura que el asistente sepa usar las 15 tareas y el comando EXTENDER
 if "messages" not in st.session_state:
@@ -77,193 +300,2389 @@ def limpiar_texto_para_audio(texto):
     return t
 
 
+def dividir_frases(texto, max_chars=200):
+    # Trozos de una o más frases, de hasta ~max_chars (gTTS corta a 100
+    # caracteres por petición; trozos cortos = primer audio antes)
+    frases = [f.strip() for f in re.split(r"(?<=[.!?;:])\s+|\n+", texto) if f.strip()]
+    trozos = []
+    for frase in frases:
+        while len(frase) > max_chars:
+            corte = frase.rfind(" ", 0, max_chars)
+            corte = corte if corte > 0 else max_chars
+            trozos.append(frase[:corte].strip())
+            frase = frase[corte:].strip()
+        if trozos and len(trozos[-1]) + len(frase) < 40:
+            trozos[-1] += " " + frase  # juntar frases muy cortas
+        elif frase:
+            trozos.append(frase)
+    return trozos
+
+
+def _sintetizar_gtts(texto, lang):
+    from gtts import gTTS
+    fp = io.BytesIO()
+    gTTS(text=texto, lang=lang).write_to_fp(fp)
+    return fp.getvalue()
+
+
+def cargar_motor_tts(nombre):
+    # "gtts" o "paquete.modulo:funcion" con firma funcion(texto, lang) -> bytes
+    # (permite probar con un motor local falso)
+    if not nombre or nombre == "gtts":
+        return _sintetizar_gtts
+    modulo, _, funcion = nombre.partition(":")
+    return getattr(importlib.import_module(modulo), funcion)
+
+
+class CacheAudio:
+    # Caché LRU en disco de trozos MP3, direccionada por contenido:
+    # clave = sha256(lang + texto). El acceso renueva la fecha del archivo y
+    # al pasar de max_bytes se borran los menos usados.
+
+    def __init__(self, carpeta, max_bytes=50 * 1024 * 1024):
+        self._carpeta = carpeta
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(carpeta, exist_ok=True)
+        self._bytes = sum(e.stat().st_size for e in os.scandir(carpeta) if e.is_file())
+
+    def _ruta(self, texto, lang):
+        clave = hashlib.sha256(f"{lang}\0{texto}".encode("utf-8")).hexdigest()
+        return os.path.join(self._carpeta, clave + ".mp3")
+
+    def leer(self, texto, lang):
+        ruta = self._ruta(texto, lang)
+        try:
+            with open(ruta, "rb") as f:
+                datos = f.read()
+            os.utime(ruta)
+            return datos
+        except OSError:
+            return None
+
+    def guardar(self, texto, lang, datos):
+        ruta = self._ruta(texto, lang)
+        tmp = f"{ruta}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(datos)
+        os.replace(tmp, ruta)
+        with self._lock:
+            self._bytes += len(datos)
+            if self._bytes > self._max_bytes:
+                self._desalojar()
+
+    def _desalojar(self):
+        entradas = sorted((e for e in os.scandir(self._carpeta)
+                           if e.is_file() and e.name.endswith(".mp3")),
+                          key=lambda e: e.stat().st_mtime)
+        self._bytes = sum(e.stat().st_size for e in entradas)
+        for e in entradas:
+            if self._bytes <= self._max_bytes * 0.8:
+                break
+            try:
+                tam = e.stat().st_size
+                os.remove(e.path)
+                self._bytes -= tam
+            except OSError:
+                pass
+
+
+class VozTTS:
+    # Pipeline de voz: divide en frases, sintetiza los trozos en paralelo
+    # (solo los que no están en caché) y los entrega en orden, en cuanto cada
+    # uno está listo. El motor es enchufable.
+
+    def __init__(self, motor, cache, hilos=4, metricas=None):
+        self._motor = motor
+        self._cache = cache
+        self._metricas = metricas or Metricas()
+        self._pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="tts")
+
+    def _trozo(self, texto, lang):
+        datos = self._cache.leer(texto, lang)
+        if datos is None:
+            self._metricas.contar_api("tts")
+            datos = self._motor(texto, lang)
+            self._cache.guardar(texto, lang, datos)
+        return datos
+
+    def sintetizar(self, texto, lang='es'):
+        futuros = [self._pool.submit(self._trozo, t, lang) for t in dividir_frases(texto)]
+        for futuro in futuros:
+            yield futuro.result()
+
+
+@st.cache_resource
+def obtener_voz():
+    try:
+        nombre_motor = st.secrets.get("TTS_MOTOR", "gtts")
+    except:
+        nombre_motor = "gtts"
+    cache = CacheAudio(os.path.join(DIR_DATOS, "tts"))
+    return VozTTS(cargar_motor_tts(nombre_motor), cache, metricas=obtener_metricas())
+
+
 def texto_a_audio(texto):
+    # Generador de trozos MP3 (en orden); vacío si no hay nada que decir
     try:
         if not texto or len(texto) < 2:
-            return None
+            return
         limpio = limpiar_texto_para_audio(texto)
-        tts = gTTS(text=limpio, lang='es')
-        fp = io.BytesIO()
-        tts.write_to_fp(fp)
-        return fp
+        yield from obtener_voz().sintetizar(limpio, 'es')
     except:
-        return None
+        return
+
+
+def audio_continuo(texto):
+    # Un solo MP3 con todos los trozos en orden (los MP3 se concatenan tal
+    # cual): suena de corrido en un reproductor. Los trozos se sintetizan en
+    # paralelo, así que esperar al último cuesta poco más que el primero.
+    return b"".join(texto_a_audio(texto))
+
+# --- PREPROCESADO DEL AUDIO DE ENTRADA ---
+FRECUENCIA_AUDIO = 16000
+TRAMA_VAD_MS = 20
+MARGEN_VAD_MS = 250
+
+
+def _recortar_silencios(muestras):
+    # VAD por energía: RMS por tramas de 20 ms; el umbral se adapta al ruido
+    # de fondo (percentil 10) y se deja un margen antes y después de la voz
+    import numpy as np
+    n = FRECUENCIA_AUDIO * TRAMA_VAD_MS // 1000
+    tramas = len(muestras) // n
+    if tramas < 3:
+        return muestras
+    rms = np.sqrt(np.mean(muestras[:tramas * n].reshape(tramas, n) ** 2, axis=1))
+    umbral = max(np.percentile(rms, 10) * 3, 0.01)
+    voz = np.nonzero(rms > umbral)[0]
+    if not len(voz):
+        return muestras
+    margen = MARGEN_VAD_MS // TRAMA_VAD_MS
+    inicio = max(0, voz[0] - margen) * n
+    fin = min(tramas, voz[-1] + 1 + margen) * n
+    return muestras[inicio:fin]
+
+
+def _codificar_audio(muestras):
+    # OGG/Opus o FLAC si está soundfile (opcional); si no, WAV 16 kHz mono
+    import numpy as np
+    pcm = (np.clip(muestras, -1, 1) * 32767).astype("<i2")
+    try:
+        import soundfile
+        for formato, subtipo, mime in (("OGG", "OPUS", "audio/ogg"), ("FLAC", "PCM_16", "audio/flac")):
+            try:
+                salida = io.BytesIO()
+                soundfile.write(salida, pcm, FRECUENCIA_AUDIO, format=formato, subtype=subtipo)
+                return salida.getvalue(), mime
+            except Exception:
+                continue
+    except ImportError:
+        pass
+    salida = io.BytesIO()
+    with wave.open(salida, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(FRECUENCIA_AUDIO)
+        w.writeframes(pcm.tobytes())
+    return salida.getvalue(), "audio/wav"
+
+
+def preprocesar_audio(datos_wav):
+    # WAV de st.audio_input -> voz recortada, mono, 16 kHz y comprimida.
+    # Devuelve (bytes, mime, info con tamaños y duraciones). Ante cualquier
+    # problema se devuelve el audio original.
+    info = {"bytes_antes": len(datos_wav), "bytes_despues": len(datos_wav),
+            "segundos_antes": 0.0, "segundos_despues": 0.0}
+    try:
+        import numpy as np
+        with wave.open(io.BytesIO(datos_wav), "rb") as w:
+            canales, ancho, frecuencia = w.getnchannels(), w.getsampwidth(), w.getframerate()
+            crudo = w.readframes(w.getnframes())
+        tipos = {1: ("u1", 128, 128), 2: ("<i2", 0, 32768), 4: ("<i4", 0, 2 ** 31)}
+        if ancho not in tipos:
+            return datos_wav, "audio/wav", info
+        tipo, centro, escala = tipos[ancho]
+        muestras = (np.frombuffer(crudo, dtype=tipo).astype(np.float32) - centro) / escala
+        muestras = muestras.reshape(-1, canales).mean(axis=1)  # a mono
+        info["segundos_antes"] = len(muestras) / frecuencia
+        if frecuencia != FRECUENCIA_AUDIO:
+            # Media móvil como filtro anti-aliasing + interpolación lineal
+            paso = frecuencia / FRECUENCIA_AUDIO
+            if paso > 1:
+                k = int(round(paso))
+                muestras = np.convolve(muestras, np.ones(k) / k, mode="same")
+            destino = np.arange(0, len(muestras) - 1, paso)
+            muestras = np.interp(destino, np.arange(len(muestras)), muestras)
+        muestras = _recortar_silencios(muestras)
+        info["segundos_despues"] = len(muestras) / FRECUENCIA_AUDIO
+        datos, mime = _codificar_audio(muestras)
+        if len(datos) >= len(datos_wav):
+            return datos_wav, "audio/wav", info
+        info["bytes_despues"] = len(datos)
+        return datos, mime, info
+    except Exception:
+        return datos_wav, "audio/wav", info
+
 
 # --- 4. FUNCIONES DE CONEXIÓN Y ALERTA ---
 
 
+SCOPES_GOOGLE = [
+    'https://spreadsheets.google.com/feeds',
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive',
+    'https://www.googleapis.com/auth/calendar'
+]
+LIBRO_MEMORIA = "Memoria_Asistente"
+
+
+def _es_handle_obsoleto(e):
+    # 401 = token caducado/revocado; errores de conexión = socket reciclado.
+    # En ambos casos la petición no llegó a ejecutarse y es seguro reintentar.
+    if isinstance(e, (ConnectionError, requests.exceptions.ConnectionError)):
+        return True
+    resp = getattr(e, "response", None)
+    if resp is None:
+        resp = getattr(e, "resp", None)  # googleapiclient.errors.HttpError
+    estado = getattr(resp, "status_code", getattr(resp, "status", None))
+    return str(estado) == "401"
+
+
+class CacheLecturas:
+    # Lecturas a Sheets compartidas por todas las sesiones y pestañas del
+    # proceso: clave (libro, hoja, rango) -> valor, con caducidad (TTL) y como
+    # mucho MAX_ENTRADAS (se descarta la menos usada). Si varias sesiones
+    # piden a la vez una clave que no está, solo una va a la red y las demás
+    # esperan su resultado (singleflight). Nuestras escrituras invalidan la
+    # hoja (ver RegistroGoogle.escribir). Las entradas con 'usuario' son solo
+    # de ese usuario: ni se comparten ni las borra un invalidar() sin él.
+    # Los valores se comparten tal cual: quien los lea no debe modificarlos.
+    # buscar() / poner() la usan sin cargador (p. ej. obtener_cache_respuestas).
+
+    TTL = 15
+    MAX_ENTRADAS = 256
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._datos = OrderedDict()  # clave -> (caduca_en, valor)
+        self._en_vuelo = {}  # clave -> {"listo": Event, "valor", "error", "invalidada"}
+        self.aciertos = 0
+        self.fallos = 0
+        self.compartidas = 0  # fallos que esperaron la lectura de otra sesión
+
+    @staticmethod
+    def _clave(clave, usuario):
+        return (("usuario", usuario) if usuario else ("comun",)) + tuple(clave)
+
+    def obtener(self, clave, cargar, ttl=None, usuario=None):
+        clave = self._clave(clave, usuario)
+        with self._lock:
+            guardado = self._datos.get(clave)
+            if guardado and guardado[0] > time.monotonic():
+                self._datos.move_to_end(clave)
+                self.aciertos += 1
+                return guardado[1]
+            vuelo = self._en_vuelo.get(clave)
+            propio = vuelo is None
+            if propio:
+                vuelo = self._en_vuelo[clave] = {"listo": threading.Event()}
+                self.fallos += 1
+            else:
+                self.compartidas += 1
+        if not propio:
+            vuelo["listo"].wait()
+            if "error" in vuelo:
+                raise vuelo["error"]
+            return vuelo["valor"]
+        try:
+            vuelo["valor"] = cargar()
+        except Exception as e:
+            vuelo["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._en_vuelo[clave]
+                # Si hubo una escritura mientras leíamos, lo leído puede ser
+                # anterior a ella: se entrega a quien esperaba, pero no se guarda
+                if "valor" in vuelo and not vuelo.get("invalidada"):
+                    caduca = time.monotonic() + (self.TTL if ttl is None else ttl)
+                    self._datos[clave] = (caduca, vuelo["valor"])
+                    self._datos.move_to_end(clave)
+                    while len(self._datos) > self.MAX_ENTRADAS:
+                        self._datos.popitem(last=False)
+            vuelo["listo"].set()
+        return vuelo["valor"]
+
+    def buscar(self, clave, usuario=None):
+        # Valor vigente o None (no cuenta como lectura ni espera a nadie)
+        clave = self._clave(clave, usuario)
+        with self._lock:
+            guardado = self._datos.get(clave)
+            if guardado and guardado[0] > time.monotonic():
+                self._datos.move_to_end(clave)
+                self.aciertos += 1
+                return guardado[1]
+            self.fallos += 1
+            return None
+
+    def poner(self, clave, valor, ttl=None, usuario=None):
+        clave = self._clave(clave, usuario)
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + (self.TTL if ttl is None else ttl), valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.MAX_ENTRADAS:
+                self._datos.popitem(last=False)
+
+    def invalidar(self, *prefijo, usuario=None):
+        # Borra las claves que empiezan por 'prefijo' (p. ej. libro, hoja)
+        prefijo = self._clave(prefijo, usuario)
+        n = len(prefijo)
+        with self._lock:
+            for clave in [c for c in self._datos if c[:n] == prefijo]:
+                del self._datos[clave]
+            for clave, vuelo in self._en_vuelo.items():
+                if clave[:n] == prefijo:
+                    vuelo["invalidada"] = True
+
+    def estadisticas(self):
+        with self._lock:
+            return {"aciertos": self.aciertos, "fallos": self.fallos,
+                    "compartidas": self.compartidas, "entradas": len(self._datos)}
+
+
+def _clave_hoja(hoja):
+    # (libro, hoja) estable entre reconexiones: el ID del libro en Sheets
+    libro = hoja.spreadsheet
+    return (getattr(libro, "id", None) or id(libro), hoja.title)
+
+
+class RegistroGoogle:
+    # Clientes autorizados compartidos por todo el proceso (sobreviven a los
+    # reruns de Streamlit): credenciales, cliente gspread, hojas abiertas y
+    # servicio de Calendar. Renueva el token antes de que caduque y reconecta
+    # cuando un handle queda obsoleto. Las lecturas repetidas entre sesiones
+    # pasan por leer() (caché del proceso) y las escrituras por escribir().
+
+    def __init__(self, creds_dict, metricas=None):
+        self._creds_dict = creds_dict
+        self.metricas = metricas or Metricas()
+        self.cache = CacheLecturas()
+        self._lock = threading.RLock()
+        self._creds = None
+        self._token_cliente = None
+        self._cliente = None
+        self._libros = {}
+        self._hojas = {}
+        self._calendario = None
+
+    def credenciales(self):
+        with self._lock:
+            if self._creds is None:
+                from oauth2client.service_account import ServiceAccountCredentials
+                self._creds = ServiceAccountCredentials.from_json_keyfile_dict(
+                    self._creds_dict, SCOPES_GOOGLE)
+            # get_access_token() solo va a la red si el token falta o caducó
+            self._creds.get_access_token()
+            return self._creds
+
+    def cliente_sheets(self):
+        with self._lock:
+            creds = self.credenciales()
+            if self._cliente is None or self._token_cliente != creds.access_token:
+                # Token nuevo: re-autorizamos y descartamos los handles viejos
+                import gspread
+                self._cliente = gspread.authorize(creds)
+                self._token_cliente = creds.access_token
+                self._contar_peticiones(self._cliente)
+                self._libros.clear()
+                self._hojas.clear()
+            return self._cliente
+
+    def _contar_peticiones(self, cliente):
+        # Cada respuesta HTTP de la sesión de gspread cuenta como una llamada
+        # (gspread 6: cliente.http_client.session; 5: cliente.session)
+        sesion = getattr(getattr(cliente, "http_client", None), "session", None) \
+            or getattr(cliente, "session", None)
+        hooks = getattr(sesion, "hooks", None)
+        if hooks is not None:
+            hooks.setdefault("response", []).append(
+                lambda resp, *args, **kwargs: self.metricas.contar_api("sheets"))
+
+    def libro(self, nombre=None, clave=None):
+        with self._lock:
+            cliente = self.cliente_sheets()
+            id_libro = clave or nombre
+            if id_libro not in self._libros:
+                if clave:
+                    self._libros[id_libro] = cliente.open_by_key(clave)
+                else:
+                    self._libros[id_libro] = cliente.open(nombre)
+            return self._libros[id_libro]
+
+    def hoja(self, titulo=None, nombre_libro=None, clave_libro=None,
+             cabecera=None, opcional=False):
+        # titulo=None -> primera hoja (sheet1). Si la hoja no existe: con
+        # 'cabecera' se crea con esa fila 1; con 'opcional' se devuelve None
+        # (también se recuerda, hasta la próxima renovación del token)
+        with self._lock:
+            libro = self.libro(nombre_libro, clave_libro)
+            id_hoja = (clave_libro or nombre_libro, titulo)
+            if self._hojas.get(id_hoja) is None and not (opcional and id_hoja in self._hojas):
+                if titulo is None:
+                    self._hojas[id_hoja] = libro.sheet1
+                else:
+                    try:
+                        self._hojas[id_hoja] = libro.worksheet(titulo)
+                    except Exception as e:
+                        if type(e).__name__ != "WorksheetNotFound" or not (cabecera or opcional):
+                            raise
+                        if opcional:
+                            self._hojas[id_hoja] = None
+                        else:
+                            nueva = libro.add_worksheet(titulo, rows=1, cols=len(cabecera))
+                            nueva.append_row(cabecera)
+                            self._hojas[id_hoja] = nueva
+            return self._hojas[id_hoja]
+
+    def calendario(self):
+        with self._lock:
+            creds = self.credenciales()
+            if self._calendario is None:
+                from googleapiclient.discovery import build
+                # Documento de descubrimiento estático (viene con la librería):
+                # construir el servicio no toca la red
+                try:
+                    self._calendario = build('calendar', 'v3', credentials=creds,
+                                             cache_discovery=False, static_discovery=True)
+                except TypeError:  # google-api-python-client < 2.0
+                    self._calendario = build('calendar', 'v3', credentials=creds,
+                                             cache_discovery=False)
+            return self._calendario
+
+    def invalidar(self):
+        with self._lock:
+            self._token_cliente = None
+            self._cliente = None
+            self._libros.clear()
+            self._hojas.clear()
+            self._calendario = None
+
+    def leer(self, hoja, rango=None, ttl=None):
+        # get_all_values() (rango None) o get(rango), a través de la caché
+        return self.cache.obtener(
+            _clave_hoja(hoja) + (rango,),
+            lambda: hoja.get(rango) if rango else hoja.get_all_values(), ttl)
+
+    def escribir(self, hoja, operacion):
+        # operacion(hoja) escribe; después (aunque falle: pudo quedar a
+        # medias) se descartan las lecturas de esa hoja guardadas en caché
+        try:
+            return operacion(hoja)
+        finally:
+            self.cache.invalidar(*_clave_hoja(hoja))
+
+    def con_reconexion(self, operacion):
+        # Ejecuta operacion(self); si falló por un handle obsoleto, reconecta
+        # y lo intenta una sola vez más.
+        try:
+            return operacion(self)
+        except Exception as e:
+            if not _es_handle_obsoleto(e):
+                raise
+            self.invalidar()
+            return operacion(self)
+
+
+@st.cache_resource
+def obtener_registro_google():
+    try:
+        creds_dict = json.loads(st.secrets["GOOGLE_CREDENTIALS"], strict=False)
+        return RegistroGoogle(creds_dict, obtener_metricas())
+    except:
+        return None
+
+
 def obtener_credenciales():
     try:
-        json_text = st.secrets["GOOGLE_CREDENTIALS"]
-        creds_dict = json.loads(json_text, strict=False)
-        scope = [
-            'https://spreadsheets.google.com/feeds',
-            'https://www.googleapis.com/auth/drive',
-            'https://www.googleapis.com/auth/calendar'
-        ]
-        return ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+        registro = obtener_registro_google()
+        return registro.credenciales() if registro else None
     except:
         return None
 
-def conectar_memoria(creds):
+def conectar_memoria(registro):
+    # (hoja de chat, hoja de perfil). Si el libro ya está particionado, la
+    # hoja de chat es el índice de conversaciones (ver ChatParticionado)
     try:
-        client = gspread.authorize(creds)
-        wb = client.open("Memoria_Asistente")
-        return wb.sheet1, wb.worksheet("Perfil")
+        return registro.con_reconexion(lambda r: (
+            r.hoja(HOJA_INDICE_CHAT, nombre_libro=LIBRO_MEMORIA, opcional=True)
+            or r.hoja(nombre_libro=LIBRO_MEMORIA),
+            r.hoja("Perfil", nombre_libro=LIBRO_MEMORIA)))
     except:
         return None, None
 
-def crear_evento_calendario(creds, resumen, inicio_iso, fin_iso, nota_alerta="", recurrence=None):
+class EspejoChat:
+    # Copia local de la hoja de chat (sheet1 de Memoria_Asistente). Recuerda
+    # la última fila leída y en cada sincronización solo descarga las filas
+    # añadidas después, con una lectura por rango.
+
+    INTERVALO_SYNC = 3  # segundos mínimos entre lecturas a la hoja
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vaciar()
+
+    def _vaciar(self):
+        self._ultima_fila = 1  # la fila 1 es la cabecera
+        self._fila_testigo = []  # contenido de la última fila leída
+        self._por_conv = {}  # id -> [(fecha, rol, mensaje), ...]
+        self._ultimo_sync = 0.0
+
+    @staticmethod
+    def _normalizar(fila):
+        # get_all_values rellena con "" y las lecturas por rango recortan las
+        # celdas vacías del final: comparamos ambas en la misma forma
+        fila = [str(c) for c in fila[:4]]
+        while fila and fila[-1] == "":
+            fila.pop()
+        return fila
+
+    def _indexar(self, filas):
+        for fila in filas:
+            if len(fila) >= 4:
+                self._por_conv.setdefault(fila[0], []).append((fila[1], fila[2], fila[3]))
+            elif fila and fila[0].strip().isdigit():
+                self._por_conv.setdefault(fila[0], [])
+
+    def sincronizar(self, hoja, forzar=False):
+        with self._lock:
+            if not forzar and time.monotonic() - self._ultimo_sync < self.INTERVALO_SYNC:
+                return
+            if self._ultima_fila <= 1:
+                nuevas = hoja.get_all_values()[1:]
+            else:
+                # Una sola llamada: la última fila conocida (para detectar
+                # borrados o ediciones que desplazan filas) + todo lo nuevo
+                testigo, nuevas = hoja.batch_get([
+                    f"A{self._ultima_fila}:D{self._ultima_fila}",
+                    f"A{self._ultima_fila + 1}:D"])
+                actual = self._normalizar(testigo[0]) if testigo else []
+                if actual != self._fila_testigo:
+                    self._vaciar()
+                    nuevas = hoja.get_all_values()[1:]
+            nuevas = [self._normalizar(f) for f in nuevas]
+            self._indexar(nuevas)
+            self._ultima_fila += len(nuevas)
+            if nuevas:
+                self._fila_testigo = nuevas[-1]
+            self._ultimo_sync = time.monotonic()
+
+    def ids(self):
+        with self._lock:
+            return sorted((i for i in self._por_conv if i.strip().isdigit()), key=int)
+
+    def sincronizado(self):
+        # Ya se leyó la hoja al menos una vez en este proceso
+        with self._lock:
+            return self._ultimo_sync > 0
+
+    def tiene_filas(self):
+        with self._lock:
+            return self._ultima_fila > 1
+
+    def pagina(self, id_conv, limite, cursor=None):
+        # Hasta 'limite' mensajes anteriores a 'cursor' (None = desde el final)
+        # y el cursor de la página siguiente (None si ya no hay más).
+        # Aquí el cursor es la posición en la conversación.
+        with self._lock:
+            filas = self._por_conv.get(str(id_conv), [])
+            fin = len(filas) if cursor is None else min(cursor, len(filas))
+            inicio = max(0, fin - limite)
+            return [(rol, msg) for _, rol, msg in filas[inicio:fin]], (inicio or None)
+
+    def avanzar_cursor(self, id_conv, cursor, n):
+        # Cursor tras descartar de la ventana sus 'n' mensajes más antiguos
+        return (cursor or 0) + n
+
+    def historial(self, id_conv):
+        # Toda la conversación con fechas (para importarla al almacén local)
+        with self._lock:
+            return list(self._por_conv.get(str(id_conv), []))
+
+    # Formato plano: una fila [ID, Fecha, Rol, Mensaje] en sheet1
+    def destino(self, id_conv):
+        return DESTINO_CHAT
+
+    def fila(self, id_conv, fecha, rol, mensaje):
+        return [id_conv, fecha, rol, mensaje]
+
+    def pendientes(self, cola, id_conv):
+        return [(f[2], f[3]) for f in cola.pendientes(DESTINO_CHAT)
+                if str(f[0]) == str(id_conv)]
+
+    def guardar(self, cola, id_conv, fecha, rol, mensaje):
+        if cola:
+            cola.encolar(self.destino(id_conv), self.fila(id_conv, fecha, rol, mensaje))
+
+
+@st.cache_resource
+def obtener_espejo_chat():
+    return EspejoChat()
+
+
+HOJA_INDICE_CHAT = "Indice_Chat"
+CABECERA_INDICE_CHAT = ["ID", "Hoja", "Libro", "Rango", "Mensajes", "Ultima_Actividad"]
+CABECERA_CONVERSACION = ["Fecha", "Rol", "Mensaje"]
+PREFIJO_HOJA_CONV = "Chat_"
+
+
+def _ultima_fila_escrita(respuesta):
+    # Del resultado de append_rows: "Chat_5!A12:C13" -> 13 (None si no hay)
     try:
-        service = build('calendar', 'v3', credentials=creds)
-        reminders = {'useDefault': False, 'overrides': [
-            {'method': 'popup', 'minutes': 10}]}
-
-        description = f"Agendado por Asistente.\n{nota_alerta}"
-        evento = {
-            'summary': resumen,
-            'description': description,
-            'start': {'dateTime': inicio_iso, 'timeZone': 'America/Lima'},
-            'end': {'dateTime': fin_iso, 'timeZone': 'America/Lima'},
-            'reminders': reminders
-        }
-
-        # Si hay regla de repetición, la agregamos
-        if recurrence:
-            evento['recurrence'] = [recurrence]
-
-        creado = service.events().insert(calendarId=TU_EMAIL_GMAIL, body=evento).execute()
+        rango = respuesta["updates"]["updatedRange"]
+        return int(re.search(r"(\d+)$", rango).group(1))
+    except (TypeError, KeyError, AttributeError):
+        return None
+
+
+class ChatParticionado:
+    # Chat repartido en una hoja por conversación (Chat_<id>: Fecha, Rol,
+    # Mensaje) y un índice pequeño (Indice_Chat: ID, Hoja, Libro, Rango,
+    # Mensajes, Ultima_Actividad). Libro vacío = Memoria_Asistente; si no,
+    # la clave del libro de archivo al que se movió la conversación.
+    # Cargar una conversación lee solo sus últimas filas: O(mensajes pedidos),
+    # sin importar cuántas conversaciones haya. El índice se mantiene desde
+    # la cola de escritura (ver al_guardar) con la fila exacta que devolvió
+    # cada append. Se crea con herramientas/migrar_chat.py.
+
+    INTERVALO_SYNC = 10  # segundos mínimos entre lecturas del índice
+
+    def __init__(self, registro):
+        self._registro = registro
+        self._lock = threading.Lock()
+        self._indice = {}  # id -> {"fila", "hoja", "libro", "mensajes", "ultima"}
+        self._cache = {}  # id -> {"desde": n_fila, "filas": [(rol, msg), ...]}
+        self._ultimo_sync = 0.0
+        # Una lectura del índice a la vez: quien llega durante otra la espera
+        # en vez de seguir con el índice todavía vacío
+        self._lock_sync = threading.Lock()
+
+    def sincronizar(self, hoja_indice, forzar=False):
+        with self._lock_sync:
+            with self._lock:
+                if not forzar and time.monotonic() - self._ultimo_sync < self.INTERVALO_SYNC:
+                    return
+            filas = self._registro.leer(hoja_indice)[1:]
+            indice = {}
+            for n, fila in enumerate(filas, start=2):
+                fila = list(fila) + [""] * (len(CABECERA_INDICE_CHAT) - len(fila))
+                if not fila[0].strip():
+                    continue
+                indice[fila[0].strip()] = {
+                    "fila": n, "hoja": fila[1] or PREFIJO_HOJA_CONV + fila[0].strip(),
+                    "libro": fila[2], "mensajes": int(fila[4] or 0), "ultima": fila[5]}
+            with self._lock:
+                self._indice = indice
+                self._ultimo_sync = time.monotonic()
+
+    def ids(self):
+        with self._lock:
+            return sorted((i for i in self._indice if i.isdigit()), key=int)
+
+    def sincronizado(self):
+        with self._lock:
+            return self._ultimo_sync > 0
+
+    def tiene_filas(self):
+        with self._lock:
+            return bool(self._indice)
+
+    def _hoja_conv(self, r, entrada):
+        if entrada["libro"]:
+            return r.hoja(entrada["hoja"], clave_libro=entrada["libro"])
+        return r.hoja(entrada["hoja"], nombre_libro=LIBRO_MEMORIA)
+
+    def _leer(self, entrada, rango):
+        valores = self._registro.con_reconexion(
+            lambda r: r.leer(self._hoja_conv(r, entrada), rango))
+        return [(f[1] if len(f) > 1 else "", f[2] if len(f) > 2 else "") for f in valores]
+
+    def _leer_desde(self, entrada, n_fila):
+        # Rango abierto: trae también filas que el índice aún no cuenta
+        return self._leer(entrada, f"A{n_fila}:C")
+
+    def mensajes(self, id_conv, limite):
+        id_conv = str(id_conv)
+        with self._lock:
+            entrada = self._indice.get(id_conv)
+            cache = self._cache.get(id_conv)
+        if entrada is None:
+            return []
+        ultima = entrada["mensajes"] + 1  # la fila 1 es la cabecera
+        primera = max(2, ultima - limite + 1)
+        if cache and cache["desde"] <= primera:
+            # Ya tenemos el principio de la ventana: solo falta lo nuevo
+            siguiente = cache["desde"] + len(cache["filas"])
+            if siguiente <= ultima:
+                nuevas = self._leer_desde(entrada, siguiente)
+                with self._lock:
+                    if cache["desde"] + len(cache["filas"]) == siguiente:
+                        cache["filas"] += nuevas
+        else:
+            cache = {"desde": primera, "filas": self._leer_desde(entrada, primera)}
+            with self._lock:
+                self._cache[id_conv] = cache
+        with self._lock:
+            return list(cache["filas"][-limite:])
+
+    def pagina(self, id_conv, limite, cursor=None):
+        # Como EspejoChat.pagina; el cursor es la fila de la hoja del mensaje
+        # más antiguo ya cargado. Las páginas anteriores se leen por rango
+        # cerrado y no pasan por la caché (que solo guarda el final).
+        id_conv = str(id_conv)
+        if cursor is None:
+            filas = self.mensajes(id_conv, limite)
+            with self._lock:
+                cache = self._cache.get(id_conv)
+                primera = cache["desde"] + len(cache["filas"]) - len(filas) if cache else 2
+            return filas, (primera if primera > 2 else None)
+        with self._lock:
+            entrada = self._indice.get(id_conv)
+        primera = max(2, cursor - limite)
+        if entrada is None or primera >= cursor:
+            return [], None
+        return self._leer(entrada, f"A{primera}:C{cursor - 1}"), (primera if primera > 2 else None)
+
+    def avanzar_cursor(self, id_conv, cursor, n):
+        return (cursor or 2) + n
+
+    def historial(self, id_conv):
+        # Toda la conversación con fechas, en una lectura (no usa la caché)
+        with self._lock:
+            entrada = self._indice.get(str(id_conv))
+        if entrada is None:
+            return []
+        valores = self._registro.con_reconexion(
+            lambda r: r.leer(self._hoja_conv(r, entrada), "A2:C"))
+        return [tuple((list(f) + ["", "", ""])[:3]) for f in valores]
+
+    def destino(self, id_conv):
+        with self._lock:
+            entrada = self._indice.get(str(id_conv))
+        destino = {"titulo": PREFIJO_HOJA_CONV + str(id_conv),
+                   "cabecera": CABECERA_CONVERSACION}
+        if entrada and entrada["libro"]:
+            destino.update(titulo=entrada["hoja"], clave_libro=entrada["libro"])
+        else:
+            destino["nombre_libro"] = LIBRO_MEMORIA
+        return destino
+
+    def fila(self, id_conv, fecha, rol, mensaje):
+        return [fecha, rol, mensaje]
+
+    def pendientes(self, cola, id_conv):
+        return [(f[1], f[2]) for f in cola.pendientes(self.destino(id_conv))]
+
+    def guardar(self, cola, id_conv, fecha, rol, mensaje):
+        if cola:
+            cola.encolar(self.destino(id_conv), self.fila(id_conv, fecha, rol, mensaje))
+
+    def al_guardar(self, destino, filas, respuesta):
+        # Observador de la cola de escritura: tras cada append a una hoja
+        # Chat_<id> actualiza (o crea) su fila del índice
+        titulo = destino.get("titulo") or ""
+        if not titulo.startswith(PREFIJO_HOJA_CONV) or not filas:
+            return
+        id_conv = titulo[len(PREFIJO_HOJA_CONV):]
+        libro = destino.get("clave_libro", "")
+        with self._lock:
+            entrada = self._indice.get(id_conv)
+            ultima = _ultima_fila_escrita(respuesta)
+            if ultima is None:
+                ultima = (entrada["mensajes"] + 1 if entrada else 1) + len(filas)
+            # Lo recién escrito también va a la caché si es contiguo
+            cache = self._cache.get(id_conv)
+            if cache and cache["desde"] + len(cache["filas"]) == ultima - len(filas) + 1:
+                cache["filas"] += [(f[1], f[2]) for f in filas]
+            n_fila = entrada["fila"] if entrada else None
+        valores = [id_conv, titulo, libro, f"A2:C{ultima}", ultima - 1, filas[-1][0]]
+        hoja_indice = self._registro.con_reconexion(
+            lambda r: r.hoja(HOJA_INDICE_CHAT, nombre_libro=LIBRO_MEMORIA,
+                             cabecera=CABECERA_INDICE_CHAT))
+        if n_fila:
+            self._registro.escribir(hoja_indice, lambda h: h.batch_update(
+                [{"range": f"A{n_fila}:F{n_fila}", "values": [valores]}]))
+        else:
+            n_fila = _ultima_fila_escrita(self._registro.escribir(
+                hoja_indice, lambda h: h.append_rows([valores])))
+            if n_fila is None:
+                with self._lock:
+                    n_fila = max((e["fila"] for e in self._indice.values()), default=1) + 1
+        with self._lock:
+            self._indice[id_conv] = {"fila": n_fila, "hoja": titulo, "libro": libro,
+                                     "mensajes": ultima - 1, "ultima": filas[-1][0]}
+
+
+@st.cache_resource
+def obtener_chat_particionado():
+    registro = obtener_registro_google()
+    chat = ChatParticionado(registro)
+    cola = obtener_cola_escritura()
+    if cola:
+        cola.suscribir(chat.al_guardar)
+    return chat
+
+
+def almacen_chat(hoja_chat, cola=None):
+    # EspejoChat (sheet1 plano) o ChatParticionado (si existe Indice_Chat).
+    # Con almacén local, ChatSQLite por delante y uno de esos dos como réplica
+    # (hoja_chat None = sin conexión: solo la base local)
+    fuente = None
+    if hoja_chat is not None:
+        if getattr(hoja_chat, "title", None) == HOJA_INDICE_CHAT:
+            fuente = obtener_chat_particionado()
+        else:
+            fuente = obtener_espejo_chat()
+    almacen = obtener_almacen_local()
+    if almacen is None:
+        return fuente
+    return almacen.chat.conectar(fuente, cola)
+
+
+DESTINO_CHAT = {"nombre_libro": LIBRO_MEMORIA}
+DESTINO_PERFIL = {"titulo": "Perfil", "nombre_libro": LIBRO_MEMORIA}
+
+
+def destino_tareas():
+    return {"titulo": "Tareas", "clave_libro": st.secrets["SPREADSHEET_ID"]}
+
+
+class ColaEscritura:
+    # Cola write-behind de las escrituras a Sheets. Las filas se acumulan por
+    # hoja destino y un hilo en segundo plano las manda en un solo append_rows
+    # cuando hay MAX_LOTE filas o la más vieja lleva MAX_ESPERA segundos.
+    # También acepta cambios de celdas (encolar_celdas), que salen en un
+    # batch_update por hoja después de los append. Todo lo pendiente vive también en un spool local (JSONL), así que un
+    # reinicio del proceso no pierde nada: se reenvía al arrancar.
+    # Un append que falla pudo llegar igual a la hoja (timeout, conexión
+    # cortada tras enviarlo): sus filas quedan marcadas como dudosas y, antes
+    # de reenviarlas, se mira si ya son las últimas de la hoja.
+
+    MAX_LOTE = 20
+    MAX_ESPERA = 2.0
+    MAX_ESPERA_ERROR = 60.0
+
+    def __init__(self, ruta_spool, registro):
+        self._ruta = ruta_spool
+        self._registro = registro
+        self._cond = threading.Condition()
+        self._pendientes = []  # [{"id", "destino", "fila" | "celdas", "t"}]
+        self._sig_id = 1
+        self._forzar = False
+        self._no_antes = 0.0  # backoff tras un error
+        self._espera_error = 0.0
+        self._fallos = 0
+        self._ultimo_error = None
+        self._ultimo_envio = None
+        self._observadores = []  # funcion(destino, filas, respuesta_append)
+        self._cargar_spool()
+        threading.Thread(target=self._bucle, name="cola-escritura",
+                         daemon=True).start()
+
+    def _cargar_spool(self):
+        try:
+            with open(self._ruta, encoding="utf-8") as f:
+                for linea in f:
+                    try:
+                        self._pendientes.append(json.loads(linea))
+                    except ValueError:
+                        pass  # línea a medio escribir por un corte
+        except FileNotFoundError:
+            return
+        if self._pendientes:
+            self._sig_id = max(op["id"] for op in self._pendientes) + 1
+
+    def _reescribir_spool(self):
+        tmp = self._ruta + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for op in self._pendientes:
+                f.write(json.dumps(op, ensure_ascii=False) + "\n")
+        os.replace(tmp, self._ruta)
+
+    def suscribir(self, funcion):
+        # Se llama (desde el hilo de la cola) tras cada append que tuvo éxito
+        with self._cond:
+            self._observadores.append(funcion)
+
+    def encolar(self, destino, fila):
+        self._encolar({"destino": destino, "fila": fila})
+
+    def encolar_celdas(self, destino, celdas):
+        # celdas: [{"range": "B5", "values": [[True]]}, ...] como batch_update
+        self._encolar({"destino": destino, "celdas": celdas})
+
+    def _encolar(self, op):
+        with self._cond:
+            op.update(id=self._sig_id, t=time.time())
+            self._sig_id += 1
+            with open(self._ruta, "a", encoding="utf-8") as f:
+                f.write(json.dumps(op, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._pendientes.append(op)
+            self._cond.notify_all()
+
+    def _segundos_para_enviar(self):
+        # None = esperar sin límite; 0 = enviar ya
+        if not self._pendientes:
+            return None
+        ahora = time.time()
+        if self._forzar:
+            return 0
+        if ahora < self._no_antes:
+            return self._no_antes - ahora
+        if len(self._pendientes) >= self.MAX_LOTE:
+            return 0
+        return max(0, self._pendientes[0]["t"] + self.MAX_ESPERA - ahora)
+
+    def _bucle(self):
+        while True:
+            with self._cond:
+                espera = self._segundos_para_enviar()
+                while espera != 0:
+                    self._cond.wait(espera)
+                    espera = self._segundos_para_enviar()
+                lote = list(self._pendientes)
+                self._forzar = False
+            self._enviar(lote)
+
+    def _enviar(self, lote):
+        grupos = {}
+        for op in lote:
+            clave = json.dumps(op["destino"], sort_keys=True)
+            grupos.setdefault(clave, (op["destino"], []))[1].append(op)
+
+        enviados = set()
+        error = None
+        for destino, ops in grupos.values():
+            ops_filas = [op for op in ops if "fila" in op]
+            ops_celdas = [op for op in ops if "celdas" in op]
+            dudosas = [op for op in ops_filas if op.get("dudosa")]
+            if dudosas:
+                try:
+                    respuesta = self._ya_escritas(destino, [op["fila"] for op in dudosas])
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                    continue
+                if respuesta is not None:
+                    enviados.update(op["id"] for op in dudosas)
+                    self._avisar(destino, [op["fila"] for op in dudosas], respuesta)
+                    ops_filas = [op for op in ops_filas if not op.get("dudosa")]
+            if ops_filas:
+                filas = [op["fila"] for op in ops_filas]
+                try:
+                    respuesta = self._registro.con_reconexion(
+                        lambda r, d=destino, f=filas: r.escribir(
+                            r.hoja(**d), lambda h: h.append_rows(f)))
+                    enviados.update(op["id"] for op in ops_filas)
+                except Exception as e:
+                    # Las celdas esperan: pueden ser de una fila aún sin escribir
+                    for op in ops_filas:
+                        op["dudosa"] = True  # se guarda con el spool, abajo
+                    error = f"{type(e).__name__}: {e}"
+                    continue
+                self._avisar(destino, filas, respuesta)
+            if ops_celdas:
+                celdas = [c for op in ops_celdas for c in op["celdas"]]
+                try:
+                    self._registro.con_reconexion(
+                        lambda r, d=destino, c=celdas: r.escribir(
+                            r.hoja(**d), lambda h: h.batch_update(c)))
+                    enviados.update(op["id"] for op in ops_celdas)
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+
+        with self._cond:
+            self._pendientes = [
+                op for op in self._pendientes if op["id"] not in enviados]
+            try:
+                self._reescribir_spool()
+            except OSError as e:
+                error = error or f"Spool: {e}"
+            if enviados:
+                self._ultimo_envio = time.time()
+            if error:
+                self._fallos += 1
+                self._ultimo_error = error
+                self._espera_error = min(
+                    self.MAX_ESPERA_ERROR, max(1.0, self._espera_error * 2))
+                self._no_antes = time.time() + self._espera_error
+            else:
+                self._ultimo_error = None
+                self._espera_error = 0.0
+                self._no_antes = 0.0
+            self._cond.notify_all()
+
+    def _ya_escritas(self, destino, filas):
+        # ¿Son 'filas' las últimas de la hoja? Si lo son, devuelve la
+        # respuesta que habría dado su append; si no, None
+        valores = self._registro.con_reconexion(lambda r: r.hoja(**destino).get_all_values())
+        if len(valores) < len(filas) or \
+                [_celdas_leidas(f) for f in valores[-len(filas):]] != [_celdas_leidas(f) for f in filas]:
+            return None
+        return {"updates": {"updatedRange": f"A{len(valores) - len(filas) + 1}:A{len(valores)}"}}
+
+    def _avisar(self, destino, filas, respuesta):
+        for funcion in list(self._observadores):
+            try:
+                funcion(destino, filas, respuesta)
+            except Exception:
+                pass  # las filas ya están escritas: no se reenvían
+
+    def vaciar(self, timeout=10.0):
+        # Envía ya lo pendiente y espera el resultado (p. ej. antes de leer la
+        # hoja de tareas). Devuelve False si quedó algo sin enviar.
+        limite = time.time() + timeout
+        with self._cond:
+            if not self._pendientes:
+                return True
+            objetivo = self._sig_id - 1
+            fallos = self._fallos
+            self._forzar = True
+            self._cond.notify_all()
+            while any(op["id"] <= objetivo for op in self._pendientes):
+                restante = limite - time.time()
+                if restante <= 0 or self._fallos != fallos:
+                    return False
+                self._cond.wait(restante)
+            return True
+
+    def pendientes(self, destino):
+        with self._cond:
+            return [op["fila"] for op in self._pendientes
+                    if op["destino"] == destino and "fila" in op]
+
+    def pendientes_celdas(self, destino):
+        with self._cond:
+            return [c for op in self._pendientes
+                    if op["destino"] == destino and "celdas" in op for c in op["celdas"]]
+
+    def estado(self):
+        with self._cond:
+            return {"pendientes": len(self._pendientes),
+                    "ultimo_error": self._ultimo_error,
+                    "ultimo_envio": self._ultimo_envio}
+
+
+def _celdas_leidas(fila):
+    # Una fila como la devuelve Sheets: texto, booleanos en mayúsculas y sin
+    # celdas vacías al final
+    celdas = ["TRUE" if c is True else "FALSE" if c is False else str(c) for c in fila]
+    while celdas and celdas[-1] == "":
+        celdas.pop()
+    return celdas
+
+
+@st.cache_resource
+def obtener_cola_escritura():
+    registro = obtener_registro_google()
+    if registro is None:
+        return None
+    os.makedirs(DIR_DATOS, exist_ok=True)
+    return ColaEscritura(os.path.join(DIR_DATOS, "spool_escrituras.jsonl"), registro)
+
+
+# --- ALMACÉN LOCAL (SQLite) CON RÉPLICA A SHEETS ---
+
+class RefrescoFondo:
+    # Ejecuta una función en un hilo aparte, como mucho cada 'intervalo'
+    # segundos y nunca dos a la vez. Los errores se quedan aquí (ultimo_error)
+    # y se reintenta en la siguiente ventana.
+
+    def __init__(self, intervalo, nombre):
+        self.intervalo = intervalo
+        self._nombre = nombre
+        self._lock = threading.Lock()
+        self._en_curso = False
+        self._ultimo = None
+        self.ultimo_error = None
+
+    def lanzar(self, funcion, *args):
+        with self._lock:
+            ahora = time.monotonic()
+            if self._en_curso or (self._ultimo is not None
+                                  and ahora - self._ultimo < self.intervalo):
+                return False
+            self._en_curso = True
+            self._ultimo = ahora
+        threading.Thread(target=self._correr, args=(funcion,) + args,
+                         name=self._nombre, daemon=True).start()
+        return True
+
+    def _correr(self, funcion, *args):
+        try:
+            funcion(*args)
+            self.ultimo_error = None
+        except Exception as e:
+            self.ultimo_error = f"{type(e).__name__}: {e}"
+        finally:
+            with self._lock:
+                self._en_curso = False
+
+
+class AlmacenLocal:
+    # Base SQLite en DIR_DATOS: almacén principal del chat, el perfil y las
+    # tareas. Se lee y se escribe aquí; las hojas de Google quedan como
+    # réplica (vía ColaEscritura) y como vista que se puede editar a mano.
+    # Una conexión compartida por todos los hilos, protegida con un lock, en
+    # modo WAL. Con ALMACEN = "sheets" no se usa (ver obtener_almacen_local).
+
+    ESQUEMA = """
+        CREATE TABLE IF NOT EXISTS mensajes (
+            n INTEGER PRIMARY KEY AUTOINCREMENT,
+            conv TEXT NOT NULL,
+            fecha TEXT NOT NULL,
+            rol TEXT NOT NULL,
+            texto TEXT NOT NULL,
+            replicada INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS mensajes_conv_fecha ON mensajes (conv, fecha, n);
+        CREATE INDEX IF NOT EXISTS mensajes_sin_replicar ON mensajes (n) WHERE replicada = 0;
+        CREATE TABLE IF NOT EXISTS conversaciones (
+            conv TEXT PRIMARY KEY,
+            importada INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS perfil (
+            n INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TEXT NOT NULL,
+            dato TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tareas (
+            fila INTEGER PRIMARY KEY,
+            valores TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            clave TEXT PRIMARY KEY,
+            valor TEXT
+        );
+    """
+
+    def __init__(self, ruta):
+        self.lock = threading.RLock()
+        self._con = sqlite3.connect(ruta, check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        self._con.executescript(self.ESQUEMA)
+        self.chat = ChatSQLite(self)
+        self.perfil = PerfilSQLite(self)
+        self.tareas = TareasSQLite(self)
+
+    def consulta(self, sql, parametros=()):
+        with self.lock:
+            return self._con.execute(sql, parametros).fetchall()
+
+    @contextmanager
+    def transaccion(self):
+        # Todo lo de dentro se confirma junto (o nada, si hay una excepción)
+        with self.lock, self._con:
+            yield self._con
+
+
+class ChatSQLite:
+    # Chat en SQLite con la interfaz de EspejoChat / ChatParticionado. La
+    # "fuente" es uno de esos dos: fija el formato de la réplica en Sheets y
+    # de ella se importa, una sola vez, cada conversación que aún no está en
+    # local (p. ej. con el disco vacío tras un redespliegue). A partir de ahí
+    # manda lo local: cada mensaje se guarda aquí y se encola hacia Sheets;
+    # los guardados sin conexión quedan con replicada = 0 y salen al volver.
+
+    INTERVALO_SYNC = 60  # segundos entre lecturas (de fondo) de los IDs en Sheets
+    REINTENTO_IMPORTAR = 30  # segundos tras un import fallido
+
+    def __init__(self, base):
+        self._base = base
+        self._fuente = None
+        self._fondo = RefrescoFondo(self.INTERVALO_SYNC, "sync-chat")
+        self._fallos_importar = {}  # id -> time.monotonic() del último fallo
+
+    def conectar(self, fuente, cola):
+        # Se llama en cada run; sin conexión (fuente None) se sigue con la última
+        if fuente is not None:
+            self._fuente = fuente
+        self._replicar_pendientes(cola)
+        return self
+
+    def sincronizar(self, hoja, forzar=False):
+        if self._fuente is None:
+            return
+        if forzar or not self.tiene_filas() or not self._fuente.sincronizado():
+            # Primer run del proceso: los IDs hacen falta ya para elegir
+            # conversación, y la fuente para saber qué hay que importar
+            self._refrescar(hoja, forzar)
+        else:
+            self._fondo.lanzar(self._refrescar, hoja, True)
+
+    def _refrescar(self, hoja, forzar):
+        # Conversaciones nuevas en Sheets (creadas en otro sitio): solo el ID;
+        # los mensajes se importan al abrirlas
+        self._fuente.sincronizar(hoja, forzar)
+        with self._base.transaccion() as con:
+            con.executemany("INSERT OR IGNORE INTO conversaciones (conv) VALUES (?)",
+                            [(i,) for i in self._fuente.ids()])
+
+    def ids(self):
+        filas = self._base.consulta("SELECT conv FROM conversaciones")
+        return sorted((c for c, in filas if c.strip().isdigit()), key=int)
+
+    def tiene_filas(self):
+        return bool(self._base.consulta("SELECT 1 FROM conversaciones LIMIT 1"))
+
+    def _importar(self, id_conv):
+        fila = self._base.consulta(
+            "SELECT importada FROM conversaciones WHERE conv = ?", (id_conv,))
+        if fila and fila[0][0]:
+            return
+        fallo = self._fallos_importar.get(id_conv)
+        if self._fuente is None or (
+                fallo is not None and time.monotonic() - fallo < self.REINTENTO_IMPORTAR):
+            return
+        if id_conv not in self._fuente.ids():
+            # Nueva, o la fuente aún no la conoce: sin marcarla, para que la
+            # próxima apertura la importe si ya está en Sheets
+            return
+        try:
+            historial = self._fuente.historial(id_conv)
+        except Exception:
+            self._fallos_importar[id_conv] = time.monotonic()
+            return
+        with self._base.transaccion() as con:
+            # Lo que ya esté en local (escrito sin conexión y replicado
+            # después) no se duplica
+            existentes = Counter(con.execute(
+                "SELECT fecha, rol, texto FROM mensajes WHERE conv = ?", (id_conv,)))
+            nuevas = []
+            for f in historial:
+                f = tuple(str(c) for c in f)
+                if existentes[f]:
+                    existentes[f] -= 1
+                else:
+                    nuevas.append((id_conv,) + f)
+            con.executemany("INSERT INTO mensajes (conv, fecha, rol, texto, replicada) "
+                            "VALUES (?, ?, ?, ?, 1)", nuevas)
+            con.execute("INSERT OR REPLACE INTO conversaciones (conv, importada) VALUES (?, 1)",
+                        (id_conv,))
+
+    def pagina(self, id_conv, limite, cursor=None):
+        # Como EspejoChat.pagina; el cursor es [fecha, n] del mensaje más
+        # antiguo ya cargado (recorre el índice conv, fecha, n hacia atrás)
+        id_conv = str(id_conv)
+        self._importar(id_conv)
+        if cursor is None:
+            filas = self._base.consulta(
+                "SELECT fecha, n, rol, texto FROM mensajes WHERE conv = ? "
+                "ORDER BY fecha DESC, n DESC LIMIT ?", (id_conv, limite + 1))
+        else:
+            filas = self._base.consulta(
+                "SELECT fecha, n, rol, texto FROM mensajes WHERE conv = ? AND (fecha, n) < (?, ?) "
+                "ORDER BY fecha DESC, n DESC LIMIT ?", (id_conv, cursor[0], cursor[1], limite + 1))
+        hay_mas = len(filas) > limite
+        filas = filas[:limite]
+        siguiente = [filas[-1][0], filas[-1][1]] if hay_mas else None
+        return [(rol, texto) for _, _, rol, texto in reversed(filas)], siguiente
+
+    def avanzar_cursor(self, id_conv, cursor, n):
+        # El mensaje 'n' posiciones después del cursor pasa a ser el más antiguo
+        if cursor is None:
+            filas = self._base.consulta(
+                "SELECT fecha, n FROM mensajes WHERE conv = ? "
+                "ORDER BY fecha, n LIMIT 1 OFFSET ?", (str(id_conv), n))
+        else:
+            filas = self._base.consulta(
+                "SELECT fecha, n FROM mensajes WHERE conv = ? AND (fecha, n) >= (?, ?) "
+                "ORDER BY fecha, n LIMIT 1 OFFSET ?", (str(id_conv), cursor[0], cursor[1], n))
+        return [filas[0][0], filas[0][1]] if filas else cursor
+
+    def pendientes(self, cola, id_conv):
+        return []  # lo encolado ya está en la base local
+
+    def guardar(self, cola, id_conv, fecha, rol, mensaje):
+        id_conv = str(id_conv)
+        self._importar(id_conv)
+        with self._base.transaccion() as con:
+            con.execute("INSERT OR IGNORE INTO conversaciones (conv) VALUES (?)", (id_conv,))
+            con.execute("INSERT INTO mensajes (conv, fecha, rol, texto) VALUES (?, ?, ?, ?)",
+                        (id_conv, fecha, rol, mensaje))
+        self._replicar_pendientes(cola)
+
+    def _replicar_pendientes(self, cola):
+        # Encola hacia Sheets, en orden, lo que aún no salió de aquí
+        if self._fuente is None or cola is None:
+            return
+        with self._base.lock:
+            filas = self._base.consulta(
+                "SELECT n, conv, fecha, rol, texto FROM mensajes WHERE replicada = 0 ORDER BY n")
+            for _, conv, fecha, rol, texto in filas:
+                self._fuente.guardar(cola, conv, fecha, rol, texto)
+            if filas:
+                with self._base.transaccion() as con:
+                    con.executemany("UPDATE mensajes SET replicada = 1 WHERE n = ?",
+                                    [(f[0],) for f in filas])
+
+
+class PerfilSQLite:
+    # Datos del perfil en SQLite: el índice BM25 se carga de aquí, sin red.
+    # La hoja Perfil se relee en segundo plano cada vez que el índice toca
+    # recarga (IndicePerfil.RECARGA), por si alguien la editó a mano.
+
+    def __init__(self, base):
+        self._base = base
+        self._fondo = RefrescoFondo(0, "sync-perfil")
+
+    def vacio(self):
+        return not self._base.consulta("SELECT 1 FROM perfil LIMIT 1")
+
+    def textos(self):
+        return [f"{fecha} {dato}".strip() for fecha, dato in
+                self._base.consulta("SELECT fecha, dato FROM perfil ORDER BY n")]
+
+    def agregar(self, fecha, dato):
+        with self._base.transaccion() as con:
+            con.execute("INSERT INTO perfil (fecha, dato) VALUES (?, ?)", (fecha, dato))
+
+    def refrescar(self, registro, hoja, cola, indice):
+        # La hoja (más lo que aún espera en la cola) reemplaza la copia local
+        valores = list(registro.leer(hoja))
+        if cola:
+            valores += cola.pendientes(DESTINO_PERFIL)
+        filas = [(str(f[0]), " ".join(str(c) for c in f[1:]).strip())
+                 for f in valores if any(str(c).strip() for c in f)]
+        with self._base.transaccion() as con:
+            con.execute("DELETE FROM perfil")
+            con.executemany("INSERT INTO perfil (fecha, dato) VALUES (?, ?)", filas)
+        indice.cargar(self.textos())
+
+    def cargar_indice(self, registro, hoja, cola, indice):
+        # Disco vacío: se importa la hoja ya. Si no, el índice sale de la
+        # base y la hoja se relee en segundo plano.
+        if self.vacio():
+            if hoja:
+                self.refrescar(registro, hoja, cola, indice)
+            return
+        indice.cargar(self.textos())
+        if hoja:
+            self._fondo.lanzar(self.refrescar, registro, hoja, cola, indice)
+
+
+class TareasSQLite:
+    # Copia persistente de la hoja Tareas (fila -> celdas) y de su revisión:
+    # ModeloTareas arranca de aquí sin bajar la hoja y sigue funcionando sin
+    # conexión.
+
+    def __init__(self, base):
+        self._base = base
+
+    def cargar(self):
+        # (revisión, filas desde la fila 2) o None si nunca se guardó
+        revision = self._base.consulta("SELECT valor FROM meta WHERE clave = 'revision_tareas'")
+        if not revision:
+            return None
+        filas = [json.loads(v) for v, in
+                 self._base.consulta("SELECT valores FROM tareas ORDER BY fila")]
+        return revision[0][0], filas
+
+    def reemplazar(self, revision, filas):
+        with self._base.transaccion() as con:
+            con.execute("DELETE FROM tareas")
+            con.executemany("INSERT INTO tareas (fila, valores) VALUES (?, ?)",
+                            [(n, json.dumps(f, ensure_ascii=False))
+                             for n, f in enumerate(filas, start=2)])
+            con.execute("INSERT OR REPLACE INTO meta (clave, valor) VALUES ('revision_tareas', ?)",
+                        (revision,))
+
+    def guardar(self, n_fila, valores):
+        with self._base.transaccion() as con:
+            con.execute("INSERT OR REPLACE INTO tareas (fila, valores) VALUES (?, ?)",
+                        (n_fila, json.dumps(valores, ensure_ascii=False)))
+
+    def fijar_revision(self, revision):
+        with self._base.transaccion() as con:
+            con.execute("INSERT OR REPLACE INTO meta (clave, valor) VALUES ('revision_tareas', ?)",
+                        (revision,))
+
+
+@st.cache_resource
+def obtener_almacen_local():
+    if ALMACEN != "sqlite":
+        return None
+    os.makedirs(DIR_DATOS, exist_ok=True)
+    return AlmacenLocal(os.path.join(DIR_DATOS, "asistente.db"))
+
+
+def _cuerpo_evento(resumen, inicio_iso, fin_iso, nota_alerta="", recurrence=None):
+    reminders = {'useDefault': False, 'overrides': [
+        {'method': 'popup', 'minutes': 10}]}
+
+    description = f"Agendado por Asistente.\n{nota_alerta}"
+    evento = {
+        'summary': resumen,
+        'description': description,
+        'start': {'dateTime': inicio_iso, 'timeZone': 'America/Lima'},
+        'end': {'dateTime': fin_iso, 'timeZone': 'America/Lima'},
+        'reminders': reminders
+    }
+
+    # Si hay regla de repetición, la agregamos
+    if recurrence:
+        evento['recurrence'] = [recurrence]
+    return evento
+
+
+def crear_evento_calendario(registro, resumen, inicio_iso, fin_iso, nota_alerta="", recurrence=None):
+    try:
+        evento = _cuerpo_evento(resumen, inicio_iso, fin_iso, nota_alerta, recurrence)
+        def insertar(r):
+            r.metricas.contar_api("calendar")
+            return r.calendario().events().insert(
+                calendarId=TU_EMAIL_GMAIL, body=evento).execute()
+
+        creado = registro.con_reconexion(insertar)
         return True, creado.get('htmlLink')
     except Exception as e:
         return False, str(e)
 
 
-def enviar_correo_gmail(destinatario, asunto, cuerpo):
+MAX_LOTE_CALENDARIO = 50  # límite de peticiones por batch de la API de Calendar
+ESTADOS_REINTENTO_CALENDARIO = ("429", "500", "502", "503")
+# Un 403 solo es temporal si es de cuota; el resto (sin permiso, calendario
+# ajeno...) no se arregla reintentando
+MOTIVOS_CUOTA_CALENDARIO = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+def _estado_error_google(error):
+    return str(getattr(getattr(error, "resp", None), "status", None))
+
+
+def _motivo_error_google(error):
+    # HttpError trae el JSON de la API: {"error": {"errors": [{"reason": ...}]}}
     try:
-        remitente = st.secrets["GMAIL_USER"]
-        password = st.secrets["GMAIL_PASSWORD"]
+        return json.loads(error.content)["error"]["errors"][0]["reason"]
+    except Exception:
+        return None
+
+
+def _reintentable_calendario(error):
+    estado = _estado_error_google(error)
+    if estado == "403":
+        return _motivo_error_google(error) in MOTIVOS_CUOTA_CALENDARIO
+    return estado in ESTADOS_REINTENTO_CALENDARIO
+
+
+def crear_eventos_calendario(registro, eventos, reintentos=2):
+    # Inserta varios eventos con BatchHttpRequest (un viaje HTTP por cada
+    # MAX_LOTE_CALENDARIO eventos). eventos: lista de tuplas con los mismos
+    # argumentos que crear_evento_calendario. Devuelve [(ok, link o error)]
+    # en el mismo orden. Los eventos que fallan por cuota o error temporal
+    # se reenvían en otro lote, con espera creciente.
+    # Cada evento lleva un id propio: si una respuesta se pierde y el evento
+    # se reenvía, la API contesta 409 en vez de crearlo dos veces.
+    cuerpos = [dict(_cuerpo_evento(*ev), id=uuid.uuid4().hex) for ev in eventos]
+    resultados = [(False, "no enviado")] * len(cuerpos)
+    pendientes = list(range(len(cuerpos)))
+
+    def enviar(r, indices, al_terminar):
+        servicio = r.calendario()
+        lote = servicio.new_batch_http_request(callback=al_terminar)
+        for i in indices:
+            lote.add(servicio.events().insert(calendarId=TU_EMAIL_GMAIL, body=cuerpos[i]),
+                     request_id=str(i))
+        r.metricas.contar_api("calendar")
+        lote.execute()
+
+    def link_existente(r, i):
+        r.metricas.contar_api("calendar")
+        return r.calendario().events().get(
+            calendarId=TU_EMAIL_GMAIL, eventId=cuerpos[i]['id']).execute().get('htmlLink')
+
+    for intento in range(reintentos + 1):
+        if intento:
+            time.sleep(random.uniform(0, 2 ** intento))
+        respuestas = {}
+
+        def al_terminar(request_id, respuesta, error):
+            respuestas[int(request_id)] = (respuesta, error)
+
+        # Un lote cada vez: si hay que reconectar, con_reconexion reenvía
+        # solo lo que aún no tuvo respuesta, no los lotes ya hechos
+        error_lote = None
+        try:
+            for inicio in range(0, len(pendientes), MAX_LOTE_CALENDARIO):
+                lote = pendientes[inicio:inicio + MAX_LOTE_CALENDARIO]
+                registro.con_reconexion(lambda r: enviar(
+                    r, [i for i in lote if i not in respuestas], al_terminar))
+        except Exception as e:
+            error_lote = e
+
+        reintentar = []
+        for i in pendientes:
+            respuesta, error = respuestas.get(i, (None, error_lote or "sin respuesta"))
+            if error is None:
+                resultados[i] = (True, respuesta.get('htmlLink'))
+            elif _estado_error_google(error) == "409":
+                # Ya lo creamos en un envío cuya respuesta se perdió
+                try:
+                    resultados[i] = (True, registro.con_reconexion(lambda r: link_existente(r, i)))
+                except Exception:
+                    resultados[i] = (True, "(sin enlace)")
+            else:
+                resultados[i] = (False, str(error))
+                if _reintentable_calendario(error) or \
+                        (i not in respuestas and _es_handle_obsoleto(error)):
+                    reintentar.append(i)
+        pendientes = reintentar
+        if not pendientes:
+            break
+    return resultados
+
+
+class BuzonSalida:
+    # Bandeja de salida: los correos se encolan y un hilo los envía por una
+    # conexión SMTP autenticada que se reutiliza. Si la conexión lleva más de
+    # IDLE_MAX segundos parada se comprueba con NOOP (y se reconecta si el
+    # servidor la cerró). Los fallos temporales (conexión cortada, 4xx) se
+    # reintentan con backoff; un 5xx es definitivo.
+
+    MAX_INTENTOS = 4
+    IDLE_MAX = 30
+    BACKOFF_BASE = 1.0
+    CIERRE_INACTIVO = 300  # cerramos nosotros tras 5 min sin correos
+    PERMANENTES = (smtplib.SMTPAuthenticationError, smtplib.SMTPRecipientsRefused,
+                   smtplib.SMTPSenderRefused)
+
+    def __init__(self, host, port, usuario, password, starttls=True, timeout=20,
+                 metricas=None):
+        self.host = host
+        self._metricas = metricas or Metricas()
+        self.port = port
+        self.usuario = usuario
+        self._password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self._cola = queue.Queue()
+        self._smtp = None
+        self._ultimo_uso = 0.0
+        self._lock = threading.Lock()
+        self._sig_id = 1
+        self._en_cola = 0
+        self._resultados = deque(maxlen=20)  # (id, destinatarios, ok, detalle)
+        threading.Thread(target=self._bucle, name="buzon-salida", daemon=True).start()
+
+    def encolar(self, destinatarios, asunto, cuerpo):
+        with self._lock:
+            id_msg = self._sig_id
+            self._sig_id += 1
+            self._en_cola += 1
+        self._cola.put((id_msg, list(destinatarios), asunto, cuerpo))
+        return id_msg
+
+    def _conectar(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            smtp.starttls()
+        if self._password:
+            smtp.login(self.usuario, self._password)
+        return smtp
+
+    def _cerrar(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
 
+    def _conexion(self):
+        if self._smtp is not None and time.monotonic() - self._ultimo_uso > self.IDLE_MAX:
+            try:
+                if self._smtp.noop()[0] != 250:
+                    self._cerrar()
+            except Exception:
+                self._smtp = None
+        if self._smtp is None:
+            self._smtp = self._conectar()
+        return self._smtp
+
+    def _enviar(self, destinatarios, asunto, cuerpo):
         msg = MIMEText(cuerpo)
         msg['Subject'] = asunto
-        msg['From'] = remitente
-        msg['To'] = destinatario
-
-        # Conexión con Gmail
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(remitente, password)
-        server.sendmail(remitente, destinatario, msg.as_string())
-        server.quit()
-        return True, "Correo enviado"
+        msg['From'] = self.usuario
+        msg['To'] = ", ".join(destinatarios)
+        for intento in range(self.MAX_INTENTOS):
+            try:
+                self._metricas.contar_api("smtp")
+                rechazados = self._conexion().sendmail(self.usuario, destinatarios, msg.as_string())
+                self._ultimo_uso = time.monotonic()
+                if rechazados:
+                    # Llegó a los demás: no se reintenta (se duplicaría)
+                    return True, f"Correo enviado; rechazado para {', '.join(sorted(rechazados))}"
+                return True, "Correo enviado"
+            except self.PERMANENTES as e:
+                return False, str(e)
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code >= 500:
+                    return False, str(e)
+                error = e  # 4xx: temporal
+            except Exception as e:
+                error = e
+            self._cerrar()  # conexión rota o respuesta 4xx: reconectar
+            if intento == self.MAX_INTENTOS - 1:
+                return False, str(error)
+            time.sleep(random.uniform(0, self.BACKOFF_BASE * 2 ** intento))
+
+    def _bucle(self):
+        while True:
+            try:
+                id_msg, destinatarios, asunto, cuerpo = self._cola.get(timeout=self.CIERRE_INACTIVO)
+            except queue.Empty:
+                self._cerrar()
+                continue
+            ok, detalle = self._enviar(destinatarios, asunto, cuerpo)
+            with self._lock:
+                self._en_cola -= 1
+                self._resultados.append((id_msg, destinatarios, ok, detalle))
+
+    def estado(self):
+        with self._lock:
+            return {"en_cola": self._en_cola, "resultados": list(self._resultados)}
+
+
+@st.cache_resource
+def obtener_buzon():
+    try:
+        return BuzonSalida(
+            st.secrets.get("SMTP_HOST", "smtp.gmail.com"),
+            int(st.secrets.get("SMTP_PORT", 587)),
+            st.secrets["GMAIL_USER"],
+            st.secrets.get("GMAIL_PASSWORD", ""),
+            starttls=secreto_si_no("SMTP_STARTTLS", True),
+            metricas=obtener_metricas())
+    except:
+        return None
+
+
+def separar_destinatarios(texto):
+    return [d.strip() for d in re.split(r"[,;\s]+", texto) if "@" in d]
+
+
+def enviar_correo_gmail(destinatario, asunto, cuerpo, buzon=None):
+    # Encola el correo (uno o varios destinatarios separados por comas) y
+    # vuelve al momento: el envío ocurre en segundo plano
+    try:
+        buzon = buzon or obtener_buzon()
+        if buzon is None:
+            return False, "Correo no configurado (faltan GMAIL_USER / GMAIL_PASSWORD)"
+        destinatarios = separar_destinatarios(destinatario)
+        if not destinatarios:
+            return False, f"Destinatario no válido: {destinatario}"
+        buzon.encolar(destinatarios, asunto, cuerpo)
+        return True, f"en cola para {', '.join(destinatarios)}"
     except Exception as e:
         return False, str(e)
 
 # --- FUNCIONES DE GESTIÓN DE TAREAS (TABLA CORREGIDA + CÁLCULO) ---
 
-def gestionar_tareas(modo, datos=None):
-    try:
-        import json
-        import gspread
-        from oauth2client.service_account import ServiceAccountCredentials
-        import streamlit as st
-
-        scope = ['https://www.googleapis.com/auth/spreadsheets',
-                 'https://www.googleapis.com/auth/drive']
-        creds_dict = json.loads(st.secrets["GOOGLE_CREDENTIALS"], strict=False)
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(
-            creds_dict, scope)
-        client = gspread.authorize(creds)
-        sheet = client.open_by_key(
-            st.secrets["SPREADSHEET_ID"]).worksheet("Tareas")
-
-        if modo == "LISTAR":
-            registros = sheet.get_all_records()
-            if not registros:
+# Columnas de la hoja Tareas: 1 = Tarea, 2..16 = Subtarea 1..15,
+# 17 = (libre), 18 = Estado ("Pendiente"), 19 = Fecha
+N_SUBTAREAS = 15
+COL_ESTADO = 18
+COL_FECHA = 19
+
+
+@dataclass
+class Tarea:
+    fila: int
+    titulo: str
+    activas: int = 0  # bit n-1 encendido = la Subtarea n existe
+    hechas: int = 0  # bit n-1 encendido = la Subtarea n está marcada
+    estado: str = ""
+    fecha: str = ""
+
+    @property
+    def total(self):
+        return self.activas.bit_count()
+
+    @property
+    def completadas(self):
+        return (self.hechas & self.activas).bit_count()
+
+
+def _tarea_desde_fila(n_fila, fila):
+    fila = list(fila) + [""] * (COL_FECHA - len(fila))
+    tarea = Tarea(n_fila, fila[0], estado=fila[COL_ESTADO - 1], fecha=fila[COL_FECHA - 1])
+    for n in range(1, N_SUBTAREAS + 1):
+        # Solo contamos si la celda NO está vacía
+        valor = str(fila[n]).strip().upper()
+        if valor in ("TRUE", "FALSE"):
+            tarea.activas |= 1 << (n - 1)
+            if valor == "TRUE":
+                tarea.hechas |= 1 << (n - 1)
+    return tarea
+
+
+class ModeloTareas:
+    # Copia en memoria de la hoja Tareas (una máscara de bits por fila). Se
+    # descarga una vez; AGREGAR / CHECK / EXTENDER la actualizan en el sitio.
+    # Para detectar ediciones hechas a mano se compara, como mucho cada
+    # REVISION_CADA segundos, la fecha de modificación del libro (metadato de
+    # Drive, mucho más barato que bajar la hoja). Con almacén local
+    # (TareasSQLite) arranca de la copia guardada y, si Sheets no responde,
+    # sigue trabajando con ella.
+
+    REVISION_CADA = 30
+    RECARGA_TOTAL = 600
+
+    def __init__(self, almacen=None):
+        self._lock = threading.RLock()
+        self._almacen = almacen
+        self._tareas = {}  # fila -> Tarea
+        self._valores = {}  # fila -> celdas (las mutaciones se resuelven con ellas)
+        self._ultima_fila = 1
+        self._revision = None
+        self._revisado_en = 0.0
+        self._cargado_en = None
+        self._adoptar_revision = False
+        self._tabla = None  # markdown ya armado (se invalida con cada cambio)
+        self.version = 0  # sube con cada recarga o cambio (ver clave_respuesta)
+
+    @staticmethod
+    def _revision_de(hoja):
+        libro = hoja.spreadsheet
+        if hasattr(libro, "get_lastUpdateTime"):
+            return libro.get_lastUpdateTime()
+        return libro.lastUpdateTime
+
+    @property
+    def local(self):
+        return self._almacen is not None
+
+    def _poblar(self, filas):
+        self.version += 1
+        self._tareas = {}
+        self._valores = {}
+        self._ultima_fila = 1
+        for fila in filas:
+            self._agregar(fila)
+
+    def _cargar(self, hoja, pendientes, celdas):
+        valores = hoja.get_all_values()
+        self._revision = self._revision_de(hoja)
+        self._poblar(valores[1:] + list(pendientes))
+        # Cambios de celdas que aún esperan en la cola, encima de lo leído
+        for celda in celdas:
+            n_fila, col = _celda_a1(celda["range"])
+            if n_fila in self._valores:
+                valor = celda["values"][0][0]
+                self._valores[n_fila][col - 1] = str(valor).upper() if isinstance(valor, bool) else valor
+                self._tareas[n_fila] = _tarea_desde_fila(n_fila, self._valores[n_fila])
+        if self._almacen:
+            self._almacen.reemplazar(self._revision, [self._valores[n] for n in sorted(self._valores)])
+        self._cargado_en = self._revisado_en = time.time()
+        self._adoptar_revision = False
+
+    def asegurar(self, hoja, pendientes=(), celdas=()):
+        # pendientes / celdas: filas de AGREGAR y cambios de celdas que siguen
+        # en la cola de escritura. hoja None = sin conexión con Sheets.
+        with self._lock:
+            ahora = time.time()
+            if self._cargado_en is None and self._almacen:
+                guardado = self._almacen.cargar()
+                if guardado:
+                    # Arranque desde la copia local; la revisión se compara ya
+                    self._revision, filas = guardado
+                    self._poblar(filas)
+                    self._cargado_en, self._revisado_en = ahora, 0.0
+            try:
+                self._revisar(hoja, pendientes, celdas, ahora)
+            except Exception:
+                if not self.local or self._cargado_en is None:
+                    raise
+                self._revisado_en = ahora  # seguimos con la copia local
+
+    def _revisar(self, hoja, pendientes, celdas, ahora):
+        if hoja is None:
+            raise ConnectionError("Sin conexión con la hoja Tareas.")
+        if self._cargado_en is None or ahora - self._cargado_en > self.RECARGA_TOTAL:
+            self._cargar(hoja, pendientes, celdas)
+            return
+        if ahora - self._revisado_en < self.REVISION_CADA:
+            return
+        revision = self._revision_de(hoja)
+        self._revisado_en = ahora
+        if revision == self._revision:
+            return
+        if self._adoptar_revision:
+            # El cambio de revisión es nuestra propia escritura
+            self._revision = revision
+            self._adoptar_revision = False
+            if self._almacen:
+                self._almacen.fijar_revision(revision)
+        else:
+            self._cargar(hoja, pendientes, celdas)
+
+    def _agregar(self, fila):
+        self._ultima_fila += 1
+        fila = [str(c) for c in fila] + [""] * (COL_FECHA - len(fila))
+        self._valores[self._ultima_fila] = fila
+        self._tareas[self._ultima_fila] = _tarea_desde_fila(self._ultima_fila, fila)
+        self._tabla = None
+        return self._ultima_fila
+
+    def _cambio_propio(self):
+        self.version += 1
+        self._tabla = None
+        self._adoptar_revision = True
+
+    def agregar(self, fila):
+        with self._lock:
+            self._cambio_propio()
+            n_fila = self._agregar(fila)
+            if self._almacen:
+                self._almacen.guardar(n_fila, self._valores[n_fila])
+            return n_fila
+
+    def valores(self, n_fila):
+        # Celdas de la fila (Tarea .. Fecha); todas vacías si no existe
+        with self._lock:
+            return list(self._valores.get(n_fila, [""] * COL_FECHA))
+
+    def reemplazar(self, n_fila, fila):
+        with self._lock:
+            if n_fila in self._tareas:
+                self._valores[n_fila] = list(fila)
+                self._tareas[n_fila] = _tarea_desde_fila(n_fila, fila)
+                if self._almacen:
+                    self._almacen.guardar(n_fila, self._valores[n_fila])
+            self._cambio_propio()
+
+    def tabla_markdown(self):
+        with self._lock:
+            if not self._tareas:
                 return "No hay tareas registradas."
+            if self._tabla is None:
+                lineas = ["\n| ID | Tarea | Subtareas | Avance |\n| :---: | :--- | :--- | :---: |\n"]
+                for t in self._tareas.values():
+                    iconos = "".join(
+                        ("✅ " if t.hechas & (1 << n) else "⬜ ")
+                        for n in range(N_SUBTAREAS) if t.activas & (1 << n))
+                    total = t.total
+                    porcentaje = f"{int((t.completadas / total) * 100)}%" if total else "0%"
+                    lineas.append(
+                        f"| **{t.fila}** | {t.titulo} | {iconos or '—'} | **{porcentaje}** |\n")
+                self._tabla = "".join(lineas)
+            return self._tabla
+
+
+@st.cache_resource
+def obtener_modelo_tareas():
+    almacen = obtener_almacen_local()
+    return ModeloTareas(almacen.tareas if almacen else None)
+
+
+@dataclass
+class MutacionTarea:
+    tipo: str  # "CHECK" | "EXTENDER" | "ESTADO"
+    fila: int
+    sub: int = None  # CHECK: número de subtarea
+    valor: str = None  # ESTADO: nuevo estado
+
+
+def _col_letra(n):
+    letras = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        letras = chr(65 + r) + letras
+    return letras
+
+
+def _celda_a1(ref):
+    # "B5" -> (5, 2)
+    m = re.match(r"([A-Z]+)(\d+)", ref)
+    col = 0
+    for letra in m.group(1):
+        col = col * 26 + ord(letra) - 64
+    return int(m.group(2)), col
+
+
+def _aplicar_mutaciones(sheet, mutaciones, modelo, cola=None, destino=None):
+    # Aplica muchas mutaciones con 1 lectura (batch_get de las filas
+    # afectadas, para comprobar conflictos contra los valores actuales) y
+    # 1 escritura (batch_update de las celdas que cambian). sheet None = sin
+    # Sheets: se comprueban contra la copia local. Con almacén local la
+    # escritura va a la cola. Devuelve una línea de resultado por mutación.
+    filas = sorted({m.fila for m in mutaciones})
+    local = modelo.local and cola is not None
+    if sheet is None:
+        actuales = {f: modelo.valores(f) for f in filas}
+    else:
+        ultima_col = _col_letra(COL_FECHA)
+        leidas = sheet.batch_get([f"A{f}:{ultima_col}{f}" for f in filas])
+        actuales = {}
+        for f, valores in zip(filas, leidas):
+            fila = list(valores[0]) if valores else []
+            actuales[f] = fila + [""] * (COL_FECHA - len(fila))
+
+    cambios = {}  # (fila, col) -> valor
+    lineas = []
+
+    def celda(f, col):
+        return cambios.get((f, col), actuales[f][col - 1])
+
+    def es_sub(valor, buscado=None):
+        v = str(valor).strip().upper()
+        return v in ("TRUE", "FALSE") if buscado is None else v == buscado
+
+    for m in mutaciones:
+        if not any(str(v).strip() for v in actuales[m.fila]):
+            lineas.append(f"⚠️ Fila {m.fila}: no existe esa tarea.")
+            continue
+        if m.tipo == "CHECK":
+            col = 1 + m.sub
+            if not es_sub(celda(m.fila, col)):
+                lineas.append(f"⚠️ Fila {m.fila}: la subtarea {m.sub} no existe.")
+            elif es_sub(celda(m.fila, col), "TRUE"):
+                lineas.append(f"Fila {m.fila}: la subtarea {m.sub} ya estaba marcada.")
+            else:
+                cambios[(m.fila, col)] = True
+                lineas.append(f"Fila {m.fila}: subtarea {m.sub} marcada.")
+        elif m.tipo == "EXTENDER":
+            libre = next((n for n in range(1, N_SUBTAREAS + 1)
+                          if not str(celda(m.fila, 1 + n)).strip()), None)
+            if libre is None:
+                lineas.append(f"⚠️ Fila {m.fila}: máximo de 15 subtareas alcanzado.")
+            else:
+                cambios[(m.fila, 1 + libre)] = False
+                lineas.append(f"Fila {m.fila}: subtarea {libre} agregada.")
+        elif m.tipo == "ESTADO":
+            cambios[(m.fila, COL_ESTADO)] = m.valor
+            lineas.append(f"Fila {m.fila}: estado '{m.valor}'.")
+
+    if cambios:
+        celdas = [{"range": f"{_col_letra(col)}{f}", "values": [[valor]]}
+                  for (f, col), valor in sorted(cambios.items())]
+        if local:
+            cola.encolar_celdas(destino, celdas)
+        else:
+            sheet.batch_update(celdas)
+        for f in filas:
+            nueva = [celda(f, c) for c in range(1, COL_FECHA + 1)]
+            modelo.reemplazar(f, [str(v).upper() if isinstance(v, bool) else v for v in nueva])
+    return lineas
 
-            texto = "\n| ID | Tarea | Subtareas | Avance |\n| :---: | :--- | :--- | :---: |\n"
 
-            for i, r in enumerate(registros, start=2):
-                hechas = 0
-                total = 0
-                iconos = ""
+def gestionar_tareas(modo, datos=None, registro=None, cola=None, modelo=None):
+    # registro/cola/modelo se pueden pasar ya resueltos (desde hilos del pool)
+    try:
+        registro = registro or obtener_registro_google()
+        if registro is None:
+            return "Error: credenciales de Google no configuradas."
+        destino = destino_tareas()
+        cola = cola or obtener_cola_escritura()
+        modelo = modelo or obtener_modelo_tareas()
+        if modelo.local:
+            # La copia local manda: sin conexión se sigue trabajando con ella
+            try:
+                sheet = registro.con_reconexion(lambda r: r.hoja(**destino))
+            except Exception:
+                sheet = None
+            return _operar_tareas(sheet, modo, datos, cola, destino, modelo)
+        return registro.con_reconexion(lambda r: _operar_tareas(
+            r.hoja(**destino), modo, datos, cola, destino, modelo))
+    except Exception as e:
+        return f"Error: {str(e)}"
 
-                # Recorremos de la Subtarea 1 a la 15
-                for n in range(1, 16):
-                    clave = f"Subtarea {n}"
-                    valor = str(r.get(clave, "")).strip().upper()
 
-                    # Solo contamos si la celda NO está vacía
-                    if valor in ["TRUE", "FALSE"]:
-                        total += 1
-                        if valor == "TRUE":
-                            hechas += 1
-                            iconos += "✅ "
-                        else:
-                            iconos += "⬜ "
+def _hoja_para_mutar(sheet, cola, modelo):
+    # Las mutaciones se comprueban contra la hoja, así que antes se vacía la
+    # cola (la fila podría ser un AGREGAR aún sin escribir). Si no se puede,
+    # con almacén local se sigue contra la copia local, avisando; sin él es
+    # un error. Devuelve (hoja o None, líneas de aviso).
+    if sheet is not None and (cola is None or cola.vaciar()):
+        return sheet, []
+    if sheet is None:
+        motivo = "Sheets sin conexión"
+    else:
+        motivo = f"no se pudo guardar lo pendiente ({cola.estado()['ultimo_error'] or 'tiempo agotado'})"
+    if not modelo.local:
+        raise RuntimeError(motivo)
+    return None, [f"⚠️ {motivo}: comprobado contra la copia local."]
+
+
+def _operar_tareas(sheet, modo, datos, cola, destino, modelo):
+    modelo.asegurar(sheet, cola.pendientes(destino) if cola else (),
+                    cola.pendientes_celdas(destino) if cola else ())
+
+    if modo == "LISTAR":
+        return modelo.tabla_markdown()
+
+    elif modo == "AGREGAR":
+        # datos: [Tarea, (n subtareas...), Fecha]
+        # Creamos fila con 15 espacios para subtareas
+        tarea = datos[0]
+        fecha = datos[-1]
+        cantidad_subs = len(datos) - 2 # Restamos Tarea y Fecha
+
+        fila_subs = []
+        for k in range(N_SUBTAREAS):
+            if k < cantidad_subs:
+                fila_subs.append("FALSE") # Activa para contar
+            else:
+                fila_subs.append("") # Vacía para ignorar
 
-                # Evitar división por cero si no hay subtareas
-                porcentaje = "0%"
-                if total > 0:
-                    porcentaje = f"{int((hechas/total)*100)}%"
+        # Armamos la fila completa: Tarea + 15 Subs + Extras
+        fila = [tarea] + fila_subs + ["", "Pendiente", fecha]
+        if cola:
+            cola.encolar(destino, fila)
+        else:
+            sheet.append_row(fila)
+        modelo.agregar(fila)
+        return f"Tarea agregada con {cantidad_subs} subtareas."
+
+    elif modo == "CHECK":
+        # datos[0] = Fila, datos[1] = Número de subtarea visual (1, 2, 3...)
+        hoja, avisos = _hoja_para_mutar(sheet, cola, modelo)
+        lineas = _aplicar_mutaciones(
+            hoja, [MutacionTarea("CHECK", int(datos[0]), int(datos[1]))], modelo, cola, destino)
+        return "Avance actualizado. " + " ".join(lineas + avisos)
+
+    elif modo == "ADD_SUB":
+        # Agrega una subtarea extra (la primera vacía) a una fila existente
+        hoja, avisos = _hoja_para_mutar(sheet, cola, modelo)
+        lineas = _aplicar_mutaciones(
+            hoja, [MutacionTarea("EXTENDER", int(datos[0]))], modelo, cola, destino)
+        return " ".join(lineas + avisos)
+
+    elif modo == "LOTE":
+        # datos: lista de MutacionTarea, aplicadas en un solo batch_update
+        hoja, avisos = _hoja_para_mutar(sheet, cola, modelo)
+        return "Avance actualizado:\n" + "\n".join(
+            f"- {l}" for l in _aplicar_mutaciones(hoja, datos, modelo, cola, destino) + avisos)
+
+
+# --- COMANDOS TÉCNICOS: PARSER DE UNA PASADA Y DESPACHO ---
+
+@dataclass
+class CmdCalendario:
+    resumen: str
+    inicio: str
+    fin: str
+    nota: str = ""
+    rrule: str = None
+
+
+@dataclass
+class CmdMemoria:
+    dato: str
+
+
+@dataclass
+class CmdEmail:
+    destinatario: str
+    asunto: str
+    cuerpo: str
+
+
+@dataclass
+class CmdTarea:
+    accion: str
+    args: list
+
+
+PATRON_CMD = re.compile(r"(CALENDAR_CMD|MEMORIA_CMD|EMAIL_CMD|TAREA_CMD):")
+
+
+def _fecha_iso(raw):
+    # "2025-12-07 10: 30" -> "2025-12-07T10:30:00"
+    iso = re.sub(r"\s*:\s*", ":", raw.strip())
+    iso = re.sub(r"\s+", "T", iso)
+    if len(iso) == 16:
+        iso += ":00"
+    datetime.datetime.fromisoformat(iso)  # ValueError si no es una fecha
+    return iso
+
+
+def _validar_calendario(campos):
+    if len(campos) < 3:
+        raise ValueError("faltan Título | Inicio | Fin")
+    rule = None
+    if len(campos) > 4:
+        rule_raw = campos[4].replace(" ", "")
+        if "FREQ=" in rule_raw:  # Solo si parece una regla válida
+            rule = rule_raw if rule_raw.startswith("RRULE:") else "RRULE:" + rule_raw
+    return CmdCalendario(campos[0], _fecha_iso(campos[1]), _fecha_iso(campos[2]),
+                         campos[3] if len(campos) > 3 else "", rule)
+
+
+def _validar_memoria(campos):
+    dato = " | ".join(campos).strip()
+    if not dato:
+        raise ValueError("dato vacío")
+    return CmdMemoria(dato)
+
+
+def _validar_email(campos):
+    if len(campos) < 3:
+        raise ValueError("faltan Destinatario | Asunto | Cuerpo")
+    if "@" not in campos[0]:
+        raise ValueError(f"destinatario no válido: {campos[0]}")
+    # El cuerpo puede contener '|': lo recomponemos
+    return CmdEmail(campos[0], campos[1], " | ".join(campos[2:]))
+
+
+def _validar_tarea(campos):
+    accion = campos[0].upper()
+    args = campos[1:]
+    if accion == "LISTAR":
+        return CmdTarea(accion, [])
+    if accion == "AGREGAR":
+        if len(args) < 2:
+            raise ValueError("faltan Título | ... | Fecha")
+        return CmdTarea(accion, args)
+    if accion == "CHECK":
+        if len(args) < 2:
+            raise ValueError("faltan ID_Fila | N_Subtarea")
+        fila, sub = int(args[0]), int(args[1])
+        if fila < 2 or not 1 <= sub <= 15:
+            raise ValueError("fila o subtarea fuera de rango")
+        return CmdTarea(accion, [fila, sub])
+    if accion == "EXTENDER":
+        if not args:
+            raise ValueError("falta ID_Fila")
+        fila = int(args[0])
+        if fila < 2:
+            raise ValueError("fila fuera de rango")
+        return CmdTarea(accion, [fila])
+    if accion == "ESTADO":
+        if len(args) < 2 or not args[1]:
+            raise ValueError("faltan ID_Fila | Estado")
+        fila = int(args[0])
+        if fila < 2:
+            raise ValueError("fila fuera de rango")
+        return CmdTarea(accion, [fila, args[1]])
+    raise ValueError(f"acción desconocida: {accion}")
+
+
+VALIDADORES_CMD = {
+    "CALENDAR_CMD": _validar_calendario,
+    "MEMORIA_CMD": _validar_memoria,
+    "EMAIL_CMD": _validar_email,
+    "TAREA_CMD": _validar_tarea,
+}
+
+
+def extraer_comandos(texto):
+    # Una sola pasada sobre la respuesta: devuelve el texto visible, todos los
+    # comandos en orden (ya validados) y los que no se pudieron interpretar.
+    # Cada comando ocupa el resto de su línea; EMAIL_CMD llega hasta el
+    # siguiente comando porque el cuerpo puede tener varias líneas.
+    visible = []
+    comandos = []
+    invalidos = []
+    pos = 0
+    marcas = list(PATRON_CMD.finditer(texto))
+    for i, m in enumerate(marcas):
+        visible.append(texto[pos:m.start()])
+        fin_bloque = marcas[i + 1].start() if i + 1 < len(marcas) else len(texto)
+        tipo = m.group(1)
+        if tipo == "EMAIL_CMD":
+            fin = fin_bloque
+        else:
+            salto = texto.find("\n", m.end(), fin_bloque)
+            fin = salto if salto != -1 else fin_bloque
+        crudo = texto[m.end():fin].strip()
+        pos = fin
+        try:
+            campos = [c.strip() for c in crudo.split("|")]
+            comandos.append(VALIDADORES_CMD[tipo](campos))
+        except (ValueError, IndexError) as e:
+            invalidos.append((f"{tipo}: {crudo}", str(e)))
+    visible.append(texto[pos:])
+    return "".join(visible).strip(), comandos, invalidos
+
+
+def _texto_evento(cmd, ok, link):
+    tipo = "repetitivo" if cmd.rrule else "único"
+    return f"\n\n{'✅ Evento ' + tipo + ' creado' if ok else '❌ Error'}: {link}"
+
+
+def _ejecutar_calendario(cmd, ctx):
+    ok, link = crear_evento_calendario(
+        ctx["registro"], cmd.resumen, cmd.inicio, cmd.fin, cmd.nota, cmd.rrule)
+    return _texto_evento(cmd, ok, link)
+
+
+def _ejecutar_memoria(cmd, ctx):
+    perfil_local = ctx["perfil_local"]
+    if not (perfil_local or (ctx["perfil"] and ctx["cola"])):
+        return ""
+    timestamp = get_hora_peru().strftime("%Y-%m-%d %H:%M:%S")
+    if perfil_local:
+        perfil_local.agregar(timestamp, cmd.dato)
+    if ctx["cola"]:
+        ctx["cola"].encolar(DESTINO_PERFIL, [timestamp, cmd.dato])
+    ctx["indice_perfil"].agregar(f"{timestamp} {cmd.dato}")
+    return "\n(💾 Guardado en perfil)"
+
+
+def _ejecutar_email(cmd, ctx):
+    ok, msg = enviar_correo_gmail(cmd.destinatario, cmd.asunto, cmd.cuerpo, ctx["buzon"])
+    return f"\n\n{'📤 Correo' if ok else '❌ Error correo'}: {msg}"
+
+
+def _ejecutar_tarea(cmd, ctx):
+    deps = (ctx["registro"], ctx["cola"], ctx["modelo_tareas"])
+    if cmd.accion == "LISTAR":
+        return f"\n\n📋 {gestionar_tareas('LISTAR', None, *deps)}"
+    if cmd.accion == "AGREGAR":
+        return f"\n\n✅ {gestionar_tareas('AGREGAR', cmd.args, *deps)}"
+    if cmd.accion == "CHECK":
+        return f"\n\n📈 {gestionar_tareas('CHECK', cmd.args, *deps)}"
+    if cmd.accion == "EXTENDER":
+        # Agrega una casilla vacía extra al final
+        return f"\n\n➕ {gestionar_tareas('ADD_SUB', cmd.args, *deps)}"
+    if cmd.accion == "ESTADO":
+        mutacion = MutacionTarea("ESTADO", cmd.args[0], valor=cmd.args[1])
+        return f"\n\n📈 {gestionar_tareas('LOTE', [mutacion], *deps)}"
+    return ""
+
+
+MUTACIONES_TAREA = ("CHECK", "EXTENDER", "ESTADO")
+
+
+@dataclass
+class CmdLoteTareas:
+    # Varios CHECK / EXTENDER / ESTADO seguidos: un solo batch_update
+    comandos: list
+
+
+def _a_mutacion(cmd):
+    if cmd.accion == "CHECK":
+        return MutacionTarea("CHECK", cmd.args[0], cmd.args[1])
+    if cmd.accion == "EXTENDER":
+        return MutacionTarea("EXTENDER", cmd.args[0])
+    return MutacionTarea("ESTADO", cmd.args[0], valor=cmd.args[1])
+
+
+def _ejecutar_lote_tareas(lote, ctx):
+    deps = (ctx["registro"], ctx["cola"], ctx["modelo_tareas"])
+    mutaciones = [_a_mutacion(cmd) for cmd in lote.comandos]
+    return f"\n\n📈 {gestionar_tareas('LOTE', mutaciones, *deps)}"
+
+
+def agrupar_mutaciones(comandos):
+    # Junta las mutaciones de tareas consecutivas en un CmdLoteTareas
+    agrupados = []
+    for cmd in comandos:
+        es_mutacion = isinstance(cmd, CmdTarea) and cmd.accion in MUTACIONES_TAREA
+        if es_mutacion and agrupados and isinstance(agrupados[-1], CmdLoteTareas):
+            agrupados[-1].comandos.append(cmd)
+        elif es_mutacion and agrupados and isinstance(agrupados[-1], CmdTarea) \
+                and agrupados[-1].accion in MUTACIONES_TAREA:
+            agrupados[-1] = CmdLoteTareas([agrupados[-1], cmd])
+        else:
+            agrupados.append(cmd)
+    return agrupados
+
+
+@dataclass
+class CmdLoteCalendario:
+    # Todos los CALENDAR_CMD de una respuesta: un solo BatchHttpRequest
+    comandos: list
+
+
+def _ejecutar_lote_calendario(lote, ctx):
+    eventos = [(c.resumen, c.inicio, c.fin, c.nota, c.rrule) for c in lote.comandos]
+    resultados = crear_eventos_calendario(ctx["registro"], eventos)
+    return "".join(_texto_evento(cmd, ok, link)
+                   for cmd, (ok, link) in zip(lote.comandos, resultados))
+
+
+def agrupar_eventos(comandos):
+    # Junta todos los eventos en un CmdLoteCalendario, en la posición del
+    # primero (son independientes entre sí y del resto de comandos)
+    eventos = [cmd for cmd in comandos if isinstance(cmd, CmdCalendario)]
+    if len(eventos) < 2:
+        return comandos
+    agrupados = []
+    for cmd in comandos:
+        if cmd is eventos[0]:
+            agrupados.append(CmdLoteCalendario(eventos))
+        elif not isinstance(cmd, CmdCalendario):
+            agrupados.append(cmd)
+    return agrupados
+
+
+MANEJADORES_CMD = {
+    CmdCalendario: _ejecutar_calendario,
+    CmdMemoria: _ejecutar_memoria,
+    CmdEmail: _ejecutar_email,
+    CmdTarea: _ejecutar_tarea,
+    CmdLoteTareas: _ejecutar_lote_tareas,
+    CmdLoteCalendario: _ejecutar_lote_calendario,
+}
+
+
+def _carril(cmd):
+    # Los comandos de un mismo carril se ejecutan en orden (AGREGAR antes de
+    # LISTAR, CHECKs sobre la misma hoja...); carriles distintos, en paralelo.
+    # Cada correo (y el lote de eventos) es independiente: va en su propio carril.
+    if isinstance(cmd, (CmdTarea, CmdLoteTareas)):
+        return "tareas"
+    if isinstance(cmd, CmdMemoria):
+        return "perfil"
+    return id(cmd)
+
+
+def _ejecutar_uno(cmd, ctx):
+    try:
+        with ctx["metricas"].span(f"cmd:{type(cmd).__name__}"):
+            return MANEJADORES_CMD[type(cmd)](cmd, ctx)
+    except Exception as e:
+        return f"\n\n❌ Error procesando comando: {str(e)}"
 
-                if total == 0: iconos = "—"
 
-                texto += f"| **{i}** | {r.get('Tarea')} | {iconos} | **{porcentaje}** |\n"
-            return texto
+@st.cache_resource
+def obtener_pool_comandos():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="comandos")
 
-        elif modo == "AGREGAR":
-            # datos: [Tarea, (n subtareas...), Fecha]
-            # Creamos fila con 15 espacios para subtareas
-            tarea = datos[0]
-            fecha = datos[-1]
-            cantidad_subs = len(datos) - 2 # Restamos Tarea y Fecha
 
-            fila_subs = []
-            for k in range(15):
-                if k < cantidad_subs:
-                    fila_subs.append("FALSE") # Activa para contar
-                else:
-                    fila_subs.append("") # Vacía para ignorar
+def ejecutar_comandos(comandos, invalidos, ctx):
+    # Ejecuta los carriles a la vez en el pool y devuelve el texto a añadir a
+    # la respuesta, con los resultados en el orden original de los comandos.
+    # Un turno con evento + correo cuesta max(latencias), no la suma.
+    comandos = agrupar_eventos(agrupar_mutaciones(comandos))
+    carriles = {}
+    for i, cmd in enumerate(comandos):
+        carriles.setdefault(_carril(cmd), []).append((i, cmd))
 
-            # Armamos la fila completa: Tarea + 15 Subs + Extras
-            fila = [tarea] + fila_subs + ["", "Pendiente", fecha]
-            sheet.append_row(fila)
-            return f"Tarea agregada con {cantidad_subs} subtareas."
-
-        elif modo == "CHECK":
-            # datos[0] = Fila, datos[1] = Número de subtarea visual (1, 2, 3...)
-            fila_idx = int(datos[0])
-            sub_num = int(datos[1])
-
-            # La columna 1 es Tarea, la 2 es Subtarea 1.
-            # Por tanto: Columna = 1 + sub_num
-            col_idx = 1 + sub_num
-
-            sheet.update_cell(fila_idx, col_idx, True)
-            return "Avance actualizado."
-
-        elif modo == "ADD_SUB":
-            # Agrega una subtarea extra a una fila existente
-            fila_idx = int(datos[0])
-            row_vals = sheet.row_values(fila_idx)
-
-            # Buscamos la primera columna vacía entre la 2 y la 16 (Subtareas)
-            col_destino = -1
-            for c in range(2, 17):
-                # Si la longitud de row_vals es menor que c, es que está vacío al final
-                if c > len(row_vals) or row_vals[c-1] == "":
-                    col_destino = c
-                    break
+    def correr(lista):
+        return [(i, _ejecutar_uno(cmd, ctx)) for i, cmd in lista]
 
-            if col_destino != -1:
-                sheet.update_cell(fila_idx, col_destino, "FALSE")
-                return "Subtarea adicional agregada."
-            else:
-                return "Máximo de 15 subtareas alcanzado."
+    salidas = [""] * len(comandos)
+    if len(carriles) == 1:
+        resultados = [correr(lista) for lista in carriles.values()]
+    else:
+        pool = obtener_pool_comandos()
+        # Cada hilo del pool escribe en la traza del turno
+        futuros = [pool.submit(ctx["metricas"].en_traza, ctx["traza"], correr, lista)
+                   for lista in carriles.values()]
+        resultados = [f.result() for f in futuros]
+    for resultado in resultados:
+        for i, texto in resultado:
+            salidas[i] = texto
 
-    except Exception as e:
-        return f"Error: {str(e)}"
+    salida = "".join(salidas)
+    for crudo, motivo in invalidos:
+        salida += f"\n\n⚠️ Comando ignorado ({motivo}): {crudo}"
+    return salida
 
 
 # --- 5. CEREBRO Y AUTODETECCIÓN ---
@@ -274,11 +2693,117 @@ except:
     st.stop()
 
 
-@st.cache_data
-def detectar_modelo_real(key):
+URL_GEMINI = "https://generativelanguage.googleapis.com/v1beta"
+MARCADORES_CMD = ("CALENDAR_CMD:", "MEMORIA_CMD:", "EMAIL_CMD:", "TAREA_CMD:")
+
+
+class LimitadorTokens:
+    # Token bucket compartido por todas las sesiones del proceso: como mucho
+    # 'por_minuto' peticiones por minuto, con ráfagas de hasta 'rafaga'.
+    # Si no hay ficha, la petición espera en vez de fallar con 429.
+
+    def __init__(self, por_minuto, rafaga=None):
+        self._ritmo = por_minuto / 60.0
+        self._capacidad = float(rafaga or max(1, por_minuto // 4))
+        self._fichas = self._capacidad
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def esperar(self):
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._fichas = min(self._capacidad,
+                                   self._fichas + (ahora - self._ultimo) * self._ritmo)
+                self._ultimo = ahora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return
+                falta = (1 - self._fichas) / self._ritmo
+            time.sleep(falta)
+
+
+class ClienteGemini:
+    # Sesión HTTP keep-alive (con pool de conexiones) para todo el tráfico
+    # con Gemini. Reintenta 429/5xx y errores de red con backoff exponencial
+    # con jitter (respetando Retry-After) y pasa antes por el limitador.
+    # url_base es configurable para probar contra un servidor Gemini falso.
+
+    REINTENTABLES = (429, 500, 502, 503, 504)
+
+    def __init__(self, url_base, por_minuto, max_reintentos=4,
+                 timeout=(10, 120), backoff_base=1.0, backoff_max=30.0, metricas=None):
+        self.metricas = metricas or Metricas()
+        self.url_base = url_base.rstrip("/")
+        self.max_reintentos = max_reintentos
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limitador = LimitadorTokens(por_minuto)
+        self._sesion = requests.Session()
+        adaptador = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self._sesion.mount("https://", adaptador)
+        self._sesion.mount("http://", adaptador)
+
+    def _espera(self, intento, resp=None):
+        retry_after = resp.headers.get("Retry-After") if resp is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(self.backoff_max, float(retry_after))
+        # "Full jitter": aleatorio entre 0 y el tope exponencial
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** intento))
+
+    def url_subida(self):
+        # La File API cuelga de /upload/<versión>/files
+        base, _, version = self.url_base.rpartition("/")
+        return f"{base}/upload/{version}/files"
+
+    def peticion(self, metodo, ruta, key, params=None, url=None, **kwargs):
+        # ruta relativa a url_base, o 'url' completa (p. ej. la de subida)
+        url = url or f"{self.url_base}/{ruta}"
+        params = dict(params or {}, key=key)
+        for intento in range(self.max_reintentos + 1):
+            self.limitador.esperar()
+            self.metricas.contar_api("gemini")
+            try:
+                resp = self._sesion.request(metodo, url, params=params,
+                                            timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if intento == self.max_reintentos:
+                    raise
+                time.sleep(self._espera(intento))
+                continue
+            if resp.status_code in self.REINTENTABLES and intento < self.max_reintentos:
+                espera = self._espera(intento, resp)
+                resp.close()
+                time.sleep(espera)
+                continue
+            return resp
+
+
+@st.cache_resource
+def obtener_cliente_gemini():
+    try:
+        url_base = st.secrets.get("GEMINI_BASE_URL", URL_GEMINI)
+        por_minuto = int(st.secrets.get("GEMINI_RPM", 15))
+    except:
+        url_base, por_minuto = URL_GEMINI, 15
+    return ClienteGemini(url_base, por_minuto, metricas=obtener_metricas())
+
+
+def texto_error_gemini(resp):
+    texto = f"Error {resp.status_code}: {resp.text}"
+    if resp.status_code == 429 or "quota" in resp.text:
+        texto += "\n(Puede ser un problema temporal de cuota de API.)"
+    return texto
+
+
+MODELO_POR_DEFECTO = "models/gemini-2.5-flash"
+
+
+def detectar_modelo_real(key, cliente):
+    # Primer modelo con generateContent, o None si la consulta falla
     try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models?key={key}"
-        response = requests.get(url)
+        response = cliente.peticion("GET", "models", key)
         if response.status_code == 200:
             data = response.json()
             for m in data.get('models', []):
@@ -286,198 +2811,494 @@ def detectar_modelo_real(key):
                     return m['name']
     except:
         pass
-    return "models/gemini-1.5-flash"
-
-modelo_activo = detectar_modelo_real(api_key)
-
-
-def get_hora_peru():
-    # Hora de Lima (UTC-5)
-    return datetime.datetime.utcnow() - datetime.timedelta(hours=5)
-
-
-# --- 6. INICIALIZACIÓN Y CARGA DE DATOS ---
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-if "id_conv_actual" not in st.session_state:
-    st.session_state.id_conv_actual = None
-if "num_mensajes" not in st.session_state:
-    st.session_state.num_mensajes = 40  # Recuperamos el contador
+    return None
 
-creds = obtener_credenciales()
-hoja_chat, hoja_perfil = None, None
-estado_memoria = "Desconectada"
-perfil_texto = ""
 
-if creds:
-    h1, h2 = conectar_memoria(creds)
-    if h1:
-        hoja_chat = h1
-        hoja_perfil = h2
-        estado_memoria = "Conectada"
+class DescubridorModelo:
+    # Modelo detectado, guardado en disco con TTL (por huella de la API key).
+    # Nunca bloquea el arranque: si falta o caducó se refresca en un hilo y
+    # mientras tanto se usa el valor guardado (aunque esté caducado). Solo el
+    # primer turno sin ningún valor guardado espera, como mucho 'espera' s.
 
-        # Cargar Chat
-        if not st.session_state.messages:
-            try:
-                todas_las_filas = hoja_chat.get_all_values()
-                if len(todas_las_filas) > 1:
-                    # 1. Detectar IDs existentes
-                    ids_existentes = sorted(
-                        list(set(f[0] for f in todas_las_filas[1:] if f[0].strip().isdigit())), key=int)
-
-                    if st.session_state.id_conv_actual is None:
-                        if ids_existentes:
-                            st.session_state.id_conv_actual = ids_existentes[-1]
-                        else:
-                            st.session_state.id_conv_actual = "1"
-
-                    target_id = str(st.session_state.id_conv_actual)
-
-                    # 2. FILTRAR primero solo las filas de esta conversación
-                    filas_de_esta_conv = []
-                    for fila in todas_las_filas[1:]:
-                        if len(fila) >= 4 and fila[0] == target_id:
-                            filas_de_esta_conv.append(fila)
-
-                    # 3. APLICAR EL LÍMITE (Cargar solo los últimos 'num_mensajes')
-                    limite = st.session_state.num_mensajes
-                    for fila in filas_de_esta_conv[-limite:]:
-                        rol_leido = fila[2].strip()
-                        msg_leido = fila[3].strip()
-                        if msg_leido:
-                            role = "user" if rol_leido.lower() == "user" else "assistant"
-                            st.session_state.messages.append(
-                                {"role": role, "content": msg_leido, "mode": "personal"})
+    TTL = 6 * 3600
+    REINTENTO = 60  # segundos entre consultas fallidas
 
-            except Exception as e:
-                st.error(f"Error recuperando historial: {e}")
+    def __init__(self, ruta, detectar):
+        self._ruta = ruta
+        self._detectar = detectar
+        self._lock = threading.Lock()
+        self._hilos = {}
+        self._ultimo_intento = {}
+        self._datos = self._leer()
 
-        # Cargar Perfil
-        if hoja_perfil:
+    def _leer(self):
+        try:
+            with open(self._ruta, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _guardar(self):
+        os.makedirs(os.path.dirname(self._ruta), exist_ok=True)
+        tmp = self._ruta + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._datos, f)
+        os.replace(tmp, self._ruta)
+
+    @staticmethod
+    def _huella(key):
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+    def _refrescar(self, key, huella):
+        modelo = self._detectar(key)
+        with self._lock:
+            self._hilos.pop(huella, None)
+            if modelo:
+                self._datos[huella] = {"modelo": modelo, "ts": time.time()}
+                try:
+                    self._guardar()
+                except OSError:
+                    pass
+
+    def modelo(self, key, espera=0):
+        huella = self._huella(key)
+        with self._lock:
+            entrada = self._datos.get(huella)
+            fresco = entrada and time.time() - entrada["ts"] < self.TTL
+            hilo = self._hilos.get(huella)
+            if not fresco and hilo is None and \
+                    time.time() - self._ultimo_intento.get(huella, 0) > self.REINTENTO:
+                self._ultimo_intento[huella] = time.time()
+                hilo = threading.Thread(target=self._refrescar, args=(key, huella),
+                                        daemon=True, name="descubre-modelo")
+                self._hilos[huella] = hilo
+                hilo.start()
+        if entrada is None and hilo is not None and espera:
+            hilo.join(espera)
+            with self._lock:
+                entrada = self._datos.get(huella)
+        return entrada["modelo"] if entrada else MODELO_POR_DEFECTO
+
+
+@st.cache_resource
+def obtener_descubridor_modelo():
+    cliente = obtener_cliente_gemini()  # resuelto aquí: el hilo no tiene contexto de Streamlit
+    return DescubridorModelo(os.path.join(DIR_DATOS, "modelo.json"),
+                             lambda key: detectar_modelo_real(key, cliente))
+
+
+# Lanza (si hace falta) el refresco en segundo plano; no espera a la red
+modelo_activo = obtener_descubridor_modelo().modelo(api_key)
+
+
+def _texto_de_respuesta(data):
+    # Texto del primer candidato de una respuesta (o de un trozo SSE) de Gemini
+    partes = []
+    for cand in data.get('candidates', [])[:1]:
+        for part in cand.get('content', {}).get('parts', []):
+            partes.append(part.get('text', ''))
+    return "".join(partes)
+
+
+def _leer_sse(resp):
+    # Cada evento llega como "data: {json}". Decodificamos a mano en UTF-8:
+    # text/event-stream no trae charset y requests asumiría latin-1.
+    try:
+        for linea in resp.iter_lines():
+            if not linea.startswith(b"data:"):
+                continue
+            trozo = _texto_de_respuesta(json.loads(linea[5:].decode("utf-8")))
+            if trozo:
+                yield trozo
+    finally:
+        resp.close()
+
+
+def llamar_gemini(modelo, key, payload):
+    # Devuelve (texto, None) o (None, texto de error)
+    resp = obtener_cliente_gemini().peticion(
+        "POST", f"{modelo}:generateContent", key,
+        headers={'Content-Type': 'application/json'}, data=json.dumps(payload))
+    if resp.status_code != 200:
+        return None, texto_error_gemini(resp)
+    return resp.json()['candidates'][0]['content']['parts'][0]['text'], None
+
+
+def llamar_gemini_stream(modelo, key, payload):
+    # Devuelve (generador de trozos de texto, None) o (None, texto de error)
+    resp = obtener_cliente_gemini().peticion(
+        "POST", f"{modelo}:streamGenerateContent", key, params={"alt": "sse"},
+        headers={'Content-Type': 'application/json'}, data=json.dumps(payload),
+        stream=True)
+    if resp.status_code != 200:
+        return None, texto_error_gemini(resp)
+    return _leer_sse(resp), None
+
+
+# --- CACHÉ DEL PREFIJO FIJO (cachedContents) Y DE RESPUESTAS ---
+
+def crear_contenido_cacheado(cliente, modelo, key, texto, ttl):
+    # Sube 'texto' como instrucción de sistema cacheada; devuelve su nombre
+    cuerpo = {"model": modelo, "systemInstruction": {"parts": [{"text": texto}]},
+              "ttl": f"{ttl}s"}
+    resp = cliente.peticion("POST", "cachedContents", key,
+                            headers={'Content-Type': 'application/json'},
+                            data=json.dumps(cuerpo))
+    if resp.status_code != 200:
+        raise RuntimeError(texto_error_gemini(resp))
+    return resp.json()["name"]
+
+
+class CacheContexto:
+    # Bloque fijo del prompt (ver prefijo_personal) guardado en Gemini como
+    # contenido cacheado (cachedContents): se sube una vez por modelo y cada
+    # turno lo cita por nombre en vez de reenviarlo. Se crea en un hilo, así que el turno que lo
+    # pide primero aún va con el bloque en línea; se renueva cuando le quedan
+    # menos de MARGEN segundos. Un prefijo por debajo del mínimo de tokens
+    # del modelo ni se intenta (la API lo rechaza); si aun así falla, se
+    # sigue en línea y no se reintenta hasta pasados REINTENTO segundos.
+
+    TTL = 3600
+    MARGEN = 300
+    REINTENTO = 1800
+    MIN_TOKENS = (("1.5", 32768), ("pro", 4096))  # (parte del nombre, mínimo)
+    MIN_TOKENS_DEFECTO = 1024
+
+    @classmethod
+    def minimo_tokens(cls, modelo):
+        return next((n for parte, n in cls.MIN_TOKENS if parte in modelo), cls.MIN_TOKENS_DEFECTO)
+
+    def __init__(self, crear):
+        self._crear = crear  # (modelo, key, texto, ttl) -> "cachedContents/..."
+        self._lock = threading.Lock()
+        self._entradas = {}  # clave -> (nombre, caduca_en)
+        self._creando = set()
+        self._fallos = {}  # clave -> time.time() del último fallo
+        self.ultimo_error = None
+
+    @staticmethod
+    def _clave(modelo, key, texto):
+        return (DescubridorModelo._huella(key), modelo,
+                hashlib.sha256(texto.encode("utf-8")).hexdigest()[:16])
+
+    def nombre(self, modelo, key, texto):
+        # Nombre del contenido cacheado, o None si aún no lo hay
+        if estimar_tokens(texto) < self.minimo_tokens(modelo):
+            return None
+        clave = self._clave(modelo, key, texto)
+        with self._lock:
+            ahora = time.time()
+            nombre, caduca = self._entradas.get(clave, (None, 0.0))
+            if caduca - ahora < self.MARGEN and clave not in self._creando \
+                    and ahora - self._fallos.get(clave, 0.0) > self.REINTENTO:
+                self._creando.add(clave)
+                threading.Thread(target=self._crear_en_fondo,
+                                 args=(clave, modelo, key, texto),
+                                 name="cache-contexto", daemon=True).start()
+            return nombre if caduca > ahora else None
+
+    def _crear_en_fondo(self, clave, modelo, key, texto):
+        try:
+            nombre = self._crear(modelo, key, texto, self.TTL)
+            with self._lock:
+                self._entradas[clave] = (nombre, time.time() + self.TTL)
+            self.ultimo_error = None
+        except Exception as e:
+            with self._lock:
+                self._fallos[clave] = time.time()
+            self.ultimo_error = f"{type(e).__name__}: {e}"
+        finally:
+            with self._lock:
+                self._creando.discard(clave)
+
+    def descartar(self, modelo, key, texto):
+        # Gemini no aceptó el nombre (caducado, borrado...): en línea por un rato
+        clave = self._clave(modelo, key, texto)
+        with self._lock:
+            self._entradas.pop(clave, None)
+            self._fallos[clave] = time.time()
+
+
+@st.cache_resource
+def obtener_cache_contexto():
+    # None si se desactiva con CACHE_CONTEXTO = false en los secrets
+    if not secreto_si_no("CACHE_CONTEXTO", True):
+        return None
+    cliente = obtener_cliente_gemini()  # resuelto aquí: el hilo no tiene contexto de Streamlit
+    return CacheContexto(lambda modelo, key, texto, ttl: crear_contenido_cacheado(
+        cliente, modelo, key, texto, ttl))
+
+
+def con_prefijo(payload, prefijo, nombre_cache):
+    # El prefijo fijo va citado por nombre (cachedContent) o, si no hay, en
+    # línea y al principio: idéntico en todos los turnos, también lo
+    # aprovecha la caché implícita de Gemini
+    if not prefijo:
+        return payload
+    if nombre_cache:
+        return dict(payload, cachedContent=nombre_cache)
+    partes = [{"text": prefijo}] + payload["contents"][0]["parts"]
+    return dict(payload, contents=[{"parts": partes}])
+
+
+# Respuestas reutilizables: misma consulta (normalizada), mismo modo y modelo,
+# misma conversación, misma hora del reloj, los mismos últimos mensajes y sin
+# cambios en tareas ni perfil desde que se respondió. Solo se guardan las que
+# no tienen efectos (sin comandos o solo TAREA_CMD: LISTAR, que se vuelve a
+# ejecutar y muestra la lista actual).
+TTL_RESPUESTAS = 600
+MIN_PALABRAS_RESPUESTA = 3  # "sí", "ok, dale"... dependen de lo anterior
+CONTEXTO_RESPUESTA = 4  # mensajes anteriores que entran en la clave
+PATRON_CONSULTA_HORA = re.compile(r"\b(hora|horas|minutos?|ahora|ahorita)\b")
+
+
+@st.cache_resource
+def obtener_cache_respuestas():
+    return CacheLecturas()
+
+
+def usuario_actual():
+    # Email de quien entró si la app tiene login (st.user); si no, la app es
+    # de un solo usuario
+    try:
+        if st.user.is_logged_in:
+            return st.user.email
+    except Exception:
+        pass
+    return "propietario"
+
+
+def normalizar_consulta(texto):
+    # "¿Qué tengo  pendiente?" y "que tengo pendiente" dan lo mismo
+    texto = unicodedata.normalize("NFD", texto.lower())
+    texto = "".join(c for c in texto if unicodedata.category(c) != "Mn")
+    return " ".join(re.findall(r"\w+", texto))
+
+
+def _contexto_respuesta(mensajes, consulta):
+    # Los últimos mensajes de la conversación sin las veces anteriores que se
+    # hizo la misma consulta (ni sus respuestas): repetirla sigue acertando
+    previos = [m for m in mensajes if m["role"] != "system"]
+    contexto = []
+    i = 0
+    while i < len(previos):
+        m = previos[i]
+        if m["role"] == "user" and normalizar_consulta(m["content"]) == consulta:
+            i += 2 if i + 1 < len(previos) and previos[i + 1]["role"] != "user" else 1
+            continue
+        contexto.append((m["role"], m["content"]))
+        i += 1
+    return contexto[-CONTEXTO_RESPUESTA:]
+
+
+def clave_respuesta(texto, modo, modelo, modelo_tareas, indice_perfil, id_conv, mensajes, ahora):
+    # None si la consulta es demasiado corta para reutilizar su respuesta o
+    # depende de la hora exacta. 'mensajes' puede incluir ya la consulta.
+    consulta = normalizar_consulta(texto)
+    if len(consulta.split()) < MIN_PALABRAS_RESPUESTA or PATRON_CONSULTA_HORA.search(consulta):
+        return None
+    estado = hashlib.sha256(repr((
+        modelo_tareas.version, indice_perfil.version, str(id_conv),
+        ahora.strftime("%Y-%m-%d %H"), _contexto_respuesta(mensajes, consulta),
+    )).encode("utf-8")).hexdigest()[:16]
+    return (modo, modelo, consulta, estado)
+
+
+def respuesta_reutilizable(comandos, invalidos):
+    return not invalidos and all(
+        isinstance(c, CmdTarea) and c.accion == "LISTAR" for c in comandos)
+
+
+# --- ADJUNTOS: NORMALIZACIÓN UNA SOLA VEZ Y CACHÉ POR CONTENIDO ---
+PATRON_REFERENCIA_ADJUNTO = re.compile(
+    r"imagen|foto|archivo|adjunt|pdf|documento|captura|escaneo|p[aá]gina|gr[aá]fic", re.I)
+
+
+@dataclass
+class Adjunto:
+    hash: str
+    nombre: str
+    mime: str
+    datos: bytes  # versión compacta (imagen reescalada / PDF original)
+    bytes_original: int
+    texto: str = None  # texto extraído de un PDF
+    uri: str = None  # referencia de la File API de Gemini
+    uri_expira: float = 0.0
+    subida_fallida: float = 0.0  # time.time() del último intento fallido
+
+
+class GestorAdjuntos:
+    # Normaliza cada archivo subido una sola vez (por hash de contenido):
+    # imágenes reescaladas a MAX_LADO y recomprimidas en JPEG, PDFs con su
+    # texto extraído. Después se envía una referencia de la File API (se
+    # sube una vez, dura 48 h) o, si no se puede, la versión compacta; tras
+    # una subida fallida ese adjunto va en línea durante REINTENTO_SUBIDA s.
+
+    MAX_LADO = 1536
+    CALIDAD_JPEG = 80
+    MAX_TEXTO_PDF = 30000
+    MAX_ENTRADAS = 32
+    VIDA_URI = 47 * 3600
+    REINTENTO_SUBIDA = 600
+
+    def __init__(self, cliente, usar_file_api=True):
+        self._cliente = cliente
+        self._usar_file_api = usar_file_api
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # hash -> Adjunto
+        self._por_subida = {}  # file_id -> hash
+
+    def _normalizar_imagen(self, datos, mime):
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            return datos, mime
+        img = Image.open(io.BytesIO(datos))
+        # Al recodificar se pierde la etiqueta EXIF de orientación: se aplica
+        # antes a los píxeles (las fotos del móvil llegarían giradas)
+        girada = img.getexif().get(0x0112, 1) != 1
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((self.MAX_LADO, self.MAX_LADO))
+        if img.mode in ("RGBA", "LA", "P"):
+            fondo = Image.new("RGB", img.size, (255, 255, 255))
+            img = img.convert("RGBA")
+            fondo.paste(img, mask=img.split()[-1])
+            img = fondo
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        salida = io.BytesIO()
+        img.save(salida, format="JPEG", quality=self.CALIDAD_JPEG, optimize=True)
+        if salida.tell() >= len(datos) and not girada:
+            return datos, mime  # ya era compacta
+        return salida.getvalue(), "image/jpeg"
+
+    def _texto_pdf(self, datos):
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            return None
+        lector = PdfReader(io.BytesIO(datos))
+        paginas = []
+        for n, pagina in enumerate(lector.pages, start=1):
+            paginas.append(f"[Página {n}]\n{pagina.extract_text() or ''}")
+        texto = "\n".join(paginas).strip()
+        # Un PDF escaneado no trae texto: entonces se manda el PDF
+        if len(texto) < 40 * len(lector.pages):
+            return None
+        return texto[:self.MAX_TEXTO_PDF]
+
+    def preparar(self, nombre, mime, datos, id_subida=None):
+        # id_subida (file_id de Streamlit) evita re-hashear en cada rerun
+        with self._lock:
+            clave = self._por_subida.get(id_subida)
+        if clave is None:
+            clave = hashlib.sha256(datos).hexdigest()
+        with self._lock:
+            if id_subida:
+                self._por_subida[id_subida] = clave
+            if clave in self._cache:
+                self._cache.move_to_end(clave)
+                return self._cache[clave]
+        texto = None
+        compactos = datos
+        try:
+            if mime.startswith("image/"):
+                compactos, mime = self._normalizar_imagen(datos, mime)
+            elif mime == "application/pdf":
+                texto = self._texto_pdf(datos)
+        except Exception:
+            compactos = datos  # si no se puede procesar, va tal cual
+        adjunto = Adjunto(clave, nombre, mime, compactos, len(datos), texto)
+        with self._lock:
+            self._cache[clave] = adjunto
+            while len(self._cache) > self.MAX_ENTRADAS:
+                viejo, _ = self._cache.popitem(last=False)
+                self._por_subida = {k: v for k, v in self._por_subida.items() if v != viejo}
+        return adjunto
+
+    def _subir(self, adjunto, key):
+        # Subida reanudable de la File API: inicio + subida/finalización
+        inicio = self._cliente.peticion(
+            "POST", None, key, url=self._cliente.url_subida(),
+            headers={"X-Goog-Upload-Protocol": "resumable",
+                     "X-Goog-Upload-Command": "start",
+                     "X-Goog-Upload-Header-Content-Length": str(len(adjunto.datos)),
+                     "X-Goog-Upload-Header-Content-Type": adjunto.mime,
+                     "Content-Type": "application/json"},
+            data=json.dumps({"file": {"display_name": adjunto.nombre}}))
+        url_subida = inicio.headers.get("X-Goog-Upload-URL")
+        if inicio.status_code != 200 or not url_subida:
+            raise RuntimeError(f"File API {inicio.status_code}")
+        resp = self._cliente.peticion(
+            "POST", None, key, url=url_subida,
+            headers={"X-Goog-Upload-Offset": "0",
+                     "X-Goog-Upload-Command": "upload, finalize"},
+            data=adjunto.datos)
+        if resp.status_code != 200:
+            raise RuntimeError(f"File API {resp.status_code}")
+        adjunto.uri = resp.json()["file"]["uri"]
+        adjunto.uri_expira = time.time() + self.VIDA_URI
+
+    def partes(self, adjunto, key):
+        # Partes del payload de Gemini para este adjunto
+        if adjunto.texto:
+            return [{"text": f"(Contenido del PDF adjunto '{adjunto.nombre}'):\n{adjunto.texto}"}]
+        ahora = time.time()
+        if self._usar_file_api and ahora - adjunto.subida_fallida > self.REINTENTO_SUBIDA:
             try:
-                vals = hoja_perfil.get_all_values()
-                for fila in vals:
-                    perfil_texto += " ".join(fila) + "\n"
-            except:
-                pass
+                if not adjunto.uri or ahora > adjunto.uri_expira:
+                    self._subir(adjunto, key)
+                return [{"file_data": {"mime_type": adjunto.mime, "file_uri": adjunto.uri}}]
+            except Exception:
+                adjunto.subida_fallida = ahora  # sin File API: la versión compacta
+        return [{"inline_data": {"mime_type": adjunto.mime,
+                                 "data": base64.b64encode(adjunto.datos).decode('utf-8')}}]
 
-# --- 7. BARRA LATERAL Y UI ---
-with st.sidebar:
-    st.header("Configuración")
-    modo = st.radio("Modo:", ["🟣 Asistente Personal", "✨ Gemini General"])
 
-    st.write("---")
-    uploaded_file = st.file_uploader("📸 Subir archivo", type=[
-                                     "png", "jpg", "jpeg", "pdf"])
+@st.cache_resource
+def obtener_gestor_adjuntos():
+    usar_file_api = secreto_si_no("GEMINI_FILE_API", True)
+    return GestorAdjuntos(obtener_cliente_gemini(), usar_file_api)
 
-    st.write("---")
-    st.header("🗂️ Conversaciones")
 
-    # 1. Leer IDs desde la hoja
-    lista_ids = ["1"]
-    if hoja_chat:
-        try:
-            raw_data = hoja_chat.get_all_values()
-            encontrados = sorted(
-                list(set(f[0] for f in raw_data[1:] if f[0].strip().isdigit())), key=int)
-            if encontrados:
-                lista_ids = encontrados
-        except:
-            pass
+TIPOS_ADJUNTO = (("image/", "una imagen"), ("application/pdf", "un PDF"),
+                 ("audio/", "un audio"), ("video/", "un video"))
 
-    # 2. Determinar ID actual
-    actual = str(
-        st.session_state.id_conv_actual) if st.session_state.id_conv_actual else lista_ids[-1]
 
-    if actual not in lista_ids:
-        lista_ids.append(actual)
+def aviso_adjunto(adjunto):
+    # Nota para el modelo tras las partes del adjunto, según su tipo
+    tipo = next((t for prefijo, t in TIPOS_ADJUNTO if adjunto.mime.startswith(prefijo)),
+                "un archivo")
+    return f"\n(El usuario adjuntó {tipo}: '{adjunto.nombre}'. Tenlo en cuenta si es relevante)."
 
-    # 3. Selector
-    id_seleccionado = st.selectbox(
-        "Elige una conversación:",
-        options=lista_ids,
-        index=lista_ids.index(actual)
-    )
 
-    if id_seleccionado != actual:
-        st.session_state.id_conv_actual = id_seleccionado
-        st.session_state.num_mensajes = 40  # Resetea vista al cambiar
-        st.session_state.messages = []
-        st.rerun()
+def adjunto_debe_enviarse(adjunto, id_conv, texto_usuario, enviados):
+    # Solo si es nuevo en esta conversación o el usuario lo menciona
+    clave = (str(id_conv), adjunto.hash)
+    return clave not in enviados or bool(PATRON_REFERENCIA_ADJUNTO.search(texto_usuario or ""))
 
-    # 4. Botón Nueva Conversación
-    if st.button("➕ Nueva Conversación"):
-        max_id = int(lista_ids[-1])
-        nuevo = str(max_id + 1)
-        st.session_state.id_conv_actual = nuevo
-        st.session_state.num_mensajes = 40  # Resetea vista al crear
-        st.session_state.messages = []
-        st.rerun()
-
-
-    # 5. Botón Cargar Más (RECUPERADO)
-    st.write("---")
-    if st.button("🔄 Cargar más antiguos"):
-        st.session_state.num_mensajes += 40
-        st.session_state.messages = []
-        st.rerun()
 
-    st.write("---")
-    if estado_memoria == "Conectada":
-        st.success(f"🧠 Memoria: Conv. {st.session_state.id_conv_actual}")
-    else:
-        st.error("⚠️ Memoria Desconectada")
+def texto_visible_parcial(texto):
+    # Mientras llega el stream no mostramos los comandos técnicos del final,
+    # ni un marcador que todavía está llegando a trozos ("TAREA_C...")
+    corte = min((texto.find(m) for m in MARCADORES_CMD if m in texto),
+                default=len(texto))
+    visible = texto[:corte]
+    # El prefijo de marcador más largo, y solo si empieza una palabra (un
+    # texto que acaba en "C" no tiene por qué ser "CALENDAR_CMD:")
+    largo = max((n for m in MARCADORES_CMD for n in range(1, len(m))
+                 if visible.endswith(m[:n])
+                 and (n == len(visible) or visible[-n - 1].isspace())), default=0)
+    return visible[:len(visible) - largo]
 
-st.title("Tu Espacio")
 
-# --- MOSTRAR HISTORIAL ---
-for message in st.session_state.messages:
-    if message["role"] != "system":
-        av = "👤" if message["role"] == "user" else "🟣"
-        with st.chat_message(message["role"], avatar=av):
-            st.markdown(message["content"])
+def get_hora_peru():
+    # Hora de Lima (UTC-5)
+    return datetime.datetime.utcnow() - datetime.timedelta(hours=5)
 
-# --- 8. INPUT UNIFICADO (VOZ Y TEXTO) ---
-audio_wav = st.audio_input("🎙️ Toca para hablar")
-prompt_texto = st.chat_input("Escribe aquí...")
-input_usuario = None
-es_audio = False
-
-if prompt_texto:
-    input_usuario = prompt_texto
-elif audio_wav:
-    es_audio = True
-    input_usuario = "🎤 [Audio enviado]"
-
-if input_usuario:
-
-    # Preparamos el mensaje para el historial (se mostrará)
-    st.session_state.messages.append(
-        {"role": "user", "content": input_usuario, "mode": "personal"})
-    with st.chat_message("user", avatar="👤"):
-        st.markdown(input_usuario)
-
-# --- 9. LÓGICA DE PROCESAMIENTO Y RESPUESTA ---
-    es_personal = ("Asistente" in modo)
-    tag_modo = "personal" if es_personal else "gemini"
-    avatar_bot = "🟣" if es_personal else "✨"
-    respuesta_texto = ""
-
-    with st.spinner("Pensando..."):
-        # Contexto
-        historial = ""
-        for m in st.session_state.messages[-40:]:
-            historial += f"{m['role']}: {m['content']}\n"
-
-        hora_peru_str = get_hora_peru().strftime("%A %d de %B del %Y, %H:%M:%S")
-
-        if es_personal:
-            sys_context = f"""
-            INSTRUCCIONES: Eres un asistente personal leal y eficiente. NO menciones limitaciones de IA.
-            HORA OFICIAL PERÚ(UTC-5): {hora_peru_str}
-            PERFIL USUARIO: {perfil_texto}
-            MEMORIA RECIENTE: {historial}
 
+# Bloque fijo de instrucciones (igual en todos los turnos)
+INSTRUCCIONES_HERRAMIENTAS = """
             TUS HERRAMIENTAS(TIENES PERMISO TOTAL PARA USARLAS):
 
             1. TAREAS Y PROYECTOS (PRIORIDAD):
@@ -504,6 +3325,7 @@ if input_usuario:
             2. Listar: "TAREA_CMD: LISTAR"
             3. Check: "TAREA_CMD: CHECK | ID_Fila | N_Subtarea"
             4. Extender: "TAREA_CMD: EXTENDER | ID_Fila"
+            5. Estado: "TAREA_CMD: ESTADO | ID_Fila | Pendiente/En curso/Completada"
             
             HERRAMIENTA TAREAS:
 
@@ -528,190 +3350,920 @@ if input_usuario:
             4. PARA ENVIAR CORREOS GMAIL:
             Si te piden enviar un correo, responde con este formato al final:
             EMAIL_CMD: Destinatario | Asunto | Cuerpo del mensaje
+            (Varios destinatarios: sepáralos con comas. Varios correos: un EMAIL_CMD por correo).
+
+            NOTA: Puedes escribir varios comandos en la misma respuesta, uno por línea
+            (por ejemplo varios TAREA_CMD: CHECK seguidos para cerrar varias subtareas).
 
             NOTA: Si te preguntan "¿Qué tengo pendiente?", SIEMPRE ejecuta primero TAREA_CMD: LISTAR.
             """
+
+
+# --- CONTEXTO CON PRESUPUESTO DE TOKENS ---
+PRESUPUESTO_TOKENS_DEFECTO = 6000
+VENTANA_RECIENTE = 20  # mensajes que van literales; los anteriores se resumen
+
+
+def estimar_tokens(texto):
+    # Estimación offline (~4 caracteres por token): suficiente para presupuestar
+    return (len(texto) + 3) // 4
+
+
+@dataclass
+class Seccion:
+    titulo: str
+    items: list  # en orden de preferencia (el primero es el más importante)
+    prioridad: int  # menor = se llena antes
+    obligatoria: bool = False
+    max_tokens: int = None
+    invertir: bool = False  # mostrar los ítems en orden inverso al de preferencia
+    separador: str = "\n"
+    # Si se indica, solo los primeros 'min_items' van con 'prioridad'; el
+    # resto de ítems compite con 'prioridad_resto'
+    min_items: int = 0
+    prioridad_resto: int = None
+
+
+def armar_con_presupuesto(secciones, presupuesto):
+    # Llena el presupuesto por prioridad, ítem a ítem y sin saltarse ítems
+    # dentro de una sección. Las obligatorias entran siempre.
+    # Devuelve (texto, tokens estimados).
+    tramos = []
+    for sec in secciones:
+        if sec.prioridad_resto is None:
+            tramos.append((sec.prioridad, sec, 0, len(sec.items)))
         else:
-            sys_context = "Responde como Gemini."
+            tramos.append((sec.prioridad, sec, 0, sec.min_items))
+            tramos.append((sec.prioridad_resto, sec, sec.min_items, len(sec.items)))
+
+    elegidos = {id(sec): 0 for sec in secciones}  # ítems aceptados (prefijo)
+    usados = {id(sec): 0 for sec in secciones}
+    restante = presupuesto
+    for _, sec, desde, hasta in sorted(tramos, key=lambda t: t[0]):
+        if elegidos[id(sec)] < desde:
+            continue  # el tramo anterior de esta sección ya no cupo
+        for item in sec.items[desde:hasta]:
+            coste = estimar_tokens(item)
+            if not sec.obligatoria:
+                if coste > restante:
+                    break
+                if sec.max_tokens is not None and usados[id(sec)] + coste > sec.max_tokens:
+                    break
+            elegidos[id(sec)] += 1
+            usados[id(sec)] += coste
+            restante -= coste
+
+    partes = []
+    for sec in secciones:
+        items = sec.items[:elegidos[id(sec)]]
+        if not items:
+            continue
+        if sec.invertir:
+            items = items[::-1]
+        partes.append(sec.titulo + sec.separador.join(items))
+    texto = "\n".join(partes)
+    return texto, estimar_tokens(texto)
+
+
+def _comprimir_turno(m):
+    # Una línea por mensaje: sin tablas ni resultados de comandos, y solo la
+    # primera frase (recortada)
+    lineas = [l.strip() for l in m["content"].splitlines()
+              if l.strip() and not l.strip().startswith(("|", "✅", "❌", "📋", "📈", "➕", "⚠️", "(💾"))]
+    texto = " ".join(" ".join(lineas).split())
+    frase = re.split(r"(?<=[.!?])\s", texto, maxsplit=1)[0]
+    if len(frase) > 160:
+        frase = frase[:157] + "..."
+    quien = "Usuario" if m["role"] == "user" else "Asistente"
+    return f"- {quien}: {frase}"
+
+
+def _huella(m):
+    return hashlib.sha1(f"{m['role']}|{m['content']}".encode("utf-8")).hexdigest()
+
+
+class ResumenesConversacion:
+    # Resumen acumulado (extractivo, sin red) de los turnos antiguos de cada
+    # conversación. Se guarda por id de conversación junto con la huella del
+    # último mensaje resumido: cada turno solo se comprimen los mensajes nuevos
+    # que salieron de la ventana reciente.
+
+    MAX_TOKENS = 600
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._por_conv = {}  # id -> {"huella": str, "lineas": [str]}
+
+    def actualizar(self, id_conv, antiguos):
+        with self._lock:
+            if not antiguos:
+                return ""
+            entrada = self._por_conv.get(id_conv)
+            inicio = 0
+            if entrada:
+                huellas = [_huella(m) for m in antiguos]
+                if entrada["huella"] in huellas:
+                    inicio = len(huellas) - huellas[::-1].index(entrada["huella"])
+                else:
+                    entrada = None  # el historial cambió (p. ej. recarga): rehacer
+            lineas = list(entrada["lineas"]) if entrada else []
+            lineas += [_comprimir_turno(m) for m in antiguos[inicio:]]
+            # Acotado: si crece demasiado, se olvidan las líneas más viejas
+            while len(lineas) > 1 and estimar_tokens("\n".join(lineas)) > self.MAX_TOKENS:
+                lineas.pop(0)
+            self._por_conv[id_conv] = {"huella": _huella(antiguos[-1]), "lineas": lineas}
+            return "\n".join(lineas)
+
+
+@st.cache_resource
+def obtener_resumenes():
+    return ResumenesConversacion()
+
+
+# --- ÍNDICE DE RELEVANCIA DEL PERFIL (BM25) ---
+TOP_K_PERFIL = 8
+STOPWORDS_ES = set("""
+a al algo como con cual cuando de del desde donde el ella ellos en entre era es esa
+ese eso esta este esto fue ha hay la las le les lo los mas me mi mis muy no nos o para
+pero por que quien se si sin sobre su sus te tengo ti tu tus un una uno y ya yo
+""".split())
+
+
+def tokenizar(texto):
+    # Minúsculas, sin tildes, sin stopwords y con un plural muy simple
+    texto = unicodedata.normalize("NFD", texto.lower())
+    texto = "".join(c for c in texto if unicodedata.category(c) != "Mn")
+    tokens = []
+    for t in re.findall(r"\w+", texto):
+        if t in STOPWORDS_ES or (len(t) < 3 and not t.isdigit()):
+            continue
+        if len(t) > 4 and t.endswith("es"):
+            t = t[:-2]
+        elif len(t) > 3 and t.endswith("s"):
+            t = t[:-1]
+        tokens.append(t)
+    return tokens
+
+
+class IndicePerfil:
+    # Índice invertido BM25 en memoria sobre los datos del Perfil (puro
+    # Python, sin red). Se carga una vez por proceso y MEMORIA_CMD le añade
+    # cada dato nuevo al momento; cada RECARGA segundos se relee la hoja por
+    # si alguien la editó a mano.
+
+    K1 = 1.5
+    B = 0.75
+    RECARGA = 600
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vaciar()
+        self.cargado_en = None
+        self.version = 0  # sube con cada carga o dato nuevo (ver clave_respuesta)
+
+    def _vaciar(self):
+        self._docs = []
+        self._longitudes = []
+        self._invertido = {}  # término -> {n_doc: frecuencia}
+
+    def _agregar(self, texto):
+        texto = texto.strip()
+        if not texto:
+            return
+        n = len(self._docs)
+        tokens = tokenizar(texto)
+        self._docs.append(texto)
+        self._longitudes.append(len(tokens))
+        for t in tokens:
+            posting = self._invertido.setdefault(t, {})
+            posting[n] = posting.get(n, 0) + 1
+
+    def cargar(self, textos):
+        with self._lock:
+            self._vaciar()
+            for texto in textos:
+                self._agregar(texto)
+            self.cargado_en = time.time()
+            self.version += 1
+
+    def necesita_carga(self):
+        return self.cargado_en is None or time.time() - self.cargado_en > self.RECARGA
+
+    def agregar(self, texto):
+        with self._lock:
+            self._agregar(texto)
+            self.version += 1
+
+    def __len__(self):
+        return len(self._docs)
+
+    def datos(self):
+        # Todos los datos, en el orden de la hoja (ver prefijo_personal)
+        with self._lock:
+            return list(self._docs)
+
+    def buscar(self, consulta, k=TOP_K_PERFIL, recientes=3):
+        # Los k datos más relevantes (de más a menos). Si hay pocos aciertos
+        # se completa con los datos más recientes, hasta 'recientes'.
+        with self._lock:
+            n_docs = len(self._docs)
+            if not n_docs:
+                return []
+            media = sum(self._longitudes) / n_docs or 1
+            puntos = {}
+            for t in set(tokenizar(consulta)):
+                posting = self._invertido.get(t)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+                for n, tf in posting.items():
+                    norma = tf + self.K1 * (1 - self.B + self.B * self._longitudes[n] / media)
+                    puntos[n] = puntos.get(n, 0.0) + idf * tf * (self.K1 + 1) / norma
+            mejores = heapq.nlargest(k, puntos, key=lambda n: (puntos[n], n))
+            for n in range(n_docs - 1, -1, -1):
+                if len(mejores) >= min(k, len(puntos) + recientes):
+                    break
+                if n not in mejores:
+                    mejores.append(n)
+            return [self._docs[n] for n in mejores]
+
+
+@st.cache_resource
+def obtener_indice_perfil():
+    return IndicePerfil()
+
+
+CABECERA_SISTEMA = ("INSTRUCCIONES: Eres un asistente personal leal y eficiente. "
+                    "NO menciones limitaciones de IA.")
+
+
+def prefijo_personal(modelo, perfil, cache_contexto, presupuesto):
+    # Parte fija del prompt del modo personal, que va como prefijo
+    # (con_prefijo). Devuelve (prefijo, lleva_perfil).
+    # Cabecera + herramientas no llegan al mínimo de tokens de cachedContents
+    # de ningún modelo. Con el perfil entero (solo cambia con MEMORIA_CMD o al
+    # releer la hoja) sí puede llegar; en ese caso va todo en el prefijo, que
+    # se cachea y se cita por nombre, y el turno ya no lleva sección de perfil.
+    # Si no llega (o no cabe en medio presupuesto) se queda en cabecera +
+    # herramientas y el perfil entra por relevancia en cada turno: mandar el
+    # perfil entero en línea en cada turno costaría más de lo que ahorra.
+    base = CABECERA_SISTEMA + "\n" + INSTRUCCIONES_HERRAMIENTAS
+    if cache_contexto and perfil:
+        completo = base + "\nPERFIL USUARIO:\n" + "\n".join(perfil)
+        tokens = estimar_tokens(completo)
+        if cache_contexto.minimo_tokens(modelo) <= tokens <= presupuesto // 2:
+            return completo, True
+    return base, False
+
+
+def construir_contexto_personal(mensajes, id_conv, datos_perfil, hora_str, presupuesto,
+                                prefijo):
+    # datos_perfil: los datos del perfil relevantes, del más al menos relevante
+    # (vacío si el perfil ya va en el prefijo). El prefijo (prefijo_personal)
+    # no va aquí, pero descuenta del presupuesto.
+    # Prioridades: instrucciones y hora (siempre) > últimos mensajes > perfil
+    # > resumen de lo antiguo > resto de mensajes recientes
+    sistema = [m["content"].strip() for m in mensajes if m["role"] == "system"]
+    turnos = [m for m in mensajes if m["role"] != "system"]
+    recientes = turnos[-VENTANA_RECIENTE:]
+    resumen = obtener_resumenes().actualizar(str(id_conv), turnos[:-VENTANA_RECIENTE])
+    lineas_recientes = [f"{m['role']}: {m['content']}" for m in reversed(recientes)]
+
+    secciones = [
+        Seccion("", sistema, 0, obligatoria=True),
+        Seccion("HORA OFICIAL PERÚ(UTC-5): ", [hora_str], 0, obligatoria=True),
+        Seccion("PERFIL USUARIO: ", datos_perfil, 2, max_tokens=presupuesto // 4),
+        Seccion("RESUMEN DE LA CONVERSACIÓN ANTERIOR:\n", [resumen] if resumen else [], 3,
+                max_tokens=ResumenesConversacion.MAX_TOKENS),
+        Seccion("MEMORIA RECIENTE: ", lineas_recientes, 1, invertir=True,
+                min_items=4, prioridad_resto=4),
+    ]
+    return armar_con_presupuesto(secciones, presupuesto - estimar_tokens(prefijo))
+
+
+# --- VENTANA DEL HISTORIAL EN LA SESIÓN ---
+PAGINA_HISTORIAL = 40  # mensajes por página ("Cargar más antiguos")
+MAX_MENSAJES_SESION = 400  # tope de mensajes cargados por conversación
+MAX_CONVERSACIONES_SESION = 5  # ventanas que se conservan al cambiar de conversación
+
+
+def _a_mensajes(filas):
+    mensajes = []
+    for rol_leido, msg_leido in filas:
+        rol_leido = rol_leido.strip()
+        msg_leido = msg_leido.strip()
+        if msg_leido:
+            role = "user" if rol_leido.lower() == "user" else "assistant"
+            mensajes.append({"role": role, "content": msg_leido, "mode": "personal"})
+    return mensajes
+
+
+def abrir_ventana(ventanas, almacen, cola, id_conv, sistema):
+    # ventanas: OrderedDict id -> {"messages", "cursor"} de la sesión. Si la
+    # conversación ya estaba cargada se reutiliza tal cual; si no, se lee
+    # solo su última página (más lo que aún espera en la cola de escritura).
+    # 'cursor' apunta a la página anterior (None = no hay más).
+    if id_conv in ventanas:
+        ventanas.move_to_end(id_conv)
+        return ventanas[id_conv]
+    filas, cursor = almacen.pagina(id_conv, PAGINA_HISTORIAL)
+    if cola:
+        filas += almacen.pendientes(cola, id_conv)
+    ventanas[id_conv] = {"messages": list(sistema) + _a_mensajes(filas), "cursor": cursor}
+    while len(ventanas) > MAX_CONVERSACIONES_SESION:
+        ventanas.popitem(last=False)
+    return ventanas[id_conv]
+
+
+def cargar_anteriores(ventana, almacen, id_conv):
+    # Antepone la página anterior (detrás de los mensajes de sistema) sin
+    # tocar lo ya cargado. Devuelve cuántos mensajes se añadieron.
+    mensajes = ventana["messages"]
+    hueco = MAX_MENSAJES_SESION - len(mensajes)
+    if ventana["cursor"] is None or hueco <= 0:
+        return 0
+    filas, ventana["cursor"] = almacen.pagina(
+        id_conv, min(PAGINA_HISTORIAL, hueco), ventana["cursor"])
+    nuevos = _a_mensajes(filas)
+    i = next((k for k, m in enumerate(mensajes) if m["role"] != "system"), len(mensajes))
+    mensajes[i:i] = nuevos
+    return len(nuevos)
+
+
+def recortar_ventana(ventana, almacen, id_conv):
+    # Al pasar del tope, descarta los mensajes más antiguos (detrás de los de
+    # sistema) y adelanta el cursor para que "Cargar más antiguos" los vuelva
+    # a traer. Devuelve cuántos se quitaron.
+    mensajes = ventana["messages"]
+    i = next((k for k, m in enumerate(mensajes) if m["role"] != "system"), len(mensajes))
+    sobran = min(len(mensajes) - MAX_MENSAJES_SESION, len(mensajes) - i)
+    if sobran <= 0:
+        return 0
+    del mensajes[i:i + sobran]
+    if almacen:
+        ventana["cursor"] = almacen.avanzar_cursor(id_conv, ventana["cursor"], sobran)
+    return sobran
+
+
+# --- 6. INICIALIZACIÓN Y CARGA DE DATOS ---
+if "messages" not in st.session_state:
+    st.session_state.messages = []
+if "id_conv_actual" not in st.session_state:
+    st.session_state.id_conv_actual = None
+if "ventanas" not in st.session_state:
+    st.session_state.ventanas = OrderedDict()  # ver abrir_ventana
+if "adjuntos_enviados" not in st.session_state:
+    st.session_state.adjuntos_enviados = set()  # (id_conv, hash) ya enviados
+
+fase_carga = metricas.iniciar("carga_datos")
+registro_google = obtener_registro_google()
+cola_escritura = obtener_cola_escritura()
+creds = obtener_credenciales()
+hoja_chat, hoja_perfil = None, None
+chat_memoria = None  # ChatSQLite, EspejoChat o ChatParticionado (ver almacen_chat)
+almacen_local = obtener_almacen_local()
+estado_memoria = "Desconectada"
+indice_perfil = obtener_indice_perfil()
+try:
+    presupuesto_tokens = int(st.secrets.get("PRESUPUESTO_TOKENS", PRESUPUESTO_TOKENS_DEFECTO))
+except:
+    presupuesto_tokens = PRESUPUESTO_TOKENS_DEFECTO
 
+if creds:
+    h1, h2 = conectar_memoria(registro_google)
+    if h1:
+        hoja_chat = h1
+        hoja_perfil = h2
+        estado_memoria = "Conectada"
+
+        # Cargar Chat: con almacén local, la base SQLite (de Sheets solo se
+        # importa lo que falta); si no, espejo local de la hoja plana (solo
+        # baja las filas nuevas) o, si está particionado, el índice
+        chat_memoria = almacen_chat(hoja_chat, cola_escritura)
         try:
-            url = f"https://generativelanguage.googleapis.com/v1beta/{modelo_activo}:generateContent?key={api_key}"
-            headers = {'Content-Type': 'application/json'}
-
-            # --- CONSTRUCCIÓN DEL PAYLOAD (CON IMAGEN) ---
-            payload_parts = [{"text": sys_context}]
-
-            # 1. Agregar Imagen (si existe)
-            if uploaded_file is not None:
-                bytes_img = uploaded_file.getvalue()
-                b64_img = base64.b64encode(bytes_img).decode('utf-8')
-                payload_parts.append({
-                    "inline_data": {
-                        "mime_type": uploaded_file.type,
-                        "data": b64_img
-                    }
-                })
-                payload_parts.append(
-                    {"text": "\n(El usuario adjuntó una imagen. Úsala si es relevante)."})
-
-            # 2. Agregar Audio o Texto
-            if es_audio:
-                bytes_audio = audio_wav.getvalue()
-                b64_audio = base64.b64encode(bytes_audio).decode('utf-8')
-                payload_parts.append({
-                    "inline_data": {
-                        "mime_type": "audio/wav",
-                        "data": b64_audio
-                    }
-                })
-                payload_parts.append(
-                    {"text": "\n---\nTranscribe el audio y responde."})
+            with metricas.span("sync_chat"):
+                registro_google.con_reconexion(
+                    lambda r: chat_memoria.sincronizar(hoja_chat))
+        except Exception as e:
+            st.error(f"Error recuperando historial: {e}")
+
+if chat_memoria is None and almacen_local:
+    # Sin conexión con Sheets: el chat sigue desde la base local
+    chat_memoria = almacen_chat(None, cola_escritura)
+    estado_memoria = "Local"
+
+if chat_memoria:
+    # 1. Conversación actual (por defecto, la última)
+    if st.session_state.id_conv_actual is None:
+        ids_existentes = chat_memoria.ids()
+        st.session_state.id_conv_actual = ids_existentes[-1] if ids_existentes else "1"
+    target_id = str(st.session_state.id_conv_actual)
+
+    # 2. Su ventana de mensajes: la que ya tiene la sesión o su última página.
+    # messages ES la lista de la ventana (lo que se añade queda en ella).
+    with metricas.span("ventana_historial"):
+        sistema = [m for m in st.session_state.messages if m["role"] == "system"]
+        ventana = abrir_ventana(st.session_state.ventanas, chat_memoria, cola_escritura,
+                                target_id, sistema)
+    st.session_state.messages = ventana["messages"]
+
+# Cargar Perfil (una vez por proceso: el índice se actualiza solo). Con
+# almacén local sale de la base y la hoja se relee en segundo plano.
+if indice_perfil.necesita_carga() and (almacen_local or hoja_perfil):
+    try:
+        with metricas.span("carga_perfil"):
+            if almacen_local:
+                almacen_local.perfil.cargar_indice(
+                    registro_google, hoja_perfil, cola_escritura, indice_perfil)
             else:
-                payload_parts.append({"text": "USUARIO: " + prompt_texto})
+                vals = registro_google.con_reconexion(lambda r: r.leer(hoja_perfil))
+                filas = [" ".join(fila) for fila in vals]
+                if cola_escritura:
+                    filas += [" ".join(f) for f in cola_escritura.pendientes(DESTINO_PERFIL)]
+                indice_perfil.cargar(filas)
+    except:
+        pass
+metricas.terminar(fase_carga)
 
-            payload = {"contents": [{"parts": payload_parts}]}
+# --- 7. BARRA LATERAL Y UI ---
+# La barra y el chat van en fragmentos (st.fragment): tocar un ajuste o mandar
+# un mensaje solo vuelve a ejecutar su fragmento, no el script entero. Los
+# fragmentos leen los ajustes de session_state y reciben como argumentos los
+# objetos del último run completo (todos de cache_resource).
+
+def adjunto_actual():
+    # Archivo del uploader de la barra, normalizado una sola vez por contenido
+    archivo = st.session_state.get("archivo")
+    if archivo is None:
+        return None
+    return obtener_gestor_adjuntos().preparar(
+        archivo.name, archivo.type, archivo.getvalue(), getattr(archivo, "file_id", None))
 
-            # Llamada a la API
-            resp = requests.post(url, headers=headers,
-                                 data=json.dumps(payload))
 
-            if resp.status_code == 200:
-                respuesta_texto = resp.json(
-                )['candidates'][0]['content']['parts'][0]['text']
-            else:
-                respuesta_texto = f"Error {resp.status_code}: {resp.text}"
-                if "quota" in resp.text:
-                    respuesta_texto += "\n(Puede ser un problema temporal de cuota de API.)"
-        except Exception as e:
-            respuesta_texto = f"Error inesperado: {e}"
+@st.fragment
+def barra_ajustes():
+    st.header("Configuración")
+    st.radio("Modo:", ["🟣 Asistente Personal", "✨ Gemini General"], key="modo")
+    st.toggle("⚡ Mostrar respuesta mientras se escribe", value=True, key="usar_streaming")
 
-# --- LOGICA CALENDARIO (CON REPETICIÓN) ---
-    if "CALENDAR_CMD:" in respuesta_texto:
-        try:
-            parts = respuesta_texto.split("CALENDAR_CMD:")
-            respuesta_texto = parts[0].strip()
-
-            # Ahora esperamos hasta 5 partes: Título | Inicio | Fin | Nota | RRULE
-            datos = parts[1].strip().split("|")
-
-            if len(datos) >= 3:
-                resumen = datos[0].strip()
-
-                # 1. Formato ISO
-                ini_raw = datos[1].strip().replace(" ", "T")
-                fin_raw = datos[2].strip().replace(" ", "T")
-                if len(ini_raw) == 16:
-                    ini_raw += ":00"
-                if len(fin_raw) == 16:
-                    fin_raw += ":00"
-
-                # 2. Nota (Opcional)
-                nota = datos[3].strip() if len(datos) > 3 else ""
-
-                # 3. Regla de Repetición (RRULE) - Opcional
-                rule = None
-                if len(datos) > 4:
-                    rule_raw = datos[4].strip()
-                    if "FREQ=" in rule_raw:  # Solo si parece una regla válida
-                        rule = "RRULE:" + \
-                            rule_raw if not rule_raw.startswith(
-                                "RRULE:") else rule_raw
-
-                ok, link = crear_evento_calendario(
-                    creds, resumen, ini_raw, fin_raw, nota, rule)
-
-                tipo = "repetitivo" if rule else "único"
-                respuesta_texto += f"\n\n{'✅ Evento ' + tipo + ' creado' if ok else '❌ Error'}: {link}"
-        except:
-            pass
+    st.write("---")
+    st.file_uploader("📸 Subir archivo", type=["png", "jpg", "jpeg", "pdf"], key="archivo")
+    adjunto = adjunto_actual()
+    if adjunto is not None:
+        st.caption(f"📎 {adjunto.bytes_original // 1024} KB → "
+                   f"{len(adjunto.texto.encode('utf-8') if adjunto.texto else adjunto.datos) // 1024} KB")
 
-# --- LOGICA MEMORIA (PERFIL) CON FECHA ---
-    if "MEMORIA_CMD:" in respuesta_texto:
-        try:
-            parts = respuesta_texto.split("MEMORIA_CMD:")
-            respuesta_texto = parts[0].strip()
-            dato_nuevo = parts[1].strip()
 
-            if hoja_perfil:
-                timestamp = get_hora_peru().strftime("%Y-%m-%d %H:%M:%S")
-                hoja_perfil.append_row([timestamp, dato_nuevo])
-                respuesta_texto += "\n(💾 Guardado en perfil)"
-        except:
-            pass
+@st.fragment
+def barra_conversaciones(chat_memoria, ventana):
+    # Cambiar de conversación o cargar mensajes antiguos cambia el historial:
+    # eso sí pide un run completo (st.rerun)
+    st.header("🗂️ Conversaciones")
 
-# --- LOGICA EMAIL ---
-    if "EMAIL_CMD:" in respuesta_texto:
-        try:
-            parts = respuesta_texto.split("EMAIL_CMD:")
-            respuesta_texto = parts[0].strip()
-            datos = parts[1].strip().split("|")
-
-            if len(datos) >= 3:
-                dest = datos[0].strip()
-                asunto = datos[1].strip()
-                cuerpo = datos[2].strip()
-
-                ok, msg = enviar_correo_gmail(dest, asunto, cuerpo)
-                respuesta_texto += f"\n\n{'✅ Correo enviado' if ok else '❌ Error correo'}: {msg}"
-        except:
-            pass
+    # 1. Leer IDs desde el almacén local
+    lista_ids = ["1"]
+    if chat_memoria:
+        with metricas.span("ids_conversaciones"):
+            encontrados = chat_memoria.ids()
+        if encontrados:
+            lista_ids = encontrados
 
-# --- LOGICA TAREAS ---
-    if "TAREA_CMD:" in respuesta_texto:
-        try:
-            parts = respuesta_texto.split("TAREA_CMD:")
-            respuesta_texto = parts[0].strip()
-            cmd_full = parts[1].strip().split("|")
-            accion = cmd_full[0].strip()
-
-            if accion == "LISTAR":
-                res = gestionar_tareas("LISTAR")
-                respuesta_texto += f"\n\n📋 {res}"
-
-            elif accion == "AGREGAR":
-                # Captura dinámicamente: Tarea | Sub1 | ... | Fecha
-                datos_tarea = [x.strip() for x in cmd_full[1:]]
-                res = gestionar_tareas("AGREGAR", datos_tarea)
-                respuesta_texto += f"\n\n✅ {res}"
-
-            elif accion == "CHECK" and len(cmd_full) >= 3:
-                # CHECK | ID_Fila | N_Subtarea
-                res = gestionar_tareas("CHECK", [cmd_full[1], cmd_full[2]])
-                respuesta_texto += f"\n\n📈 {res}"
-
-            elif accion == "EXTENDER" and len(cmd_full) >= 2:
-                # EXTENDER | ID_Fila (Agrega una casilla vacía extra al final)
-                res = gestionar_tareas("ADD_SUB", [cmd_full[1]])
-                respuesta_texto += f"\n\n➕ {res}"
+    # 2. Determinar ID actual
+    actual = str(
+        st.session_state.id_conv_actual) if st.session_state.id_conv_actual else lista_ids[-1]
 
-        except Exception as e:
-            respuesta_texto += f"\n\n❌ Error procesando tarea: {str(e)}"
+    if actual not in lista_ids:
+        lista_ids.append(actual)
+
+    # 3. Selector
+    id_seleccionado = st.selectbox(
+        "Elige una conversación:",
+        options=lista_ids,
+        index=lista_ids.index(actual)
+    )
 
-    # C. RESPUESTA FINAL
-    with st.chat_message("assistant", avatar=avatar_bot):
-        st.markdown(respuesta_texto)
+    # (la ventana de cada conversación se conserva en la sesión: volver a
+    # una ya abierta no relee nada)
+    if id_seleccionado != actual:
+        st.session_state.id_conv_actual = id_seleccionado
+        st.rerun()
 
-        # LOGICA DE AUDIO INTELIGENTE: (Solo responde con audio si se le habló con audio)
-        if es_audio:
-            audio_fp = texto_a_audio(respuesta_texto)
-            if audio_fp:
-                st.audio(audio_fp, format='audio/mp3')
+    # 4. Botón Nueva Conversación
+    if st.button("➕ Nueva Conversación"):
+        max_id = int(lista_ids[-1])
+        nuevo = str(max_id + 1)
+        st.session_state.id_conv_actual = nuevo
+        st.rerun()
 
-        st.session_state.messages.append(
-            {"role": "model", "content": respuesta_texto, "mode": tag_modo})
 
-# D. GUARDAR EN MEMORIA
-        if hoja_chat:
+    # 5. Botón Cargar Más: solo la página anterior, antepuesta a la ventana
+    st.write("---")
+    if chat_memoria and ventana["cursor"] is not None:
+        if len(ventana["messages"]) >= MAX_MENSAJES_SESION:
+            st.caption(f"📜 Máximo de {MAX_MENSAJES_SESION} mensajes cargados.")
+        elif st.button("🔄 Cargar más antiguos"):
+            with metricas.span("pagina_historial"):
+                cargar_anteriores(ventana, chat_memoria, str(st.session_state.id_conv_actual))
+            st.rerun()
+
+
+INTERVALO_BARRA_ESTADO = 5  # s entre refrescos mientras hay trabajo pendiente
+
+
+def trabajo_pendiente(cola_escritura):
+    # Correos por enviar o filas por guardar (también las que dan error)
+    buzon = obtener_buzon()
+    if buzon and buzon.estado()["en_cola"]:
+        return True
+    return bool(cola_escritura and cola_escritura.estado()["pendientes"])
+
+
+def barra_estado(estado_memoria, cola_escritura):
+    # Fragmento (ver pintar_barra_estado): solo lee estado en memoria
+    if estado_memoria == "Conectada":
+        st.success(f"🧠 Memoria: Conv. {st.session_state.id_conv_actual}")
+    elif estado_memoria == "Local":
+        st.warning(f"🧠 Memoria local (Sheets sin conexión): Conv. {st.session_state.id_conv_actual}")
+    else:
+        st.error("⚠️ Memoria Desconectada")
+
+    # Estado de la bandeja de salida
+    buzon = obtener_buzon()
+    if buzon:
+        estado_buzon = buzon.estado()
+        if estado_buzon["en_cola"]:
+            st.info(f"📤 Enviando {estado_buzon['en_cola']} correo(s)...")
+        for _, destinatarios, ok, detalle in estado_buzon["resultados"][-3:]:
+            if ok:
+                st.caption(f"✅ Correo enviado a {', '.join(destinatarios)}")
+            else:
+                st.caption(f"❌ Correo a {', '.join(destinatarios)}: {detalle}")
+
+    # Estado de la cola de escritura
+    if cola_escritura:
+        estado_cola = cola_escritura.estado()
+        if estado_cola["ultimo_error"]:
+            st.warning(f"⚠️ {estado_cola['pendientes']} fila(s) sin guardar, reintentando. "
+                       f"Último error: {estado_cola['ultimo_error']}")
+        elif estado_cola["pendientes"]:
+            st.info(f"⏳ Guardando {estado_cola['pendientes']} fila(s)...")
+        else:
+            st.caption("💾 Todo guardado")
+
+    # Refresco automático solo mientras quede trabajo: al terminar, un run
+    # completo la vuelve a montar sin temporizador. Sin él, lo que encole un
+    # turno del chat se ve en el siguiente run completo o con el botón.
+    if st.session_state.get("barra_estado_viva"):
+        if not trabajo_pendiente(cola_escritura):
+            st.session_state.barra_estado_viva = False
+            st.rerun()
+    else:
+        st.button("🔄 Actualizar estado")  # el clic vuelve a ejecutar solo el fragmento
+
+
+def pintar_barra_estado(estado_memoria, cola_escritura):
+    # run_every se fija al montar el fragmento, en cada run completo
+    viva = trabajo_pendiente(cola_escritura)
+    st.session_state.barra_estado_viva = viva
+    fragmento = st.fragment(barra_estado, run_every=INTERVALO_BARRA_ESTADO if viva else None)
+    fragmento(estado_memoria, cola_escritura)
+
+
+fase_barra = metricas.iniciar("barra_lateral")
+with st.sidebar:
+    barra_ajustes()
+    st.write("---")
+    barra_conversaciones(chat_memoria, ventana if chat_memoria else None)
+    st.write("---")
+    pintar_barra_estado(estado_memoria, cola_escritura)
+metricas.terminar(fase_barra)
+
+# --- MOSTRAR HISTORIAL ---
+# Solo en runs completos (al abrir, cambiar de conversación o cargar más
+# antiguos); los turnos nuevos los pinta el fragmento del chat
+fase_historial = metricas.iniciar("historial")
+for message in st.session_state.messages:
+    if message["role"] != "system":
+        av = "👤" if message["role"] == "user" else "🟣"
+        with st.chat_message(message["role"], avatar=av):
+            st.markdown(message["content"])
+st.session_state.pintados = len(st.session_state.messages)
+metricas.terminar(fase_historial)
+
+
+def recortar_mensajes(chat_memoria):
+    # Tras cada mensaje nuevo: la ventana no pasa del tope y 'pintados' sigue
+    # apuntando a los mismos mensajes. Sin almacén no hay cursor que mover.
+    id_actual = str(st.session_state.id_conv_actual)
+    ventana = st.session_state.ventanas.get(id_actual) if chat_memoria else None
+    if ventana is None or ventana["messages"] is not st.session_state.messages:
+        ventana, chat_memoria = {"messages": st.session_state.messages, "cursor": None}, None
+    quitados = recortar_ventana(ventana, chat_memoria, id_actual)
+    st.session_state.pintados = max(0, st.session_state.pintados - quitados)
+
+
+def turno_chat(ctx):
+    # Entrada (voz o texto), respuesta, comandos y guardado de un turno.
+    # Devuelve el texto del usuario (None si en este run no hubo mensaje).
+    chat_memoria = ctx["chat_memoria"]
+    cola_escritura = ctx["cola"]
+    registro_google = ctx["registro"]
+    hoja_perfil = ctx["perfil"]
+    almacen_local = ctx["almacen_local"]
+    modo = st.session_state.modo
+    usar_streaming = st.session_state.usar_streaming
+    adjunto = adjunto_actual()
+
+    # Turnos de este fragmento desde el último run completo (lo anterior ya
+    # está pintado fuera de él)
+    for message in st.session_state.messages[st.session_state.pintados:]:
+        if message["role"] != "system":
+            av = "👤" if message["role"] == "user" else "🟣"
+            with st.chat_message(message["role"], avatar=av):
+                st.markdown(message["content"])
+
+    # --- 8. INPUT UNIFICADO (VOZ Y TEXTO) ---
+    audio_wav = st.audio_input("🎙️ Toca para hablar")
+    prompt_texto = st.chat_input("Escribe aquí...")
+    input_usuario = None
+    es_audio = False
+
+    # El audio grabado sigue en el widget en los runs siguientes: cada
+    # grabación se procesa una sola vez
+    huella_audio = hashlib.sha1(audio_wav.getvalue()).hexdigest() if audio_wav else None
+
+    if prompt_texto:
+        input_usuario = prompt_texto
+    elif huella_audio and huella_audio != st.session_state.get("audio_procesado"):
+        es_audio = True
+        input_usuario = "🎤 [Audio enviado]"
+        st.session_state.audio_procesado = huella_audio
+
+    if input_usuario:
+
+        # Preparamos el mensaje para el historial (se mostrará)
+        st.session_state.messages.append(
+            {"role": "user", "content": input_usuario, "mode": "personal"})
+        recortar_mensajes(chat_memoria)
+        contenedor_usuario = st.chat_message("user", avatar="👤")
+        with contenedor_usuario:
+            st.markdown(input_usuario)
+
+    # --- 9. LÓGICA DE PROCESAMIENTO Y RESPUESTA ---
+        es_personal = ("Asistente" in modo)
+        tag_modo = "personal" if es_personal else "gemini"
+        avatar_bot = "🟣" if es_personal else "✨"
+        respuesta_texto = ""
+        fragmentos = None
+        fase_llm = None
+        llamada_ok = False  # respuesta completa del modelo (se puede guardar)
+
+        # El mensaje del asistente se abre ya: en modo streaming se va llenando
+        contenedor_bot = st.chat_message("assistant", avatar=avatar_bot)
+        marcador_respuesta = contenedor_bot.empty()
+
+        with st.spinner("Pensando..."):
+            # Si aún no hay modelo detectado, esperamos un poco
+            modelo_activo = obtener_descubridor_modelo().modelo(api_key, espera=5)
+
+            # Consulta repetida sin cambios en tareas, perfil ni conversación:
+            # la respuesta guardada, sin llamar al modelo (ver clave_respuesta)
+            cache_respuestas = obtener_cache_respuestas()
+            clave_cache = None
+            if es_personal and not es_audio and adjunto is None:
+                clave_cache = clave_respuesta(input_usuario, modo, modelo_activo,
+                                              obtener_modelo_tareas(), indice_perfil,
+                                              st.session_state.id_conv_actual,
+                                              st.session_state.messages, get_hora_peru())
+            reutilizada = cache_respuestas.buscar(clave_cache, usuario_actual()) \
+                if clave_cache else None
+            if reutilizada is not None:
+                respuesta_texto = reutilizada
+                contenedor_bot.caption("⚡ Respuesta reutilizada (tareas y perfil sin cambios)")
+            else:
+                # Contexto (acotado por el presupuesto de tokens). Del perfil solo van
+                # los datos relevantes para lo que se está hablando.
+                consulta_perfil = " ".join(
+                    m["content"] for m in st.session_state.messages[-3:] if m["role"] != "system")
+                datos_perfil = indice_perfil.buscar(consulta_perfil)
+                hora_peru_str = get_hora_peru().strftime("%A %d de %B del %Y, %H:%M:%S")
+
+                if es_personal:
+                    with metricas.span("contexto"):
+                        prefijo, perfil_en_prefijo = prefijo_personal(
+                            modelo_activo, indice_perfil.datos(), obtener_cache_contexto(),
+                            presupuesto_tokens)
+                        sys_context, tokens_contexto = construir_contexto_personal(
+                            st.session_state.messages, st.session_state.id_conv_actual,
+                            [] if perfil_en_prefijo else datos_perfil, hora_peru_str,
+                            presupuesto_tokens, prefijo)
+                else:
+                    sys_context = "Responde como Gemini."
+                    prefijo = None
+
+                try:
+                    # --- CONSTRUCCIÓN DEL PAYLOAD (CON IMAGEN) ---
+                    payload_parts = [{"text": sys_context}]
+
+                    # 1. Agregar Imagen (si existe, y solo si es nueva o se menciona)
+                    if adjunto is not None and adjunto_debe_enviarse(
+                            adjunto, st.session_state.id_conv_actual, prompt_texto,
+                            st.session_state.adjuntos_enviados):
+                        with metricas.span("adjuntos"):
+                            payload_parts += obtener_gestor_adjuntos().partes(adjunto, api_key)
+                        payload_parts.append({"text": aviso_adjunto(adjunto)})
+                        st.session_state.adjuntos_enviados.add(
+                            (str(st.session_state.id_conv_actual), adjunto.hash))
+
+                    # 2. Agregar Audio o Texto
+                    if es_audio:
+                        # Sin silencios, mono 16 kHz y comprimido antes de subirlo
+                        with metricas.span("audio_entrada"):
+                            bytes_audio, mime_audio, info_audio = preprocesar_audio(audio_wav.getvalue())
+                        contenedor_usuario.caption(
+                            f"🎙️ {info_audio['bytes_antes'] // 1024} KB → {info_audio['bytes_despues'] // 1024} KB "
+                            f"({info_audio['segundos_antes']:.1f} s → {info_audio['segundos_despues']:.1f} s)")
+                        b64_audio = base64.b64encode(bytes_audio).decode('utf-8')
+                        payload_parts.append({
+                            "inline_data": {
+                                "mime_type": mime_audio,
+                                "data": b64_audio
+                            }
+                        })
+                        payload_parts.append(
+                            {"text": "\n---\nTranscribe el audio y responde."})
+                    else:
+                        payload_parts.append({"text": "USUARIO: " + prompt_texto})
+
+                    payload = {"contents": [{"parts": payload_parts}]}
+
+                    # Llamada a la API. El prefijo fijo va como contenido
+                    # cacheado si ya está creado (ver CacheContexto)
+                    cache_contexto = obtener_cache_contexto()
+                    nombre_cache = cache_contexto.nombre(modelo_activo, api_key, prefijo) \
+                        if prefijo and cache_contexto else None
+                    llamar = llamar_gemini_stream if usar_streaming else llamar_gemini
+                    fase_llm = metricas.iniciar("llm")  # hasta el último trozo recibido
+                    resultado, error = llamar(
+                        modelo_activo, api_key, con_prefijo(payload, prefijo, nombre_cache))
+                    if error and nombre_cache:
+                        # Caducó o ya no existe: una vez más, con el prefijo en línea
+                        cache_contexto.descartar(modelo_activo, api_key, prefijo)
+                        resultado, error = llamar(
+                            modelo_activo, api_key, con_prefijo(payload, prefijo, None))
+                    if error:
+                        respuesta_texto = error
+                    elif usar_streaming:
+                        fragmentos = resultado
+                    else:
+                        respuesta_texto = resultado
+                        llamada_ok = True
+                except Exception as e:
+                    respuesta_texto = f"Error inesperado: {e}"
+                    if fase_llm:
+                        fase_llm["error"] = type(e).__name__
+
+        # Streaming: pintamos el texto según llega (sin los comandos del final).
+        # Los comandos se detectan abajo sobre el texto completo.
+        if fragmentos is not None:
             try:
+                for trozo in fragmentos:
+                    respuesta_texto += trozo
+                    marcador_respuesta.markdown(
+                        texto_visible_parcial(respuesta_texto) + "▌")
+                llamada_ok = bool(respuesta_texto)
+            except Exception as e:
+                respuesta_texto += f"\n\n(Respuesta interrumpida: {e})"
+                fase_llm["error"] = type(e).__name__
+            if not respuesta_texto:
+                respuesta_texto = "(El modelo no devolvió texto.)"
+        if fase_llm:
+            metricas.terminar(fase_llm)
+
+    # --- COMANDOS TÉCNICOS (todos los de la respuesta, en orden) ---
+        respuesta_cruda = respuesta_texto
+        respuesta_texto, comandos, invalidos = extraer_comandos(respuesta_texto)
+        if llamada_ok and clave_cache and respuesta_reutilizable(comandos, invalidos):
+            cache_respuestas.poner(clave_cache, respuesta_cruda, TTL_RESPUESTAS, usuario_actual())
+        if comandos or invalidos:
+            ctx_comandos = {"registro": registro_google, "cola": cola_escritura,
+                            "perfil": hoja_perfil, "indice_perfil": indice_perfil,
+                            "perfil_local": almacen_local.perfil if almacen_local else None,
+                            "modelo_tareas": obtener_modelo_tareas(),
+                            "buzon": obtener_buzon(),
+                            "metricas": metricas, "traza": metricas.traza_actual()}
+            with metricas.span("comandos"):
+                respuesta_texto += ejecutar_comandos(comandos, invalidos, ctx_comandos)
+
+        # C. RESPUESTA FINAL
+        with contenedor_bot:
+            marcador_respuesta.markdown(respuesta_texto)
+
+            # LOGICA DE AUDIO INTELIGENTE: (Solo responde con audio si se le habló con audio)
+            if es_audio:
+                with metricas.span("tts"):
+                    audio = audio_continuo(respuesta_texto)
+                if audio:
+                    st.audio(audio, format='audio/mp3', autoplay=True)
+
+            st.session_state.messages.append(
+                {"role": "model", "content": respuesta_texto, "mode": tag_modo})
+            recortar_mensajes(chat_memoria)
+
+    # D. GUARDAR EN MEMORIA
+            # (Base local y/o cola: la cola las manda juntas a Sheets en segundo plano)
+            if chat_memoria:
                 timestamp = get_hora_peru().strftime("%Y-%m-%d %H:%M:%S")
+                # (con almacén de chat la sesión siempre tiene conversación fijada)
                 id_actual = st.session_state.id_conv_actual
 
-                # Guardamos 4 columnas: ID, Fecha, Rol, Mensaje
-                hoja_chat.append_row(
-                    [id_actual, timestamp, "user", input_usuario])
-                hoja_chat.append_row(
-                    [id_actual, timestamp, "assistant", respuesta_texto])
-            except:
-                pass
+                # Plano: ID, Fecha, Rol, Mensaje en sheet1. Particionado: Fecha,
+                # Rol, Mensaje en la hoja de la conversación. ChatSQLite: a la
+                # base y de ahí, en uno de esos formatos, a la cola
+                with metricas.span("persistencia"):
+                    chat_memoria.guardar(cola_escritura, id_actual, timestamp, "user", input_usuario)
+                    chat_memoria.guardar(cola_escritura, id_actual, timestamp, "assistant", respuesta_texto)
+
+    return input_usuario
 
 
+@st.fragment
+def panel_chat(ctx):
+    # Cada run del fragmento (con o sin mensaje) lleva su propia traza
+    traza_chat = Traza(time.perf_counter())
+    input_usuario = metricas.en_traza(traza_chat, turno_chat, ctx)
+    metricas.cerrar(traza_chat, fase="fragmento_chat", turno=bool(input_usuario))
+    st.session_state.traza_chat = traza_chat
+    return input_usuario
+
+
+input_usuario = panel_chat({
+    "chat_memoria": chat_memoria, "cola": cola_escritura, "registro": registro_google,
+    "perfil": hoja_perfil, "almacen_local": almacen_local})
+
+
+# --- MÉTRICA DE ARRANQUE EN FRÍO ---
+@st.cache_resource
+def obtener_metricas_arranque():
+    # Se rellena en el primer run del proceso y no cambia después
+    return {}
+
+
+metricas_arranque = obtener_metricas_arranque()
+if not metricas_arranque:
+    metricas_arranque.update(
+        fecha=get_hora_peru().strftime("%Y-%m-%d %H:%M:%S"),
+        pintado_ms=round((T_PRIMER_PINTADO - T_INICIO_RUN) * 1000),
+        run_ms=round((time.perf_counter() - T_INICIO_RUN) * 1000))
+    # Histórico para seguir la evolución entre despliegues
+    try:
+        os.makedirs(DIR_DATOS, exist_ok=True)
+        with open(os.path.join(DIR_DATOS, "arranque.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(metricas_arranque) + "\n")
+    except OSError:
+        pass
+
+# --- RENDIMIENTO: CIERRE DE LA TRAZA Y PANEL OPCIONAL ---
+metricas.cerrar(traza, turno=bool(input_usuario))
+
+
+@st.fragment
+def panel_rendimiento(traza):
+    # "Este run" = el último run completo más el último run del chat
+    if not st.toggle("📊 Panel de rendimiento", value=False):
+        return
+    trazas = [traza] + [t for t in [st.session_state.get("traza_chat")] if t is not None]
+    fases_proceso, llamadas_proceso = metricas.resumen()
+    este_run, llamadas_run = {}, Counter()
+    for t in trazas:
+        for medida in t.spans:
+            este_run[medida["fase"]] = este_run.get(medida["fase"], 0) + medida["ms"]
+        llamadas_run.update(t.llamadas)
+    filas_panel = ["| Fase | Este run | p50 | p95 | n |", "|---|---|---|---|---|"]
+    for fase, (n, p50, p95, errores) in sorted(
+            fases_proceso.items(), key=lambda x: -x[1][2]):
+        marca = f" ⚠️{errores}" if errores else ""
+        filas_panel.append(f"| {fase}{marca} | {este_run.get(fase, 0):.0f} ms | "
+                           f"{p50:.0f} ms | {p95:.0f} ms | {n} |")
+    st.markdown("\n".join(filas_panel))
+    st.caption("Llamadas externas (este run / proceso): " + (" · ".join(
+        f"{api} {llamadas_run.get(api, 0)}/{n}"
+        for api, n in sorted(llamadas_proceso.items())) or "ninguna"))
+    if registro_google:
+        cache = registro_google.cache.estadisticas()
+        st.caption(f"Caché de lecturas de Sheets: {cache['aciertos']} aciertos · "
+                   f"{cache['fallos']} lecturas · {cache['compartidas']} compartidas "
+                   f"entre sesiones · {cache['entradas']} entradas")
+    respuestas = obtener_cache_respuestas().estadisticas()
+    st.caption(f"Respuestas reutilizadas: {respuestas['aciertos']} de "
+               f"{respuestas['aciertos'] + respuestas['fallos']} consultas cacheables")
+    cache_contexto = obtener_cache_contexto()
+    if cache_contexto and cache_contexto.ultimo_error:
+        st.caption(f"Prefijo cacheado en Gemini no disponible (va en línea): "
+                   f"{cache_contexto.ultimo_error[:120]}")
+
+
+with st.sidebar:
+    st.caption(f"⏱️ Arranque en frío: título en {metricas_arranque['pintado_ms']} ms, "
+               f"run completo en {metricas_arranque['run_ms']} ms")
+    panel_rendimiento(traza)
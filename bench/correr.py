@@ -0,0 +1,232 @@
+# Banco de pruebas sin red de app.py: ejecuta el script con AppTest contra
+# los servicios falsos de bench/falsos.py y mide, para cada tamaño de la
+# hoja de historial, el arranque, la latencia por turno (p50/p95), el coste
+# de un rerun sin mensaje y las llamadas a cada API por turno.
+#
+#   python bench/correr.py                          # 100, 1k, 10k y 100k filas
+#   python bench/correr.py --filas 1000 --turnos 30 --latencia-gemini 0.5
+#   python bench/correr.py --filas 1000 --mismo-mensaje   # caché de respuestas
+#
+# Cada tamaño corre en un proceso aparte (las cachés de st.cache_resource
+# son por proceso) con un DIR_DATOS temporal: nunca toca el spool real.
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+FILAS_POR_CONVERSACION = 50
+CABECERA_TAREAS = (["Tarea"] + [f"Subtarea {n}" for n in range(1, 16)]
+                   + ["", "Estado", "Fecha"])
+
+TEXTO = ("Claro, aquí tienes un resumen de lo que hablamos. " * 8).strip()
+RESPUESTAS_CON_COMANDOS = [
+    TEXTO,
+    TEXTO + "\nTAREA_CMD: LISTAR",
+    TEXTO + "\nCALENDAR_CMD: Estudio | 2030-01-07 09:00 | 2030-01-07 10:00"
+            "\nCALENDAR_CMD: Estudio | 2030-01-08 09:00 | 2030-01-08 10:00"
+            "\nCALENDAR_CMD: Estudio | 2030-01-09 09:00 | 2030-01-09 10:00",
+    TEXTO + "\nTAREA_CMD: CHECK | 2 | 1\nMEMORIA_CMD: Prefiere estudiar temprano",
+    TEXTO + "\nEMAIL_CMD: alguien@ejemplo.com | Resumen | Hola, te paso el resumen.",
+]
+CONSULTA_REPETIDA = "¿Qué tengo pendiente?"
+
+
+def percentil(valores, p):
+    # Método del rango más cercano
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[max(0, math.ceil(p / 100 * len(ordenados)) - 1)]
+
+
+def historial(n_filas):
+    filas = [["ID", "Fecha", "Rol", "Mensaje"]]
+    for i in range(n_filas):
+        id_conv = str(i // FILAS_POR_CONVERSACION + 1)
+        rol = "user" if i % 2 == 0 else "assistant"
+        filas.append([id_conv, "2025-01-01 10:00:00", rol, f"Mensaje {i} " + "texto " * 20])
+    return filas
+
+
+def historial_particionado(n_filas):
+    # Mismo historial en el formato de herramientas/migrar_chat.py
+    plano = historial(n_filas)[1:]
+    hojas, indice = {}, [["ID", "Hoja", "Libro", "Rango", "Mensajes", "Ultima_Actividad"]]
+    for fila in plano:
+        hojas.setdefault("Chat_" + fila[0], [["Fecha", "Rol", "Mensaje"]]).append(fila[1:])
+    for titulo, filas in hojas.items():
+        n = len(filas) - 1
+        indice.append([titulo[len("Chat_"):], titulo, "", f"A2:C{n + 1}", n, filas[-1][0]])
+    return {"Hoja 1": [["ID", "Fecha", "Rol", "Mensaje"]], **hojas, "Indice_Chat": indice}
+
+
+def tareas(n=10):
+    filas = [CABECERA_TAREAS]
+    for i in range(n):
+        filas.append([f"Tarea {i}", "FALSE", "FALSE", "FALSE"] + [""] * 12
+                     + ["Pendiente", "2030-01-01"])
+    return filas
+
+
+def medir(args):
+    # Un tamaño de historial, en este proceso; devuelve un dict de métricas
+    import falsos
+    from streamlit.testing.v1 import AppTest
+
+    n_filas = args.filas[0]
+    respuestas = [TEXTO] if args.sin_comandos else RESPUESTAS_CON_COMANDOS
+    gemini = falsos.arrancar_gemini(falsos.ConfigGemini(
+        args.latencia_gemini, args.por_trozo, respuestas=respuestas,
+        min_tokens_cache=args.min_tokens_cache))
+    smtp = falsos.arrancar_smtp()
+    chat = historial_particionado(n_filas) if args.particionado else {"Hoja 1": historial(n_filas)}
+    libros = {
+        "Memoria_Asistente": falsos.Libro({
+            **chat,
+            "Perfil": [[f"2025-01-{d:02d}", f"Dato de perfil {d}"] for d in range(1, 29)],
+        }, args.latencia_sheets),
+        "CLAVE_TAREAS": falsos.Libro({"Tareas": tareas()}, args.latencia_sheets),
+    }
+    calendario = falsos.ServicioCalendar(args.latencia_calendar)
+    falsos.instalar(libros, calendario)
+    memoria = libros["Memoria_Asistente"]
+
+    at = AppTest.from_file(os.path.join(RAIZ, "app.py"), default_timeout=args.timeout)
+    at.secrets["GEMINI_API_KEY"] = "clave-falsa"
+    at.secrets["GEMINI_BASE_URL"] = f"http://127.0.0.1:{gemini.server_port}/v1beta"
+    at.secrets["GEMINI_RPM"] = 100000
+    at.secrets["GOOGLE_CREDENTIALS"] = "{}"
+    at.secrets["SPREADSHEET_ID"] = "CLAVE_TAREAS"
+    at.secrets["GMAIL_USER"] = "yo@ejemplo.com"
+    at.secrets["SMTP_HOST"] = "127.0.0.1"
+    at.secrets["SMTP_PORT"] = smtp.server_address[1]
+    at.secrets["SMTP_STARTTLS"] = False
+    at.secrets["DIR_DATOS"] = args.dir_datos
+
+    t = time.perf_counter()
+    at.run()
+    arranque = time.perf_counter() - t
+    if at.exception:
+        raise RuntimeError(f"excepción en el arranque: {at.exception}")
+
+    def filas_chat():
+        return sum(len(h.filas) for t, h in memoria.hojas.items()
+                   if t == "Hoja 1" or t.startswith("Chat_"))
+
+    filas_antes = filas_chat()
+    turnos, llamadas = [], []
+    for i in range(args.turnos):
+        antes = falsos.foto_contadores()
+        t = time.perf_counter()
+        texto = CONSULTA_REPETIDA if args.mismo_mensaje else f"Mensaje de prueba {i}"
+        at.chat_input[0].set_value(texto).run()
+        turnos.append(time.perf_counter() - t)
+        if at.exception:
+            raise RuntimeError(f"excepción en el turno {i}: {at.exception}")
+        llamadas.append(falsos.foto_contadores() - antes)
+
+    reruns = []
+    for _ in range(args.reruns):
+        t = time.perf_counter()
+        at.run()
+        reruns.append(time.perf_counter() - t)
+
+    # Las filas del chat se escriben en segundo plano: esperamos a la cola
+    esperadas = filas_antes + 2 * args.turnos
+    limite = time.monotonic() + 15
+    while filas_chat() < esperadas and time.monotonic() < limite:
+        time.sleep(0.1)
+
+    por_turno = {}
+    for foto in llamadas:
+        for clave, n in foto.items():
+            por_turno[clave] = por_turno.get(clave, 0) + n
+    total = falsos.foto_contadores()
+    por_turno["sheets_escritura"] = total["sheets_escritura"]  # incluye la cola diferida
+    por_turno["smtp_mensajes"] = total["smtp_mensajes"]
+    return {
+        "filas": n_filas,
+        "arranque_s": arranque,
+        "turno_p50_s": percentil(turnos, 50),
+        "turno_p95_s": percentil(turnos, 95),
+        "rerun_p50_s": percentil(reruns, 50),
+        "rerun_p95_s": percentil(reruns, 95),
+        "llamadas_por_turno": {k: round(v / args.turnos, 2) for k, v in sorted(por_turno.items())},
+        "filas_guardadas": filas_chat() - filas_antes,
+    }
+
+
+def imprimir(resultados):
+    columnas = sorted({k for r in resultados for k in r["llamadas_por_turno"]})
+    print(f"{'filas':>7} {'arranque':>9} {'turno p50':>10} {'turno p95':>10} "
+          f"{'rerun p50':>10} {'rerun p95':>10}")
+    for r in resultados:
+        print(f"{r['filas']:>7} {r['arranque_s']:>8.3f}s {r['turno_p50_s']:>9.3f}s "
+              f"{r['turno_p95_s']:>9.3f}s {r['rerun_p50_s']:>9.3f}s {r['rerun_p95_s']:>9.3f}s")
+    print("\nLlamadas por turno:")
+    print(f"{'filas':>7} " + " ".join(f"{c:>17}" for c in columnas))
+    for r in resultados:
+        print(f"{r['filas']:>7} " + " ".join(
+            f"{r['llamadas_por_turno'].get(c, 0):>17}" for c in columnas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banco de pruebas sin red de app.py")
+    parser.add_argument("--filas", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--turnos", type=int, default=20)
+    parser.add_argument("--reruns", type=int, default=10)
+    parser.add_argument("--latencia-gemini", type=float, default=0.2)
+    parser.add_argument("--por-trozo", type=float, default=0.01)
+    parser.add_argument("--latencia-sheets", type=float, default=0.05)
+    parser.add_argument("--latencia-calendar", type=float, default=0.1)
+    parser.add_argument("--sin-comandos", action="store_true",
+                        help="respuestas de solo texto (sin CALENDAR/TAREA/EMAIL_CMD)")
+    parser.add_argument("--particionado", action="store_true",
+                        help="historial con una hoja por conversación + Indice_Chat")
+    parser.add_argument("--mismo-mensaje", action="store_true",
+                        help=f"todos los turnos envían \"{CONSULTA_REPETIDA}\"")
+    parser.add_argument("--min-tokens-cache", type=int, default=1024,
+                        help="mínimo de tokens que el Gemini falso acepta en cachedContents")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", metavar="RUTA", help="guarda los resultados en JSON")
+    parser.add_argument("--hijo", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--dir-datos", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo:
+        print(json.dumps(medir(args)))
+        return
+
+    resultados = []
+    for n in args.filas:
+        with tempfile.TemporaryDirectory() as dir_datos:
+            orden = [sys.executable, os.path.abspath(__file__), "--hijo", "--filas", str(n),
+                     "--dir-datos", dir_datos]
+            for nombre in ("turnos", "reruns", "latencia_gemini", "por_trozo",
+                           "latencia_sheets", "latencia_calendar", "min_tokens_cache", "timeout"):
+                orden += [f"--{nombre.replace('_', '-')}", str(getattr(args, nombre))]
+            for bandera in ("sin_comandos", "particionado", "mismo_mensaje"):
+                if getattr(args, bandera):
+                    orden.append(f"--{bandera.replace('_', '-')}")
+            salida = subprocess.run(orden, capture_output=True, text=True)
+            if salida.returncode != 0:
+                sys.exit(f"Falló la medición con {n} filas:\n{salida.stderr}")
+            resultados.append(json.loads(salida.stdout.strip().splitlines()[-1]))
+            print(f"... {n} filas listo", file=sys.stderr)
+
+    imprimir(resultados)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
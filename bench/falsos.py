@@ -0,0 +1,608 @@
+# Servicios falsos, locales y sin red, para medir app.py con AppTest:
+# Gemini (servidor HTTP con latencia, streaming SSE, cachedContents y la
+# subida reanudable de la File API),
+# Sheets (gspread en memoria), Calendar (servicio con BatchHttpRequest) y un
+# sumidero SMTP.
+# Todos cuentan sus llamadas en CONTADORES.
+
+import itertools
+import json
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTADORES = Counter()
+_lock_contadores = threading.Lock()
+
+
+def contar(clave, n=1):
+    with _lock_contadores:
+        CONTADORES[clave] += n
+
+
+def foto_contadores():
+    with _lock_contadores:
+        return Counter(CONTADORES)
+
+
+# --- GEMINI ---
+
+class ConfigGemini:
+    # latencia: segundos hasta el primer byte; por_trozo: pausa entre
+    # eventos SSE; respuestas: textos que se devuelven en rotación;
+    # min_tokens_cache: tamaño mínimo (~4 caracteres por token) que acepta
+    # cachedContents, como el de los modelos reales; fallos: errores que se
+    # sirven, en orden, antes de volver a responder bien (un código HTTP, o
+    # "cortar" para cerrar la conexión sin respuesta); retry_after: cabecera
+    # Retry-After de esos errores
+    def __init__(self, latencia=0.2, por_trozo=0.01, tam_trozo=40, respuestas=None,
+                 min_tokens_cache=1024, fallos=None, retry_after=None):
+        self.latencia = latencia
+        self.por_trozo = por_trozo
+        self.tam_trozo = tam_trozo
+        self.respuestas = respuestas or ["Hola, soy el Gemini falso."]
+        self.min_tokens_cache = min_tokens_cache
+        self.fallos = list(fallos or [])
+        self.retry_after = retry_after
+        self.cacheados = {}  # "cachedContents/N" -> texto
+        self.archivos = {}  # uri de la File API -> (mime, bytes)
+        self._subidas = {}  # upload_id -> (nombre, mime) de una subida iniciada
+        self.llegadas = []  # (time.monotonic(), ruta) de cada petición
+        self._turno = itertools.count()
+        self._lock = threading.Lock()
+
+    def siguiente(self):
+        return self.respuestas[next(self._turno) % len(self.respuestas)]
+
+    def siguiente_fallo(self):
+        with self._lock:
+            return self.fallos.pop(0) if self.fallos else None
+
+
+class _ManejadorGemini(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, codigo, obj, cabeceras=None):
+        cuerpo = json.dumps(obj).encode()
+        self.send_response(codigo)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        for nombre, valor in (cabeceras or {}).items():
+            self.send_header(nombre, valor)
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def _fallo(self):
+        # True si esta petición se lleva uno de los fallos configurados
+        config = self.server.config
+        config.llegadas.append((time.monotonic(), self.path.split("?")[0]))
+        fallo = config.siguiente_fallo()
+        if fallo is None:
+            return False
+        contar("gemini_fallo")
+        if fallo == "cortar":
+            self.close_connection = True
+            return True
+        cabeceras = {"Retry-After": str(config.retry_after)} if config.retry_after is not None else {}
+        self._json(fallo, {"error": {"code": fallo, "message": "Fallo simulado"}}, cabeceras)
+        return True
+
+    def do_GET(self):
+        if self._fallo():
+            return
+        contar("gemini_listar")
+        time.sleep(self.server.config.latencia)
+        self._json(200, {"models": [{"name": "models/falso",
+                                     "supportedGenerationMethods": ["generateContent"]}]})
+
+    def _crear_cacheado(self, cuerpo):
+        config = self.server.config
+        contar("gemini_cache_crear")
+        texto = "".join(p.get("text", "") for p in
+                        cuerpo.get("systemInstruction", {}).get("parts", []))
+        if len(texto) // 4 < config.min_tokens_cache:
+            self._json(400, {"error": {"code": 400, "message": "Cached content is too small."}})
+            return
+        nombre = f"cachedContents/{len(config.cacheados) + 1}"
+        config.cacheados[nombre] = texto
+        self._json(200, {"name": nombre, "model": cuerpo.get("model")})
+
+    def _subida(self, datos):
+        # File API, subida reanudable: "start" devuelve la URL de subida en
+        # X-Goog-Upload-URL; "upload, finalize" a esa URL guarda los bytes
+        config = self.server.config
+        comando = self.headers.get("X-Goog-Upload-Command", "")
+        if comando == "start":
+            contar("gemini_subida_inicio")
+            cuerpo = json.loads(datos or b"{}")
+            with config._lock:
+                id_subida = str(len(config._subidas) + 1)
+                config._subidas[id_subida] = (
+                    cuerpo.get("file", {}).get("display_name", ""),
+                    self.headers.get("X-Goog-Upload-Header-Content-Type", ""))
+            url = f"http://{self.headers['Host']}{self.path.split('?')[0]}?upload_id={id_subida}"
+            self._json(200, {}, {"X-Goog-Upload-URL": url, "X-Goog-Upload-Status": "active"})
+            return
+        id_subida = re.search(r"upload_id=(\w+)", self.path)
+        if "finalize" not in comando or not id_subida or id_subida.group(1) not in config._subidas:
+            self._json(400, {"error": {"code": 400, "message": "Bad upload request."}})
+            return
+        contar("gemini_subida")
+        nombre, mime = config._subidas.pop(id_subida.group(1))
+        with config._lock:
+            n = len(config.archivos) + 1
+            uri = f"http://{self.headers['Host']}/v1beta/files/{n}"
+            config.archivos[uri] = (mime, datos)
+        self._json(200, {"file": {"name": f"files/{n}", "displayName": nombre, "mimeType": mime,
+                                  "sizeBytes": str(len(datos)), "uri": uri, "state": "ACTIVE"}},
+                   {"X-Goog-Upload-Status": "final"})
+
+    def do_POST(self):
+        n = int(self.headers.get("Content-Length", 0))
+        datos = self.rfile.read(n)
+        contar("gemini_bytes_entrada", n)
+        if self._fallo():
+            return
+        if self.path.startswith("/upload/"):
+            self._subida(datos)
+            return
+        cuerpo = json.loads(datos or b"{}")
+        if self.path.split("?")[0].endswith("/cachedContents"):
+            self._crear_cacheado(cuerpo)
+            return
+        config = self.server.config
+        if "cachedContent" in cuerpo:
+            if cuerpo["cachedContent"] not in config.cacheados:
+                self._json(404, {"error": {"code": 404, "message": "CachedContent not found."}})
+                return
+            contar("gemini_con_cache")
+        for contenido in cuerpo.get("contents", []):
+            for parte in contenido.get("parts", []):
+                if "file_data" in parte and parte["file_data"]["file_uri"] not in config.archivos:
+                    self._json(400, {"error": {"code": 400, "message": "File not found."}})
+                    return
+        texto = config.siguiente()
+        time.sleep(config.latencia)
+        if "streamGenerateContent" in self.path:
+            contar("gemini_stream")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for i in range(0, len(texto), config.tam_trozo):
+                evento = {"candidates": [{"content": {"parts": [
+                    {"text": texto[i:i + config.tam_trozo]}]}}]}
+                self.wfile.write(b"data: " + json.dumps(evento).encode() + b"\r\n\r\n")
+                self.wfile.flush()
+                time.sleep(config.por_trozo)
+            self.close_connection = True
+        else:
+            contar("gemini_generate")
+            self._json(200, {"candidates": [{"content": {"parts": [{"text": texto}]}}]})
+
+
+def arrancar_gemini(config):
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), _ManejadorGemini)
+    servidor.daemon_threads = True
+    servidor.config = config
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+# --- SHEETS (gspread en memoria) ---
+
+# Como la sesión HTTP de gspread: app.py cuelga aquí su hook de respuestas
+SESION_SHEETS = types.SimpleNamespace(hooks={"response": []})
+
+
+class WorksheetNotFound(Exception):
+    pass
+
+
+def _llamada_http():
+    for hook in list(SESION_SHEETS.hooks["response"]):
+        hook(None)
+
+
+def _a1(celda):
+    m = re.match(r"([A-Z]+)(\d*)", celda)
+    col = 0
+    for letra in m.group(1):
+        col = col * 26 + ord(letra) - 64
+    return (int(m.group(2)) if m.group(2) else None), col
+
+
+def _recortar(fila):
+    fila = list(fila)
+    while fila and fila[-1] == "":
+        fila.pop()
+    return fila
+
+
+class Hoja:
+    # Worksheet de gspread con lo que usa app.py. 'latencia' simula el
+    # viaje de ida y vuelta de cada llamada a la API.
+    def __init__(self, libro, titulo, filas, latencia=0.0):
+        self.spreadsheet = libro
+        self.title = titulo
+        self.filas = [[str(c) for c in f] for f in filas]
+        self.latencia = latencia
+        self._lock = threading.Lock()
+
+    def _llamada(self, tipo):
+        contar(f"sheets_{tipo}")
+        _llamada_http()
+        time.sleep(self.latencia)
+
+    def _modificada(self):
+        self.spreadsheet.revision += 1
+
+    def _rango(self, rango):
+        a, _, b = rango.partition(":")
+        f1, c1 = _a1(a)
+        f2, c2 = _a1(b or a)
+        f2 = f2 or len(self.filas)
+        salida = [_recortar(f[c1 - 1:c2]) for f in self.filas[f1 - 1:f2]]
+        while salida and not salida[-1]:
+            salida.pop()
+        return salida
+
+    def _poner(self, f, c, valor):
+        while len(self.filas) < f:
+            self.filas.append([])
+        fila = self.filas[f - 1]
+        while len(fila) < c:
+            fila.append("")
+        fila[c - 1] = "TRUE" if valor is True else ("FALSE" if valor is False else str(valor))
+
+    def get_all_values(self):
+        self._llamada("lectura")
+        with self._lock:
+            ancho = max((len(f) for f in self.filas), default=0)
+            return [f + [""] * (ancho - len(f)) for f in self.filas]
+
+    def get(self, rango):
+        self._llamada("lectura")
+        with self._lock:
+            return self._rango(rango)
+
+    def batch_get(self, rangos):
+        self._llamada("lectura")
+        with self._lock:
+            return [self._rango(r) for r in rangos]
+
+    def row_values(self, n):
+        self._llamada("lectura")
+        with self._lock:
+            return _recortar(self.filas[n - 1]) if n <= len(self.filas) else []
+
+    def append_row(self, fila, **kwargs):
+        self.append_rows([fila])
+
+    def append_rows(self, filas, **kwargs):
+        self._llamada("escritura")
+        with self._lock:
+            primera = len(self.filas) + 1
+            self.filas += [[str(c) for c in f] for f in filas]
+            self._modificada()
+            # Como la API: el rango escrito, del que app.py saca la última fila
+            return {"updates": {"updatedRange": f"'{self.title}'!A{primera}:C{len(self.filas)}"}}
+
+    def update_cell(self, f, c, valor):
+        self._llamada("escritura")
+        with self._lock:
+            self._poner(f, c, valor)
+            self._modificada()
+
+    def batch_update(self, datos, **kwargs):
+        self._llamada("escritura")
+        with self._lock:
+            for d in datos:
+                f1, c1 = _a1(d["range"].partition(":")[0])
+                for i, fila in enumerate(d["values"]):
+                    for j, valor in enumerate(fila):
+                        self._poner(f1 + i, c1 + j, valor)
+            self._modificada()
+
+
+_IDS_LIBRO = itertools.count(1)
+
+
+class Libro:
+    def __init__(self, hojas, latencia=0.0):
+        self.id = f"libro-{next(_IDS_LIBRO)}"
+        self.revision = 0
+        self.latencia = latencia
+        self.hojas = {t: Hoja(self, t, filas, latencia) for t, filas in hojas.items()}
+
+    @property
+    def sheet1(self):
+        return next(iter(self.hojas.values()))
+
+    def worksheet(self, titulo):
+        contar("sheets_lectura")
+        _llamada_http()
+        if titulo not in self.hojas:
+            raise WorksheetNotFound(titulo)
+        return self.hojas[titulo]
+
+    def add_worksheet(self, title, rows=1, cols=1):
+        contar("sheets_escritura")
+        _llamada_http()
+        self.hojas[title] = Hoja(self, title, [], self.latencia)
+        return self.hojas[title]
+
+    def worksheets(self):
+        return list(self.hojas.values())
+
+    def get_lastUpdateTime(self):
+        contar("sheets_revision")
+        _llamada_http()
+        time.sleep(self.latencia)
+        return str(self.revision)
+
+
+class ClienteSheets:
+    def __init__(self, libros):
+        self.libros = libros
+        self.http_client = types.SimpleNamespace(session=SESION_SHEETS)
+
+    def open(self, nombre):
+        contar("sheets_abrir")
+        return self.libros[nombre]
+
+    def open_by_key(self, clave):
+        contar("sheets_abrir")
+        return self.libros[clave]
+
+
+class Credenciales:
+    access_token = "token-falso"
+    access_token_expired = False
+
+    def get_access_token(self):
+        return self
+
+
+# --- CALENDAR ---
+
+class ErrorHttp(Exception):
+    # Como googleapiclient.errors.HttpError: .resp.status y el JSON de error
+    # de la API en .content
+    def __init__(self, estado, motivo=""):
+        super().__init__(f'<HttpError {estado} "{motivo}">')
+        self.resp = types.SimpleNamespace(status=estado)
+        self.content = json.dumps(
+            {"error": {"code": estado, "errors": [{"reason": motivo}]}}).encode()
+
+
+class _PeticionEvento:
+    def __init__(self, servicio, cuerpo=None, id_evento=None):
+        self._servicio = servicio
+        self.cuerpo = cuerpo
+        self.id_evento = id_evento
+
+    def execute(self):
+        time.sleep(self._servicio.latencia)
+        if self.id_evento is not None:
+            contar("calendar_get")
+            return self._servicio.leer(self.id_evento)
+        contar("calendar_insert")
+        return self._servicio.guardar(self.cuerpo)
+
+
+class _LoteEventos:
+    def __init__(self, servicio, callback):
+        self._servicio = servicio
+        self._callback = callback
+        self._peticiones = []
+
+    def add(self, peticion, request_id=None):
+        self._peticiones.append((request_id or str(len(self._peticiones)), peticion))
+
+    def execute(self):
+        contar("calendar_batch")
+        time.sleep(self._servicio.latencia)
+        fallo = self._servicio.siguiente_fallo_lote()
+        if isinstance(fallo, int):
+            raise ErrorHttp(fallo)
+        for request_id, peticion in self._peticiones:
+            try:
+                respuesta, error = self._servicio.guardar(peticion.cuerpo), None
+            except ErrorHttp as e:
+                respuesta, error = None, e
+            if fallo != "cortar":
+                self._callback(request_id, respuesta, error)
+        if fallo == "cortar":  # el servidor lo hizo pero la respuesta se perdió
+            raise ConnectionError("conexión cortada")
+
+
+class _Eventos:
+    def __init__(self, servicio):
+        self._servicio = servicio
+
+    def insert(self, calendarId, body):
+        return _PeticionEvento(self._servicio, cuerpo=body)
+
+    def get(self, calendarId, eventId):
+        return _PeticionEvento(self._servicio, id_evento=eventId)
+
+
+class ServicioCalendar:
+    # Fallos inyectables: `fallos` se consume uno por evento insertado
+    # (None = crearlo, (estado, motivo) = responder ese HttpError) y
+    # `fallos_lote` uno por BatchHttpRequest.execute() (None, un estado que
+    # lanza antes de hacer nada, o "cortar": lo hace todo y pierde la
+    # respuesta). Un id repetido responde 409 como la API real.
+    def __init__(self, latencia=0.0, fallos=(), fallos_lote=()):
+        self.latencia = latencia
+        self.eventos = []
+        self.fallos = list(fallos)
+        self.fallos_lote = list(fallos_lote)
+        self._links = {}
+        self._lock = threading.Lock()
+
+    def siguiente_fallo_lote(self):
+        with self._lock:
+            return self.fallos_lote.pop(0) if self.fallos_lote else None
+
+    def guardar(self, cuerpo):
+        with self._lock:
+            fallo = self.fallos.pop(0) if self.fallos else None
+            if fallo:
+                raise ErrorHttp(*fallo)
+            if "id" in cuerpo and cuerpo["id"] in self._links:
+                raise ErrorHttp(409, "duplicate")
+            self.eventos.append(cuerpo)
+            link = f"https://calendar.falso/evento/{len(self.eventos)}"
+            self._links[cuerpo.get("id", len(self.eventos))] = link
+            return {"htmlLink": link}
+
+    def leer(self, id_evento):
+        with self._lock:
+            if id_evento not in self._links:
+                raise ErrorHttp(404, "notFound")
+            return {"id": id_evento, "htmlLink": self._links[id_evento]}
+
+    def events(self):
+        return _Eventos(self)
+
+    def new_batch_http_request(self, callback=None):
+        return _LoteEventos(self, callback)
+
+
+# --- TTS ---
+
+def sintetizar(texto, lang):
+    # Motor de voz falso para TTS_MOTOR = "falsos:sintetizar": devuelve el
+    # texto como "audio" y tarda más cuanto más corto es, para que los
+    # trozos terminen desordenados
+    contar("tts_sintetizar")
+    time.sleep(max(0.0, 0.2 - len(texto) / 1000))
+    return f"[{lang}:{texto}]".encode("utf-8")
+
+
+# --- SMTP ---
+
+class _ManejadorSMTP(socketserver.StreamRequestHandler):
+    # Lo justo de SMTP para smtplib: EHLO, MAIL, RCPT, DATA, NOOP, RSET, QUIT.
+    # Fallos inyectables en el servidor: `fallos` se consume uno por DATA
+    # (None = aceptar, un código 4xx/5xx = responderlo, "cortar" = cerrar sin
+    # responder); `rechazados` son direcciones a las que RCPT contesta 550;
+    # cortar_conexiones() simula el cierre por inactividad del servidor.
+    def _responder(self, linea):
+        self.wfile.write(linea.encode() + b"\r\n")
+
+    def handle(self):
+        contar("smtp_conexiones")
+        with self.server.lock:
+            self.server.abiertas.add(self.connection)
+        try:
+            self._sesion()
+        finally:
+            with self.server.lock:
+                self.server.abiertas.discard(self.connection)
+
+    def _sesion(self):
+        self._responder("220 sumidero ESMTP")
+        destinatarios = []
+        while True:
+            try:
+                linea = self.rfile.readline()
+            except OSError:  # cortada con cortar_conexiones()
+                return
+            if not linea:
+                return
+            orden = linea.decode(errors="replace").strip()
+            verbo = orden.upper()
+            if verbo.startswith(("EHLO", "HELO")):
+                self._responder("250-sumidero")
+                self._responder("250 8BITMIME")
+            elif verbo.startswith("MAIL"):
+                destinatarios = []
+                self._responder("250 OK")
+            elif verbo.startswith("RCPT"):
+                direccion = orden.partition(":")[2].strip().strip("<>")
+                if direccion in self.server.rechazados:
+                    self._responder("550 Buzón inexistente")
+                else:
+                    destinatarios.append(direccion)
+                    self._responder("250 OK")
+            elif verbo == "DATA":
+                self._responder("354 Fin con <CRLF>.<CRLF>")
+                while self.rfile.readline().rstrip(b"\r\n") != b".":
+                    pass
+                with self.server.lock:
+                    fallo = self.server.fallos.pop(0) if self.server.fallos else None
+                if fallo == "cortar":
+                    return
+                if fallo:
+                    self._responder(f"{fallo} Fallo simulado")
+                    continue
+                contar("smtp_mensajes")
+                self.server.mensajes.append(destinatarios)
+                self._responder("250 OK")
+            elif verbo == "QUIT":
+                self._responder("221 Adiós")
+                return
+            else:  # NOOP, RSET...
+                self._responder("250 OK")
+
+
+def arrancar_smtp(fallos=(), rechazados=()):
+    servidor = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _ManejadorSMTP)
+    servidor.daemon_threads = True
+    servidor.mensajes = []
+    servidor.fallos = list(fallos)
+    servidor.rechazados = set(rechazados)
+    servidor.lock = threading.Lock()
+    servidor.abiertas = set()
+
+    def cortar_conexiones():
+        with servidor.lock:
+            for conexion in servidor.abiertas:
+                conexion.shutdown(socket.SHUT_RDWR)
+
+    servidor.cortar_conexiones = cortar_conexiones
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+# --- INSTALACIÓN ---
+
+def instalar(libros, calendario):
+    # app.py importa gspread, oauth2client y googleapiclient al primer uso:
+    # basta con dejar módulos falsos en sys.modules antes de arrancar AppTest
+    cliente = ClienteSheets(libros)
+
+    gspread = types.ModuleType("gspread")
+    gspread.authorize = lambda creds: cliente
+
+    service_account = types.ModuleType("oauth2client.service_account")
+    service_account.ServiceAccountCredentials = types.SimpleNamespace(
+        from_json_keyfile_dict=lambda datos, scopes: Credenciales())
+    oauth2client = types.ModuleType("oauth2client")
+    oauth2client.service_account = service_account
+
+    discovery = types.ModuleType("googleapiclient.discovery")
+    discovery.build = lambda *args, **kwargs: calendario
+    googleapiclient = types.ModuleType("googleapiclient")
+    googleapiclient.discovery = discovery
+
+    sys.modules.update({
+        "gspread": gspread,
+        "oauth2client": oauth2client,
+        "oauth2client.service_account": service_account,
+        "googleapiclient": googleapiclient,
+        "googleapiclient.discovery": discovery,
+    })
+    return cliente
@@ -0,0 +1,219 @@
+# Convierte el chat plano de Memoria_Asistente (sheet1: ID, Fecha, Rol,
+# Mensaje) al formato particionado que lee app.py: una hoja Chat_<id> por
+# conversación (Fecha, Rol, Mensaje) más el índice Indice_Chat (ID, Hoja,
+# Libro, Rango, Mensajes, Ultima_Actividad). También mueve las
+# conversaciones frías a un libro de archivo.
+#
+#   python herramientas/migrar_chat.py migrar [--borrar-plano] [--simular]
+#   python herramientas/migrar_chat.py archivar --archivo CLAVE_LIBRO [--dias 90]
+#
+# Migrar con la app parada y su cola de escritura vacía (.asistente/
+# spool_escrituras.jsonl sin filas del chat). El índice se crea al final:
+# hasta entonces la app sigue usando la hoja plana, y sheet1 no se toca salvo
+# con --borrar-plano. Tras migrar, reiniciar la app para que vea el índice.
+# Las credenciales salen de --credenciales (JSON de la cuenta de servicio) o
+# de GOOGLE_CREDENTIALS en .streamlit/secrets.toml.
+#
+# Los nombres y cabeceras deben coincidir con los de app.py (lo comprueba
+# tests/test_migrar_chat.py).
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+LIBRO_MEMORIA = "Memoria_Asistente"
+HOJA_INDICE_CHAT = "Indice_Chat"
+CABECERA_INDICE_CHAT = ["ID", "Hoja", "Libro", "Rango", "Mensajes", "Ultima_Actividad"]
+CABECERA_CONVERSACION = ["Fecha", "Rol", "Mensaje"]
+PREFIJO_HOJA_CONV = "Chat_"
+SCOPES_GOOGLE = ['https://spreadsheets.google.com/feeds',
+                 'https://www.googleapis.com/auth/drive']
+
+ID_SIN_ID = "0"  # filas antiguas guardadas sin ID de conversación
+MAX_PETICIONES = 100  # addSheet/deleteSheet por batchUpdate
+MAX_FILAS_LOTE = 20000  # filas por values.batchUpdate
+
+
+def cargar_credenciales(ruta):
+    if ruta:
+        with open(ruta, encoding="utf-8") as f:
+            return json.load(f)
+    import tomllib
+    raiz = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(raiz, ".streamlit", "secrets.toml"), "rb") as f:
+        return json.loads(tomllib.load(f)["GOOGLE_CREDENTIALS"], strict=False)
+
+
+def conectar(ruta_credenciales):
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(
+        cargar_credenciales(ruta_credenciales), SCOPES_GOOGLE)
+    return gspread.authorize(creds)
+
+
+def con_reintentos(operacion, intentos=6):
+    # Cuota de Sheets (429) y errores 5xx: espera exponencial y reintenta
+    for intento in range(intentos):
+        try:
+            return operacion()
+        except Exception as e:
+            estado = getattr(getattr(e, "response", None), "status_code", None)
+            if estado not in (429, 500, 502, 503) or intento == intentos - 1:
+                raise
+            time.sleep(2 ** intento)
+
+
+def _por_lotes(elementos, tam):
+    for i in range(0, len(elementos), tam):
+        yield elementos[i:i + tam]
+
+
+def crear_hojas(libro, hojas):
+    # hojas: [(titulo, filas, columnas)] en pocas llamadas batchUpdate
+    peticiones = [{"addSheet": {"properties": {
+        "title": titulo, "gridProperties": {"rowCount": max(1, filas), "columnCount": columnas}}}}
+        for titulo, filas, columnas in hojas]
+    for lote in _por_lotes(peticiones, MAX_PETICIONES):
+        con_reintentos(lambda l=lote: libro.batch_update({"requests": l}))
+
+
+def escribir_valores(libro, datos):
+    # datos: [(titulo, valores)] desde A1, agrupados por número de filas
+    lote, filas = [], 0
+    for titulo, valores in datos:
+        lote.append({"range": f"'{titulo}'!A1", "values": valores})
+        filas += len(valores)
+        if filas >= MAX_FILAS_LOTE:
+            con_reintentos(lambda l=lote: libro.values_batch_update(
+                {"valueInputOption": "RAW", "data": l}))
+            lote, filas = [], 0
+    if lote:
+        con_reintentos(lambda: libro.values_batch_update({"valueInputOption": "RAW", "data": lote}))
+
+
+def agrupar_por_conversacion(filas):
+    # [ID, Fecha, Rol, Mensaje] -> {id: [[Fecha, Rol, Mensaje], ...]} en orden
+    conversaciones = {}
+    for fila in filas:
+        fila = list(fila) + [""] * (4 - len(fila))
+        if not any(fila[:4]):
+            continue
+        id_conv = fila[0].strip() or ID_SIN_ID
+        conversaciones.setdefault(id_conv, []).append(fila[1:4])
+    return conversaciones
+
+
+def migrar(cliente, args):
+    libro = cliente.open(LIBRO_MEMORIA)
+    titulos = {ws.title for ws in libro.worksheets()}
+    if HOJA_INDICE_CHAT in titulos:
+        sys.exit(f"{HOJA_INDICE_CHAT} ya existe: el libro ya está particionado.")
+
+    plano = libro.sheet1
+    conversaciones = agrupar_por_conversacion(con_reintentos(plano.get_all_values)[1:])
+    repetidas = [i for i in conversaciones if PREFIJO_HOJA_CONV + i in titulos]
+    if repetidas:
+        sys.exit(f"Ya existen hojas para las conversaciones {repetidas}: bórralas o renómbralas.")
+
+    indice = [CABECERA_INDICE_CHAT]
+    for id_conv, mensajes in sorted(conversaciones.items(), key=lambda x: (not x[0].isdigit(), x[0].zfill(12))):
+        n = len(mensajes)
+        indice.append([id_conv, PREFIJO_HOJA_CONV + id_conv, "", f"A2:C{n + 1}", n, mensajes[-1][0]])
+    total = sum(len(m) for m in conversaciones.values())
+    print(f"{total} mensajes en {len(conversaciones)} conversaciones "
+          f"({len(conversaciones.get(ID_SIN_ID, []))} sin ID van a la conversación {ID_SIN_ID}).")
+    if args.simular:
+        return
+
+    crear_hojas(libro, [(PREFIJO_HOJA_CONV + i, len(m) + 1, len(CABECERA_CONVERSACION))
+                        for i, m in conversaciones.items()])
+    escribir_valores(libro, [(PREFIJO_HOJA_CONV + i, [CABECERA_CONVERSACION] + m)
+                             for i, m in conversaciones.items()])
+    # El índice va al final: su existencia es lo que activa el formato nuevo
+    crear_hojas(libro, [(HOJA_INDICE_CHAT, len(indice), len(CABECERA_INDICE_CHAT))])
+    escribir_valores(libro, [(HOJA_INDICE_CHAT, indice)])
+    print(f"Creadas {len(conversaciones)} hojas y {HOJA_INDICE_CHAT}.")
+
+    if args.borrar_plano:
+        # Deja solo la cabecera: libera las celdas del formato antiguo
+        con_reintentos(lambda: plano.resize(rows=1))
+        print("Hoja plana vaciada (se conserva la cabecera).")
+
+
+def _fecha(texto):
+    try:
+        return datetime.date.fromisoformat(texto.strip()[:10])
+    except ValueError:
+        return None
+
+
+def archivar(cliente, args):
+    libro = cliente.open(LIBRO_MEMORIA)
+    archivo = cliente.open_by_key(args.archivo)
+    hoja_indice = libro.worksheet(HOJA_INDICE_CHAT)
+    limite = datetime.date.today() - datetime.timedelta(days=args.dias)
+
+    frias = []  # (n_fila_indice, id, titulo)
+    for n, fila in enumerate(con_reintentos(hoja_indice.get_all_values)[1:], start=2):
+        fila = list(fila) + [""] * (len(CABECERA_INDICE_CHAT) - len(fila))
+        ultima = _fecha(fila[5])
+        if fila[0] and not fila[2] and ultima and ultima < limite:
+            frias.append((n, fila[0], fila[1] or PREFIJO_HOJA_CONV + fila[0]))
+    print(f"{len(frias)} conversaciones sin actividad desde {limite}.")
+    if args.simular or not frias:
+        return
+
+    ocupadas = {ws.title for ws in archivo.worksheets()} & {t for _, _, t in frias}
+    if ocupadas:
+        sys.exit(f"El archivo ya tiene hojas {sorted(ocupadas)}: elige otro libro de archivo.")
+
+    # 1. Copiar al archivo
+    datos = []
+    for lote in _por_lotes(frias, MAX_PETICIONES):
+        respuesta = con_reintentos(lambda l=lote: libro.values_batch_get(
+            [f"'{t}'!A:C" for _, _, t in l]))
+        for (_, _, titulo), rango in zip(lote, respuesta.get("valueRanges", [])):
+            datos.append((titulo, rango.get("values", [CABECERA_CONVERSACION])))
+    crear_hojas(archivo, [(t, len(v), len(CABECERA_CONVERSACION)) for t, v in datos])
+    escribir_valores(archivo, datos)
+
+    # 2. Apuntar el índice al archivo (desde aquí la app lee de allí)
+    con_reintentos(lambda: hoja_indice.batch_update(
+        [{"range": f"C{n}", "values": [[args.archivo]]} for n, _, _ in frias]))
+
+    # 3. Borrar las hojas del libro activo
+    ids_hoja = {ws.title: ws.id for ws in libro.worksheets()}
+    peticiones = [{"deleteSheet": {"sheetId": ids_hoja[t]}} for _, _, t in frias if t in ids_hoja]
+    for lote in _por_lotes(peticiones, MAX_PETICIONES):
+        con_reintentos(lambda l=lote: libro.batch_update({"requests": l}))
+    print(f"Archivadas {len(frias)} conversaciones en {args.archivo}. Reinicia la app.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Particiona y archiva el chat de Memoria_Asistente")
+    parser.add_argument("--credenciales", help="JSON de la cuenta de servicio")
+    sub = parser.add_subparsers(dest="orden", required=True)
+    p_migrar = sub.add_parser("migrar", help="hoja plana -> una hoja por conversación + índice")
+    p_migrar.add_argument("--borrar-plano", action="store_true",
+                          help="vaciar sheet1 después de migrar")
+    p_migrar.add_argument("--simular", action="store_true", help="solo contar, sin escribir")
+    p_archivar = sub.add_parser("archivar", help="mover conversaciones frías a otro libro")
+    p_archivar.add_argument("--archivo", required=True, help="clave del libro de archivo")
+    p_archivar.add_argument("--dias", type=int, default=90,
+                            help="días sin actividad para considerarla fría")
+    p_archivar.add_argument("--simular", action="store_true", help="solo contar, sin escribir")
+    args = parser.parse_args()
+
+    cliente = conectar(args.credenciales)
+    if args.orden == "migrar":
+        migrar(cliente, args)
+    else:
+        archivar(cliente, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# Apoyo común de los tests. app.py es un script de Streamlit que hace todo
+# al importarse: las pruebas unitarias cargan solo las definiciones que
+# necesitan (cargar_app) y las de extremo a extremo lo ejecutan con AppTest
+# contra los servicios falsos de bench/falsos.py.
+
+import ast
+import builtins
+import os
+import sqlite3
+import sys
+import time
+import types
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUTA_APP = os.path.join(RAIZ, "app.py")
+sys.path.insert(0, os.path.join(RAIZ, "bench"))
+
+
+def _nombre(nodo):
+    if isinstance(nodo, (ast.FunctionDef, ast.ClassDef)):
+        return nodo.name
+    if isinstance(nodo, ast.Assign) and len(nodo.targets) == 1 \
+            and isinstance(nodo.targets[0], ast.Name):
+        return nodo.targets[0].id
+    return None
+
+
+class _Globales(dict):
+    # Globales de lo cargado: un nombre de app.py que no se pidió falla con
+    # un NameError que dice cuál falta, no con un error confuso más adelante
+    def __missing__(self, nombre):
+        if hasattr(builtins, nombre):
+            return getattr(builtins, nombre)
+        raise NameError(f"'{nombre}' no está cargado: añádelo a cargar_app(...)")
+
+
+def _cargar(*nombres, **sustitutos):
+    # Los imports de nivel superior de app.py más las definiciones pedidas,
+    # en el orden del archivo. 'sustitutos' ocupa el lugar de otras
+    # definiciones (una constante más pequeña, un manejador falso...), que
+    # también tienen que existir en app.py.
+    with open(RUTA_APP, encoding="utf-8") as f:
+        arbol = ast.parse(f.read(), RUTA_APP)
+    definidos = {_nombre(n) for n in arbol.body}
+    faltan = (set(nombres) | set(sustitutos)) - definidos
+    if faltan:
+        raise LookupError(f"app.py no define {sorted(faltan)} (¿se renombró o se movió?)")
+    cuerpo = [n for n in arbol.body if isinstance(n, (ast.Import, ast.ImportFrom))
+              or (_nombre(n) in nombres and _nombre(n) not in sustitutos)]
+    espacio = _Globales(sustitutos)
+    exec(compile(ast.Module(body=cuerpo, type_ignores=[]), RUTA_APP, "exec"), espacio)
+    return types.SimpleNamespace(**{n: espacio[n] for n in (*nombres, *sustitutos)})
+
+
+@pytest.fixture
+def cargar_app():
+    return _cargar
+
+
+@pytest.fixture
+def gemini():
+    # Servidores Gemini falsos sin latencia: gemini(**opciones de ConfigGemini)
+    import falsos
+    servidores = []
+
+    def arrancar(**config):
+        servidores.append(falsos.arrancar_gemini(falsos.ConfigGemini(0, 0, **config)))
+        return servidores[-1]
+
+    yield arrancar
+    for servidor in servidores:
+        servidor.shutdown()
+
+
+def url_gemini(servidor):
+    return f"http://127.0.0.1:{servidor.server_port}/v1beta"
+
+
+class Entorno:
+    # app.py con AppTest contra bench/falsos.py, con un DIR_DATOS propio.
+    # reiniciar() vacía st.cache_resource: como un proceso nuevo que
+    # conserva el disco (base SQLite y spool).
+
+    def __init__(self, dir_datos, hojas_memoria, latencia_sheets=0.0):
+        import falsos
+        import correr
+        self.falsos = falsos
+        self.dir_datos = str(dir_datos)
+        self.gemini = falsos.arrancar_gemini(falsos.ConfigGemini(0.01, 0, respuestas=["Respuesta"]))
+        self.libros = {
+            "Memoria_Asistente": falsos.Libro(
+                {**hojas_memoria, "Perfil": [["2025-01-01", "Le gusta el cine"]]}, latencia_sheets),
+            "CLAVE_TAREAS": falsos.Libro({"Tareas": correr.tareas(3)}, latencia_sheets),
+        }
+        self.conectar()
+
+    def conectar(self):
+        self.falsos.instalar(self.libros, self.falsos.ServicioCalendar())
+
+    def desconectar(self):
+        def sin_red(creds):
+            raise ConnectionError("sin red")
+        sys.modules["gspread"].authorize = sin_red
+
+    def reiniciar(self):
+        import streamlit as st
+        st.cache_resource.clear()
+
+    def sesion(self, **estado):
+        from streamlit.testing.v1 import AppTest
+        at = AppTest.from_file(RUTA_APP, default_timeout=30)
+        at.secrets["GEMINI_API_KEY"] = "clave-falsa"
+        at.secrets["GEMINI_BASE_URL"] = f"http://127.0.0.1:{self.gemini.server_port}/v1beta"
+        at.secrets["GEMINI_RPM"] = 100000
+        at.secrets["GOOGLE_CREDENTIALS"] = "{}"
+        at.secrets["SPREADSHEET_ID"] = "CLAVE_TAREAS"
+        at.secrets["DIR_DATOS"] = self.dir_datos
+        for clave, valor in estado.items():
+            at.session_state[clave] = valor
+        return at
+
+    def base(self, sql, parametros=()):
+        con = sqlite3.connect(os.path.join(self.dir_datos, "asistente.db"))
+        try:
+            return con.execute(sql, parametros).fetchall()
+        finally:
+            con.close()
+
+    @staticmethod
+    def esperar(condicion, limite=15):
+        fin = time.monotonic() + limite
+        while not condicion():
+            if time.monotonic() > fin:
+                return False
+            time.sleep(0.1)
+        return True
+
+
+@pytest.fixture
+def entorno(tmp_path):
+    import streamlit as st
+    st.cache_resource.clear()
+    creados = []
+
+    def crear(hojas_memoria, latencia_sheets=0.0):
+        creados.append(Entorno(tmp_path, hojas_memoria, latencia_sheets))
+        return creados[-1]
+
+    yield crear
+    for e in creados:
+        e.gemini.shutdown()
+    st.cache_resource.clear()
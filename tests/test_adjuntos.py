@@ -0,0 +1,77 @@
+import io
+import os
+
+import pytest
+
+from conftest import url_gemini
+
+
+def test_normalizar_imagen_aplica_orientacion_exif(cargar_app):
+    Image = pytest.importorskip("PIL.Image")
+    app = cargar_app("Adjunto", "GestorAdjuntos")
+    gestor = app.GestorAdjuntos.__new__(app.GestorAdjuntos)  # sin cliente Gemini
+
+    # Foto apaisada guardada "de lado", con Orientation = 6 (girar 90°)
+    foto = Image.new("RGB", (400, 200), (200, 30, 30))
+    exif = foto.getexif()
+    exif[0x0112] = 6
+    datos = io.BytesIO()
+    foto.save(datos, format="JPEG", exif=exif.tobytes())
+
+    salida, mime = gestor._normalizar_imagen(datos.getvalue(), "image/jpeg")
+    assert mime == "image/jpeg"
+    assert Image.open(io.BytesIO(salida)).size == (200, 400)
+
+
+def _gestor(cargar_app, servidor):
+    app = cargar_app("Metricas", "LimitadorTokens", "ClienteGemini", "Adjunto", "GestorAdjuntos",
+                     "TIPOS_ADJUNTO", "aviso_adjunto")
+    cliente = app.ClienteGemini(url_gemini(servidor), 6000, backoff_base=0.01)
+    return app, cliente, app.GestorAdjuntos(cliente)
+
+
+def test_un_adjunto_grande_va_por_la_file_api(cargar_app, gemini):
+    servidor = gemini()
+    app, cliente, gestor = _gestor(cargar_app, servidor)
+    datos = os.urandom(2 * 1024 * 1024)
+    adjunto = gestor.preparar("nota.ogg", "audio/ogg", datos)
+
+    partes = gestor.partes(adjunto, "k")
+    uri = partes[0]["file_data"]["file_uri"]
+    assert partes == [{"file_data": {"mime_type": "audio/ogg", "file_uri": uri}}]
+    assert servidor.config.archivos[uri] == ("audio/ogg", datos)
+    assert [ruta for _, ruta in servidor.config.llegadas] == ["/upload/v1beta/files"] * 2
+
+    # Se sube una vez: los turnos siguientes citan la misma URI
+    assert gestor.partes(adjunto, "k") == partes
+    assert len(servidor.config.llegadas) == 2
+    resp = cliente.peticion("POST", "models/falso:generateContent", "k",
+                            json={"contents": [{"parts": [{"text": "¿Qué dice?"}] + partes}]})
+    assert resp.status_code == 200
+
+
+def test_una_subida_fallida_no_se_reintenta_cada_turno(cargar_app, gemini):
+    servidor = gemini(fallos=[403])
+    app, _, gestor = _gestor(cargar_app, servidor)
+    adjunto = gestor.preparar("nota.ogg", "audio/ogg", b"audio" * 100)
+
+    for _ in range(3):
+        partes = gestor.partes(adjunto, "k")
+        assert list(partes[0]) == ["inline_data"]
+    assert len(servidor.config.llegadas) == 1
+
+    # Pasado el plazo se vuelve a intentar
+    adjunto.subida_fallida -= gestor.REINTENTO_SUBIDA + 1
+    assert list(gestor.partes(adjunto, "k")[0]) == ["file_data"]
+
+
+def test_aviso_adjunto_segun_el_tipo(cargar_app):
+    app = cargar_app("Adjunto", "TIPOS_ADJUNTO", "aviso_adjunto")
+
+    def aviso(mime):
+        return app.aviso_adjunto(app.Adjunto("h", "x", mime, b"", 0))
+
+    assert "adjuntó una imagen" in aviso("image/jpeg")
+    assert "adjuntó un PDF" in aviso("application/pdf")
+    assert "adjuntó un audio" in aviso("audio/ogg")
+    assert "adjuntó un archivo" in aviso("text/csv")
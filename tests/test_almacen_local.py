@@ -0,0 +1,100 @@
+# AlmacenLocal (SQLite) con réplica a Sheets, de extremo a extremo: import
+# desde Sheets, réplica de lo escrito sin conexión y reinicios del proceso.
+
+import pytest
+
+import correr
+
+
+def _visibles(at):
+    return [m["content"] for m in at.session_state["messages"] if m["role"] != "system"]
+
+
+def _en_sheets(e, formato, id_conv):
+    memoria = e.libros["Memoria_Asistente"].hojas
+    if formato == "plano":
+        return [f[3] for f in memoria["Hoja 1"].filas[1:] if f and f[0] == id_conv]
+    hoja = memoria.get("Chat_" + id_conv)
+    return [f[2] for f in hoja.filas[1:]] if hoja else []
+
+
+def _hojas(formato, n_filas):
+    if formato == "plano":
+        return {"Hoja 1": correr.historial(n_filas)}
+    return correr.historial_particionado(n_filas)
+
+
+def test_reinicio_importa_la_conversacion_abierta_antes_del_indice(entorno):
+    # Tras un reinicio la base ya tiene los IDs: abrir una conversación aún
+    # no importada no puede darla por vacía mientras el índice no se leyó
+    e = entorno(correr.historial_particionado(200), latencia_sheets=0.05)
+    primera = e.sesion()
+    primera.run()
+    assert not primera.exception
+    assert len(_visibles(primera)) == 40  # última página de la conversación 4
+
+    e.reiniciar()
+    segunda = e.sesion(id_conv_actual="3")
+    segunda.run()
+    assert not segunda.exception
+    assert len(_visibles(segunda)) == 40
+    assert e.base("SELECT count(*) FROM mensajes WHERE conv = '3'") == [(50,)]
+    assert e.base("SELECT importada FROM conversaciones WHERE conv = '3'") == [(1,)]
+
+
+@pytest.mark.parametrize("formato", ["plano", "particionado"])
+def test_lo_escrito_sin_conexion_se_replica_una_vez(entorno, formato):
+    e = entorno(_hojas(formato, 6))
+    base = _en_sheets(e, formato, "1")
+
+    # 1. Con conexión: importa la conversación y replica el turno
+    at = e.sesion()
+    at.run()
+    at.chat_input[0].set_value("hola conectado").run()
+    assert not at.exception
+    assert e.esperar(lambda: len(_en_sheets(e, formato, "1")) == len(base) + 2)
+
+    # 2. Reinicio sin conexión: sigue desde la base local
+    e.reiniciar()
+    e.desconectar()
+    at = e.sesion()
+    at.run()
+    assert "Memoria local" in at.sidebar.warning[0].value
+    assert _visibles(at)[-2:] == ["hola conectado", "Respuesta"]
+    at.chat_input[0].set_value("hola sin conexion").run()
+    assert not at.exception
+    assert e.base("SELECT texto FROM mensajes WHERE replicada = 0 ORDER BY n") == [
+        ("hola sin conexion",), ("Respuesta",)]
+
+    # 3. Reinicio con conexión: sale lo pendiente, en orden y sin duplicar
+    e.reiniciar()
+    e.conectar()
+    at = e.sesion()
+    at.run()
+    at.chat_input[0].set_value("hola de vuelta").run()
+    assert not at.exception
+    esperadas = base + ["hola conectado", "Respuesta", "hola sin conexion", "Respuesta",
+                        "hola de vuelta", "Respuesta"]
+    assert e.esperar(lambda: _en_sheets(e, formato, "1") == esperadas)
+    assert e.base("SELECT count(*) FROM mensajes WHERE replicada = 0") == [(0,)]
+    assert e.base("SELECT count(*) FROM mensajes WHERE conv = '1'") == [(len(esperadas),)]
+
+
+def test_reinicio_no_vuelve_a_importar(entorno):
+    # Una conversación importada no se relee de Sheets tras reiniciar
+    e = entorno(correr.historial_particionado(60))
+    at = e.sesion()
+    at.run()
+    assert len(_visibles(at)) == 10  # conversación 2: 10 mensajes
+
+    e.reiniciar()
+    hoja = e.libros["Memoria_Asistente"].hojas["Chat_2"]
+    lecturas = []
+    leer = hoja.get
+    hoja.get = lambda rango: lecturas.append(rango) or leer(rango)
+    at = e.sesion()
+    at.run()
+    assert not at.exception
+    assert len(_visibles(at)) == 10
+    assert e.base("SELECT count(*) FROM mensajes WHERE conv = '2'") == [(10,)]
+    assert lecturas == []
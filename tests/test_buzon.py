@@ -0,0 +1,117 @@
+import random
+import time
+
+import pytest
+
+import falsos
+
+
+@pytest.fixture
+def buzon(cargar_app, monkeypatch):
+    # BuzonSalida contra el sumidero SMTP; el backoff se anota en vez de dormirlo
+    app = cargar_app("Metricas", "BuzonSalida")
+    pausas = []
+    monkeypatch.setattr(random, "uniform", lambda a, b: pausas.append(b) or 0.0)
+    servidores = []
+
+    def crear(**fallos):
+        servidor = falsos.arrancar_smtp(**fallos)
+        servidores.append(servidor)
+        b = app.BuzonSalida("127.0.0.1", servidor.server_address[1], "yo@ejemplo.com",
+                            "", starttls=False, timeout=5)
+        b.servidor, b.pausas = servidor, pausas
+        return b
+
+    yield crear
+    for servidor in servidores:
+        servidor.shutdown()
+        servidor.server_close()
+
+
+def _esperar(buzon, n):
+    limite = time.monotonic() + 10
+    while time.monotonic() < limite:
+        estado = buzon.estado()
+        if estado["en_cola"] == 0 and len(estado["resultados"]) >= n:
+            return estado["resultados"]
+        time.sleep(0.01)
+    raise AssertionError("el buzón no terminó")
+
+
+def test_varios_destinatarios_en_un_envio(buzon):
+    b = buzon()
+    b.encolar(["ana@ejemplo.com", "luis@ejemplo.com"], "Hola", "Cuerpo")
+    [(_, _, ok, detalle)] = _esperar(b, 1)
+    assert ok and detalle == "Correo enviado"
+    assert b.servidor.mensajes == [["ana@ejemplo.com", "luis@ejemplo.com"]]
+
+
+def test_destinatario_rechazado_no_repite_el_envio(buzon):
+    b = buzon(rechazados=["nadie@ejemplo.com"])
+    b.encolar(["ana@ejemplo.com", "nadie@ejemplo.com"], "Hola", "Cuerpo")
+    [(_, _, ok, detalle)] = _esperar(b, 1)
+    assert ok and "nadie@ejemplo.com" in detalle
+    assert b.servidor.mensajes == [["ana@ejemplo.com"]]
+    assert b.pausas == []
+
+
+def test_reutiliza_la_conexion(buzon):
+    b = buzon()
+    antes = falsos.foto_contadores()["smtp_conexiones"]
+    for i in range(3):
+        b.encolar(["ana@ejemplo.com"], f"Correo {i}", "Cuerpo")
+    _esperar(b, 3)
+    assert falsos.foto_contadores()["smtp_conexiones"] - antes == 1
+    assert len(b.servidor.mensajes) == 3
+
+
+def test_4xx_se_reintenta_con_backoff(buzon):
+    b = buzon(fallos=[451, "cortar"])
+    b.encolar(["ana@ejemplo.com"], "Hola", "Cuerpo")
+    [(_, _, ok, _)] = _esperar(b, 1)
+    assert ok
+    assert b.servidor.mensajes == [["ana@ejemplo.com"]]
+    assert b.pausas == [1.0, 2.0]  # BACKOFF_BASE * 2**intento
+
+
+def test_5xx_es_definitivo(buzon):
+    b = buzon(fallos=[554])
+    b.encolar(["ana@ejemplo.com"], "Hola", "Cuerpo")
+    [(_, _, ok, detalle)] = _esperar(b, 1)
+    assert not ok and "554" in detalle
+    assert b.servidor.mensajes == [] and b.pausas == []
+
+
+def test_agota_los_intentos(buzon):
+    b = buzon(fallos=[421] * 10)
+    b.encolar(["ana@ejemplo.com"], "Hola", "Cuerpo")
+    [(_, _, ok, detalle)] = _esperar(b, 1)
+    assert not ok and "421" in detalle
+    assert len(b.pausas) == b.MAX_INTENTOS - 1
+
+
+def test_reconecta_tras_cierre_por_inactividad(buzon):
+    # Conexión cerrada por el servidor antes de IDLE_MAX: el envío falla,
+    # se reconecta y se reintenta
+    b = buzon()
+    b.encolar(["ana@ejemplo.com"], "Uno", "Cuerpo")
+    _esperar(b, 1)
+    b.servidor.cortar_conexiones()
+    b.encolar(["ana@ejemplo.com"], "Dos", "Cuerpo")
+    resultados = _esperar(b, 2)
+    assert [ok for _, _, ok, _ in resultados] == [True, True]
+    assert len(b.servidor.mensajes) == 2 and len(b.pausas) == 1
+
+
+def test_noop_detecta_el_cierre_sin_fallar_el_envio(buzon):
+    # Pasado IDLE_MAX se comprueba la conexión antes de usarla
+    b = buzon()
+    b.IDLE_MAX = 0
+    b.encolar(["ana@ejemplo.com"], "Uno", "Cuerpo")
+    _esperar(b, 1)
+    b.servidor.cortar_conexiones()
+    antes = falsos.foto_contadores()["smtp_conexiones"]
+    b.encolar(["ana@ejemplo.com"], "Dos", "Cuerpo")
+    _esperar(b, 2)
+    assert falsos.foto_contadores()["smtp_conexiones"] - antes == 1
+    assert len(b.servidor.mensajes) == 2 and b.pausas == []
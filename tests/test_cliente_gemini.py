@@ -0,0 +1,93 @@
+import random
+import threading
+import time
+
+import pytest
+
+from conftest import url_gemini
+
+
+@pytest.fixture
+def app(cargar_app):
+    return cargar_app("Metricas", "LimitadorTokens", "ClienteGemini")
+
+
+def _cliente(app, servidor, **opciones):
+    return app.ClienteGemini(url_gemini(servidor), 6000, **opciones)
+
+
+def _generar(cliente):
+    return cliente.peticion("POST", "models/falso:generateContent", "k",
+                            json={"contents": [{"parts": [{"text": "Hola"}]}]})
+
+
+@pytest.fixture
+def esperas(monkeypatch):
+    # Las pausas del cliente (no las del servidor), con el jitter en su tope
+    anotadas = []
+    dormir = time.sleep
+    principal = threading.current_thread()
+
+    def sleep(segundos):
+        if threading.current_thread() is principal:
+            anotadas.append(round(segundos, 3))
+        dormir(segundos)
+
+    monkeypatch.setattr(time, "sleep", sleep)
+    monkeypatch.setattr(random, "uniform", lambda a, b: b)
+    return anotadas
+
+
+def test_reintenta_5xx_y_cortes_con_backoff_exponencial(app, gemini, esperas):
+    servidor = gemini(fallos=[503, "cortar", 500])
+    resp = _generar(_cliente(app, servidor, backoff_base=0.01))
+    assert resp.status_code == 200
+    assert len(servidor.config.llegadas) == 4
+    assert esperas == [0.01, 0.02, 0.04]
+
+
+def test_devuelve_el_error_al_agotar_los_reintentos(app, gemini, esperas):
+    servidor = gemini(fallos=[502] * 5)
+    resp = _generar(_cliente(app, servidor, max_reintentos=2, backoff_base=0.01))
+    assert resp.status_code == 502
+    assert len(servidor.config.llegadas) == 3
+    assert esperas == [0.01, 0.02]
+
+
+def test_no_reintenta_errores_del_cliente(app, gemini, esperas):
+    servidor = gemini(fallos=[400])
+    assert _generar(_cliente(app, servidor, backoff_base=0.01)).status_code == 400
+    assert len(servidor.config.llegadas) == 1
+    assert esperas == []
+
+
+def test_respeta_retry_after(app, gemini, esperas):
+    servidor = gemini(fallos=[429, 429], retry_after=1)
+    assert _generar(_cliente(app, servidor, backoff_base=0.01)).status_code == 200
+    assert esperas == [1.0, 1.0]
+    (t0, _), (t1, _), (t2, _) = servidor.config.llegadas
+    assert t1 - t0 >= 1.0 and t2 - t1 >= 1.0
+
+
+def test_el_limitador_espacia_las_peticiones(app, gemini):
+    servidor = gemini()
+    cliente = _cliente(app, servidor)
+    cliente.limitador = app.LimitadorTokens(600, rafaga=2)  # 10/s, ráfaga de 2
+    for _ in range(5):
+        assert _generar(cliente).status_code == 200
+    llegadas = [t for t, _ in servidor.config.llegadas]
+    # Las dos primeras salen ya; las demás, una cada ~0,1 s
+    assert llegadas[1] - llegadas[0] < 0.05
+    assert all(b - a >= 0.08 for a, b in zip(llegadas[2:], llegadas[3:]))
+    assert llegadas[-1] - llegadas[0] >= 0.27
+
+
+def test_el_limitador_bloquea_entre_hilos(app):
+    limitador = app.LimitadorTokens(1200, rafaga=1)  # 20/s
+    inicio = time.monotonic()
+    hilos = [threading.Thread(target=limitador.esperar) for _ in range(5)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    assert time.monotonic() - inicio >= 0.18
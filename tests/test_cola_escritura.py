@@ -0,0 +1,120 @@
+import threading
+import time
+
+import falsos
+
+DESTINO = {"titulo": "Hoja 1"}
+
+
+class _Registro:
+    # Lo que ColaEscritura usa de RegistroGoogle, sobre un libro falso
+    def __init__(self, libro):
+        self.libro = libro
+
+    def hoja(self, titulo=None, **_):
+        return self.libro.hojas[titulo]
+
+    def escribir(self, hoja, operacion):
+        return operacion(hoja)
+
+    def con_reconexion(self, operacion):
+        return operacion(self)
+
+
+def _libro():
+    return falsos.Libro({"Hoja 1": [["ID", "Fecha", "Rol", "Mensaje"]]})
+
+
+def _detener(cola):
+    # El hilo de una cola "muerta" no vuelve a tocar el spool
+    cola._enviar = lambda lote: threading.Event().wait()
+
+
+def test_agrupa_las_filas_en_un_append(cargar_app, tmp_path):
+    app = cargar_app("ColaEscritura", "_celdas_leidas")
+    libro = _libro()
+    hoja = libro.hojas["Hoja 1"]
+    lotes = []
+    append = hoja.append_rows
+    hoja.append_rows = lambda filas, **kw: lotes.append(len(filas)) or append(filas, **kw)
+    cola = app.ColaEscritura(str(tmp_path / "spool.jsonl"), _Registro(libro))
+
+    # vaciar() sin nada pendiente no deja forzado el siguiente envío
+    assert cola.vaciar()
+    for i in range(3):
+        cola.encolar(DESTINO, ["1", "2030-01-01", "user", f"m{i}"])
+    time.sleep(0.3)
+    assert lotes == []
+    assert cola.vaciar()
+    assert lotes == [3]
+    assert [f[3] for f in hoja.filas[1:]] == ["m0", "m1", "m2"]
+    assert (tmp_path / "spool.jsonl").read_text() == ""
+
+
+def test_el_spool_se_reenvia_tras_un_reinicio(cargar_app, tmp_path):
+    app = cargar_app("ColaEscritura", "_celdas_leidas")
+    spool = str(tmp_path / "spool.jsonl")
+    caida = _Registro(_libro())
+    caida.con_reconexion = lambda operacion: (_ for _ in ()).throw(ConnectionError("sin red"))
+    vieja = app.ColaEscritura(spool, caida)
+    cola_filas = [["1", "2030-01-01", "user", "a"], ["1", "2030-01-01", "model", "b"]]
+    for fila in cola_filas:
+        vieja.encolar(DESTINO, fila)
+    assert not vieja.vaciar()
+    _detener(vieja)
+
+    libro = _libro()
+    nueva = app.ColaEscritura(spool, _Registro(libro))
+    assert nueva.vaciar()
+    assert libro.hojas["Hoja 1"].filas[1:] == cola_filas
+    assert open(spool).read() == ""
+
+
+def test_un_append_incierto_no_se_duplica(cargar_app, tmp_path):
+    app = cargar_app("ColaEscritura", "_celdas_leidas")
+    spool = str(tmp_path / "spool.jsonl")
+    libro = _libro()
+    hoja = libro.hojas["Hoja 1"]
+    append = hoja.append_rows
+    fallos = []
+
+    def llega_pero_falla(filas, **kw):
+        # La API escribe, pero la respuesta no vuelve
+        respuesta = append(filas, **kw)
+        if not fallos:
+            fallos.append(1)
+            raise TimeoutError("read timeout")
+        return respuesta
+
+    hoja.append_rows = llega_pero_falla
+    vieja = app.ColaEscritura(spool, _Registro(libro))
+    vieja.encolar(DESTINO, ["1", "2030-01-01", "user", "hola"])
+    assert not vieja.vaciar()
+    _detener(vieja)
+
+    # Tras un reinicio la marca sigue en el spool: se comprueba, no se reenvía
+    nueva = app.ColaEscritura(spool, _Registro(libro))
+    nueva.encolar(DESTINO, ["1", "2030-01-01", "model", "qué tal"])
+    assert nueva.vaciar()
+    assert [f[3] for f in hoja.filas[1:]] == ["hola", "qué tal"]
+
+
+def test_un_append_que_no_llego_se_reenvia(cargar_app, tmp_path):
+    app = cargar_app("ColaEscritura", "_celdas_leidas")
+    libro = _libro()
+    hoja = libro.hojas["Hoja 1"]
+    append = hoja.append_rows
+    fallos = []
+
+    def falla_una_vez(filas, **kw):
+        if not fallos:
+            fallos.append(1)
+            raise ConnectionError("reset")
+        return append(filas, **kw)
+
+    hoja.append_rows = falla_una_vez
+    cola = app.ColaEscritura(str(tmp_path / "spool.jsonl"), _Registro(libro))
+    cola.encolar(DESTINO, ["1", "2030-01-01", "user", "hola"])
+    assert not cola.vaciar()
+    assert cola.vaciar()
+    assert [f[3] for f in hoja.filas[1:]] == ["hola"]
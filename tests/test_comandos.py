@@ -0,0 +1,98 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+PARSER = ("CmdCalendario", "CmdMemoria", "CmdEmail", "CmdTarea", "PATRON_CMD", "_fecha_iso",
+          "_validar_calendario", "_validar_memoria", "_validar_email", "_validar_tarea",
+          "VALIDADORES_CMD", "extraer_comandos")
+
+
+def test_extraer_comandos_en_una_pasada(cargar_app):
+    app = cargar_app(*PARSER)
+    texto = ("Listo, lo agendo.\n"
+             "CALENDAR_CMD: Dentista | 2030-01-02 10: 30 | 2030-01-02 11:00 | Llevar placas\n"
+             "TAREA_CMD: AGREGAR | Informe | Redactar | 2030-01-05\n"
+             "TAREA_CMD: check | 5 | 2\n"
+             "Y te escribo a Ana.\n"
+             "EMAIL_CMD: ana@ejemplo.com | Reunión | Hola Ana,\nnos vemos a las 3 | sala B\n"
+             "MEMORIA_CMD: Prefiere reuniones por la tarde")
+    visible, comandos, invalidos = app.extraer_comandos(texto)
+
+    assert visible == "Listo, lo agendo.\n\n\n\nY te escribo a Ana."
+    assert invalidos == []
+    assert comandos == [
+        app.CmdCalendario("Dentista", "2030-01-02T10:30:00", "2030-01-02T11:00:00", "Llevar placas"),
+        app.CmdTarea("AGREGAR", ["Informe", "Redactar", "2030-01-05"]),
+        app.CmdTarea("CHECK", [5, 2]),
+        # El cuerpo del correo llega hasta el siguiente comando, con sus '|'
+        app.CmdEmail("ana@ejemplo.com", "Reunión", "Hola Ana,\nnos vemos a las 3 | sala B"),
+        app.CmdMemoria("Prefiere reuniones por la tarde"),
+    ]
+
+
+@pytest.mark.parametrize("crudo, motivo", [
+    ("CALENDAR_CMD: Cita | mañana | luego", "Invalid isoformat"),
+    ("CALENDAR_CMD: Cita | 2030-01-02 10:00", "faltan Título"),
+    ("EMAIL_CMD: ana | Hola | Texto", "destinatario no válido"),
+    ("TAREA_CMD: CHECK | 1 | 3", "fuera de rango"),
+    ("TAREA_CMD: CHECK | cinco | 3", "invalid literal"),
+    ("TAREA_CMD: BORRAR | 4", "acción desconocida"),
+])
+def test_extraer_comandos_separa_los_invalidos(cargar_app, crudo, motivo):
+    app = cargar_app(*PARSER)
+    visible, comandos, invalidos = app.extraer_comandos(f"Hecho.\n{crudo}\nTAREA_CMD: LISTAR")
+    assert visible == "Hecho."
+    assert comandos == [app.CmdTarea("LISTAR", [])]
+    assert len(invalidos) == 1 and invalidos[0][0] == crudo
+    assert motivo in invalidos[0][1]
+
+
+def test_ejecutar_comandos_ordena_carriles_y_paraleliza_el_resto(cargar_app):
+    pool = ThreadPoolExecutor(4)
+    manejadores = {}
+    app = cargar_app("Metricas", *PARSER, "MutacionTarea", "MUTACIONES_TAREA", "CmdLoteTareas",
+                     "agrupar_mutaciones", "CmdLoteCalendario", "agrupar_eventos",
+                     "_carril", "_ejecutar_uno", "ejecutar_comandos",
+                     MANEJADORES_CMD=manejadores, obtener_pool_comandos=lambda: pool)
+    hechos = []
+
+    def manejador(nombre, pausa):
+        def ejecutar(cmd, ctx):
+            time.sleep(pausa)
+            hechos.append((nombre, threading.current_thread().name))
+            return f"[{nombre}]"
+        return ejecutar
+
+    manejadores.update({
+        app.CmdTarea: lambda cmd, ctx: manejador(cmd.accion, 0.1)(cmd, ctx),
+        app.CmdLoteTareas: lambda lote, ctx: manejador(
+            "+".join(c.accion for c in lote.comandos), 0)(lote, ctx),
+        app.CmdEmail: manejador("email", 0.3),
+        app.CmdLoteCalendario: manejador("eventos", 0.3),
+        app.CmdMemoria: lambda cmd, ctx: 1 / 0,
+    })
+    _, comandos, invalidos = app.extraer_comandos(
+        "CALENDAR_CMD: A | 2030-01-01 10:00 | 2030-01-01 11:00\n"
+        "TAREA_CMD: AGREGAR | Informe | 2030-01-05\n"
+        "TAREA_CMD: CHECK | 5 | 1\nTAREA_CMD: EXTENDER | 5\n"
+        "EMAIL_CMD: ana@ejemplo.com | Hola | Texto\n"
+        "CALENDAR_CMD: B | 2030-01-02 10:00 | 2030-01-02 11:00\n"
+        "TAREA_CMD: LISTAR\nMEMORIA_CMD: Algo\nTAREA_CMD: CHECK | 1 | 1")
+    metricas = app.Metricas()
+
+    inicio = time.monotonic()
+    salida = app.ejecutar_comandos(comandos, invalidos, {"metricas": metricas, "traza": None})
+    duracion = time.monotonic() - inicio
+
+    # Resultados en el orden de los comandos (los eventos, en el lugar del
+    # primero; las mutaciones seguidas, en un lote)
+    assert salida.startswith("[eventos][AGREGAR][CHECK+EXTENDER][email][LISTAR]\n\n❌ Error")
+    assert "⚠️ Comando ignorado (fila o subtarea fuera de rango): TAREA_CMD: CHECK | 1 | 1" in salida
+    # Las tareas van en orden en un mismo carril; correo y eventos, a la vez
+    tareas = [n for n, _ in hechos if n in ("AGREGAR", "CHECK+EXTENDER", "LISTAR")]
+    assert tareas == ["AGREGAR", "CHECK+EXTENDER", "LISTAR"]
+    assert len({hilo for n, hilo in hechos if n in ("AGREGAR", "LISTAR")}) == 1
+    assert duracion < 0.55
+    pool.shutdown()
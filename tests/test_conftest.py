@@ -0,0 +1,13 @@
+import pytest
+
+
+def test_cargar_app_falla_claro_si_falta_un_nombre(cargar_app):
+    with pytest.raises(LookupError, match="no_existe"):
+        cargar_app("normalizar_consulta", "no_existe")
+    with pytest.raises(LookupError, match="OTRA"):
+        cargar_app("normalizar_consulta", OTRA=1)
+    # clave_respuesta usa normalizar_consulta, que no se pidió
+    app = cargar_app("MIN_PALABRAS_RESPUESTA", "CONTEXTO_RESPUESTA", "PATRON_CONSULTA_HORA",
+                     "_contexto_respuesta", "clave_respuesta")
+    with pytest.raises(NameError, match="normalizar_consulta"):
+        app.clave_respuesta("qué tengo pendiente", "m", "m", None, None, "1", [], None)
@@ -0,0 +1,50 @@
+import falsos
+
+CABECERA = ["ID", "Fecha", "Rol", "Mensaje"]
+
+
+def _hoja(filas):
+    return falsos.Libro({"Hoja 1": [CABECERA] + filas}).hojas["Hoja 1"]
+
+
+def _lecturas():
+    return falsos.foto_contadores()["sheets_lectura"]
+
+
+def test_sincronizar_lee_solo_lo_nuevo(cargar_app):
+    app = cargar_app("EspejoChat")
+    hoja = _hoja([["1", "f1", "user", "hola"], ["1", "f2", "model", "qué tal"]])
+    espejo = app.EspejoChat()
+    assert not espejo.sincronizado()
+
+    espejo.sincronizar(hoja)
+    assert espejo.sincronizado() and espejo.ids() == ["1"]
+    assert espejo.pagina("1", 10) == ([("user", "hola"), ("model", "qué tal")], None)
+
+    # Dentro del intervalo no se vuelve a leer (salvo que se fuerce)
+    antes = _lecturas()
+    hoja.append_rows([["2", "f3", "user", "otra"], ["1", "f4", "user", "sigo"]])
+    espejo.sincronizar(hoja)
+    assert _lecturas() == antes and espejo.ids() == ["1"]
+
+    # Forzada: una sola lectura (testigo + filas nuevas)
+    espejo.sincronizar(hoja, forzar=True)
+    assert _lecturas() == antes + 1
+    assert espejo.ids() == ["1", "2"]
+    assert espejo.historial("1")[-1] == ("f4", "user", "sigo")
+    assert espejo.pagina("1", 2) == ([("model", "qué tal"), ("user", "sigo")], 1)
+
+
+def test_sincronizar_relee_todo_si_la_hoja_cambio_por_debajo(cargar_app):
+    app = cargar_app("EspejoChat")
+    hoja = _hoja([["1", "f1", "user", "hola"], ["1", "f2", "model", "qué tal"]])
+    espejo = app.EspejoChat()
+    espejo.sincronizar(hoja)
+
+    # Alguien borró una fila a mano: la última conocida ya no coincide
+    del hoja.filas[1]
+    hoja.append_rows([["3", "f5", "user", "nueva"]])
+    espejo.sincronizar(hoja, forzar=True)
+    assert espejo.ids() == ["1", "3"]
+    assert espejo.historial("1") == [("f2", "model", "qué tal")]
+    assert espejo.historial("3") == [("f5", "user", "nueva")]
@@ -0,0 +1,91 @@
+import random
+
+import pytest
+
+import falsos
+
+NOMBRES = ("_cuerpo_evento", "ESTADOS_REINTENTO_CALENDARIO", "MOTIVOS_CUOTA_CALENDARIO",
+           "_estado_error_google", "_motivo_error_google", "_reintentable_calendario",
+           "_es_handle_obsoleto", "crear_eventos_calendario", "RegistroGoogle", "Metricas")
+
+
+class _Registro:
+    # Lo que crear_eventos_calendario usa de RegistroGoogle, con el
+    # con_reconexion de verdad
+    def __init__(self, app, servicio):
+        self._app = app
+        self.servicio = servicio
+        self.metricas = app.Metricas()
+        self.reconexiones = 0
+
+    def calendario(self):
+        return self.servicio
+
+    def invalidar(self):
+        self.reconexiones += 1
+
+    def con_reconexion(self, operacion):
+        return self._app.RegistroGoogle.con_reconexion(self, operacion)
+
+
+@pytest.fixture
+def crear(cargar_app, monkeypatch):
+    app = cargar_app(*NOMBRES, MAX_LOTE_CALENDARIO=2, TU_EMAIL_GMAIL="yo@ejemplo.com")
+    esperas = []
+    monkeypatch.setattr(random, "uniform", lambda a, b: esperas.append(b) or 0.0)
+
+    def crear(n, **fallos):
+        registro = _Registro(app, falsos.ServicioCalendar(**fallos))
+        eventos = [(f"Evento {i}", f"2026-01-0{i + 1}T10:00:00", f"2026-01-0{i + 1}T11:00:00")
+                   for i in range(n)]
+        resultados = app.crear_eventos_calendario(registro, eventos)
+        return resultados, registro, esperas
+
+    return crear
+
+
+def _resumenes(servicio):
+    return [e["summary"] for e in servicio.eventos]
+
+
+def test_varios_lotes_en_orden(crear):
+    antes = falsos.foto_contadores()["calendar_batch"]
+    resultados, registro, _ = crear(5)
+    assert [ok for ok, _ in resultados] == [True] * 5
+    assert [link for _, link in resultados] == [
+        f"https://calendar.falso/evento/{i}" for i in range(1, 6)]
+    assert falsos.foto_contadores()["calendar_batch"] - antes == 3  # lotes de 2
+    assert len({e["id"] for e in registro.servicio.eventos}) == 5
+
+
+def test_reconexion_no_repite_los_lotes_hechos(crear):
+    # 401 en el segundo lote: se reconecta y se reenvía solo ese
+    resultados, registro, _ = crear(4, fallos_lote=[None, 401])
+    assert [ok for ok, _ in resultados] == [True] * 4
+    assert _resumenes(registro.servicio) == [f"Evento {i}" for i in range(4)]
+    assert registro.reconexiones == 1
+
+
+def test_respuesta_perdida_no_duplica(crear):
+    # El lote se hizo pero la conexión se cortó antes de la respuesta: el
+    # reenvío recibe 409 por los ids y se dan por creados
+    resultados, registro, _ = crear(2, fallos_lote=["cortar"])
+    assert _resumenes(registro.servicio) == ["Evento 0", "Evento 1"]
+    assert resultados == [(True, "https://calendar.falso/evento/1"),
+                          (True, "https://calendar.falso/evento/2")]
+
+
+def test_403_solo_se_reintenta_si_es_de_cuota(crear):
+    resultados, registro, esperas = crear(2, fallos=[(403, "rateLimitExceeded"),
+                                                     (403, "forbidden")])
+    (ok0, _), (ok1, error1) = resultados
+    assert ok0 and not ok1 and "403" in error1
+    assert _resumenes(registro.servicio) == ["Evento 0"]
+    assert len(esperas) == 1
+
+
+def test_agota_los_reintentos(crear):
+    resultados, registro, esperas = crear(1, fallos=[(503, "backendError")] * 5)
+    [(ok, error)] = resultados
+    assert not ok and "503" in error
+    assert registro.servicio.eventos == [] and len(esperas) == 2
@@ -0,0 +1,144 @@
+import types
+
+import pytest
+
+
+class _Rerun(Exception):
+    pass
+
+
+class _Estado(dict):
+    # st.session_state: dict con acceso por atributo
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+
+class _St:
+    # Sustituto de streamlit para llamar a un fragmento fuera de un run:
+    # anota lo que pinta; button/selectbox devuelven lo que diga el test
+    def __init__(self, **estado):
+        self.session_state = _Estado(estado)
+        self.pintado = []
+        self.pulsados = set()
+        self.fragmentos = []
+
+    def __getattr__(self, nombre):
+        return lambda *args, **kwargs: self.pintado.append((nombre, args[0] if args else None))
+
+    def button(self, etiqueta, **_):
+        self.pintado.append(("button", etiqueta))
+        return etiqueta in self.pulsados
+
+    def selectbox(self, etiqueta, options, index=0, **_):
+        return options[index]
+
+    def fragment(self, func, run_every=None):
+        self.fragmentos.append((func.__name__, run_every))
+        return func
+
+    def rerun(self):
+        raise _Rerun
+
+    def textos(self, tipo):
+        return [texto for nombre, texto in self.pintado if nombre == tipo]
+
+
+def _fragmento(app, nombre, st):
+    # La función de dentro del @st.fragment, con el st falso en sus globales.
+    # Los globales son solo lo cargado: si el fragmento usa algo del run
+    # completo que no recibe como argumento, falla con NameError.
+    funcion = getattr(app, nombre)
+    funcion = getattr(funcion, "__wrapped__", funcion)
+    funcion.__globals__["st"] = st
+    return funcion
+
+
+class _Cola:
+    def __init__(self, pendientes=0, error=None):
+        self.pendientes, self.error = pendientes, error
+
+    def estado(self):
+        return {"pendientes": self.pendientes, "ultimo_error": self.error}
+
+
+@pytest.fixture
+def barra(cargar_app):
+    def cargar(en_cola=0, resultados=()):
+        buzon = types.SimpleNamespace(
+            estado=lambda: {"en_cola": en_cola, "resultados": list(resultados)})
+        return cargar_app("INTERVALO_BARRA_ESTADO", "trabajo_pendiente", "barra_estado",
+                          "pintar_barra_estado", obtener_buzon=lambda: buzon)
+    return cargar
+
+
+def test_barra_estado_sin_trabajo_no_se_refresca(barra):
+    app = barra()
+    st = _St(id_conv_actual="2")
+    _fragmento(app, "pintar_barra_estado", st)
+    _fragmento(app, "barra_estado", st)
+    app.pintar_barra_estado("Conectada", _Cola())
+    assert st.fragmentos == [("barra_estado", None)]
+    assert st.textos("success") == ["🧠 Memoria: Conv. 2"]
+    assert st.textos("caption") == ["💾 Todo guardado"]
+    assert st.textos("button") == ["🔄 Actualizar estado"]
+
+
+def test_barra_estado_se_refresca_mientras_hay_trabajo(barra):
+    app = barra(en_cola=1)
+    st = _St(id_conv_actual="1")
+    _fragmento(app, "pintar_barra_estado", st)
+    _fragmento(app, "barra_estado", st)
+    app.pintar_barra_estado("Local", _Cola(pendientes=3, error="429"))
+    assert st.fragmentos == [("barra_estado", app.INTERVALO_BARRA_ESTADO)]
+    assert st.textos("info") == ["📤 Enviando 1 correo(s)..."]
+    assert "3 fila(s) sin guardar" in st.textos("warning")[-1]
+    assert st.textos("button") == []
+
+
+def test_barra_estado_deja_de_refrescarse_al_terminar(barra):
+    # Refresco del fragmento solo, con el trabajo ya hecho: pide un run
+    # completo para montarse sin temporizador
+    app = barra(resultados=[(1, ["ana@ejemplo.com"], True, "Correo enviado")])
+    st = _St(id_conv_actual="1", barra_estado_viva=True)
+    with pytest.raises(_Rerun):
+        _fragmento(app, "barra_estado", st)("Conectada", _Cola())
+    assert st.session_state.barra_estado_viva is False
+    assert st.textos("caption")[0] == "✅ Correo enviado a ana@ejemplo.com"
+
+
+def test_barra_ajustes_solo_usa_session_state(cargar_app):
+    app = cargar_app("barra_ajustes", "adjunto_actual",
+                     obtener_gestor_adjuntos=lambda: pytest.fail("sin archivo no se prepara"))
+    st = _St(archivo=None)
+    _fragmento(app, "barra_ajustes", st)()
+    assert [nombre for nombre, _ in st.pintado] == [
+        "header", "radio", "toggle", "write", "file_uploader"]
+
+
+class _Chat:
+    def ids(self):
+        return ["1", "2", "3"]
+
+
+def test_barra_conversaciones_con_sus_argumentos(cargar_app):
+    app = cargar_app("barra_conversaciones", "MAX_MENSAJES_SESION", "cargar_anteriores",
+                     metricas=cargar_app("Metricas", "Traza").Metricas())
+    st = _St(id_conv_actual="2")
+    conversaciones = _fragmento(app, "barra_conversaciones", st)
+    conversaciones(_Chat(), {"cursor": None, "messages": []})
+    assert st.session_state.id_conv_actual == "2"
+    st.pulsados.add("➕ Nueva Conversación")
+    with pytest.raises(_Rerun):
+        conversaciones(_Chat(), {"cursor": None, "messages": []})
+    assert st.session_state.id_conv_actual == "4"
+
+
+def test_panel_chat_solo_usa_su_contexto(cargar_app):
+    vistos = []
+    app = cargar_app("panel_chat", "Traza", metricas=cargar_app("Metricas", "Traza").Metricas(),
+                     turno_chat=lambda ctx: vistos.append(ctx) or "hola")
+    st = _St()
+    ctx = {"chat_memoria": None, "cola": None}
+    assert _fragmento(app, "panel_chat", st)(ctx) == "hola"
+    assert vistos == [ctx]
+    assert st.session_state.traza_chat.llamadas is not None
@@ -0,0 +1,45 @@
+DATOS = [
+    "2024-01-01 Se llama Juan Martín",
+    "2024-01-02 Es alérgico a la penicilina",
+    "2024-01-03 Trabaja en ERH como gerente de proyectos",
+    "2024-01-04 Su perro se llama Toby",
+    "2024-01-05 Prefiere las reuniones por la tarde",
+    "2024-01-06 Los proyectos de ERH se revisan los lunes",
+]
+
+
+def _indice(cargar_app):
+    app = cargar_app("TOP_K_PERFIL", "STOPWORDS_ES", "tokenizar", "IndicePerfil")
+    indice = app.IndicePerfil()
+    indice.cargar(DATOS)
+    return app, indice
+
+
+def test_tokenizar_normaliza_tildes_plurales_y_stopwords(cargar_app):
+    app = cargar_app("STOPWORDS_ES", "tokenizar")
+    assert app.tokenizar("¿Qué reunión tengo con los Proyectos?") == ["reunion", "proyecto"]
+    assert app.tokenizar("Las reuniones de 2024 en 3 días") == ["reunion", "2024", "3", "dia"]
+
+
+def test_buscar_ordena_por_relevancia_y_completa_con_recientes(cargar_app):
+    app, indice = _indice(cargar_app)
+    # Dos datos con "proyectos"; el que además dice "gerente" va primero
+    resultado = indice.buscar("¿Quién es el gerente de proyectos?")
+    assert resultado[:2] == [DATOS[2], DATOS[5]]
+    # Luego los más recientes que no salieron, hasta 'recientes' más
+    assert resultado[2:] == [DATOS[4], DATOS[3], DATOS[1]]
+    assert indice.buscar("reunión", k=1) == [DATOS[4]]
+
+
+def test_buscar_sin_aciertos_da_los_recientes(cargar_app):
+    app, indice = _indice(cargar_app)
+    assert indice.buscar("clima de mañana") == [DATOS[5], DATOS[4], DATOS[3]]
+    assert app.IndicePerfil().buscar("algo") == []
+
+
+def test_agregar_queda_buscable_y_sube_la_version(cargar_app):
+    app, indice = _indice(cargar_app)
+    version = indice.version
+    indice.agregar("2024-02-01 Su gata se llama Mora")
+    assert indice.version == version + 1 and len(indice) == 7
+    assert indice.buscar("gata")[0] == "2024-02-01 Su gata se llama Mora"
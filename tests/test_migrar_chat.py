@@ -0,0 +1,30 @@
+import importlib.util
+import os
+
+from conftest import RAIZ
+
+COMPARTIDAS = ("LIBRO_MEMORIA", "HOJA_INDICE_CHAT", "CABECERA_INDICE_CHAT",
+               "CABECERA_CONVERSACION", "PREFIJO_HOJA_CONV")
+
+
+def _migrar_chat():
+    ruta = os.path.join(RAIZ, "herramientas", "migrar_chat.py")
+    spec = importlib.util.spec_from_file_location("migrar_chat", ruta)
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+def test_nombres_y_cabeceras_iguales_que_app(cargar_app):
+    # migrar_chat.py copia estos valores de app.py: si uno cambia, la
+    # herramienta escribiría hojas que la app no encuentra
+    app = cargar_app(*COMPARTIDAS)
+    migrar = _migrar_chat()
+    for nombre in COMPARTIDAS:
+        assert getattr(migrar, nombre) == getattr(app, nombre), nombre
+
+
+def test_scopes_incluidos_en_los_de_app(cargar_app):
+    # La herramienta solo toca Sheets/Drive: le basta un subconjunto
+    app = cargar_app("SCOPES_GOOGLE")
+    assert set(_migrar_chat().SCOPES_GOOGLE) <= set(app.SCOPES_GOOGLE)
@@ -0,0 +1,78 @@
+import falsos
+
+CABECERA = ["Tarea"] + [f"Subtarea {n}" for n in range(1, 16)] + ["", "Estado", "Fecha"]
+
+
+def _fila(titulo, subs, estado="Pendiente", fecha="2030-01-01"):
+    return [titulo] + subs + [""] * (15 - len(subs)) + ["", estado, fecha]
+
+
+def _modelo(cargar_app, filas):
+    app = cargar_app("N_SUBTAREAS", "COL_ESTADO", "COL_FECHA", "Tarea", "_tarea_desde_fila",
+                     "_celda_a1", "ModeloTareas")
+    hoja = falsos.Libro({"Tareas": [CABECERA] + filas}).hojas["Tareas"]
+    modelo = app.ModeloTareas()
+    modelo.REVISION_CADA = 0  # revisar la revisión en cada asegurar()
+    return app, hoja, modelo
+
+
+def _lecturas():
+    return falsos.foto_contadores()["sheets_lectura"]
+
+
+def test_carga_una_vez_y_cachea_la_tabla(cargar_app):
+    _, hoja, modelo = _modelo(cargar_app, [
+        _fila("Informe", ["TRUE", "FALSE"]), _fila("Viaje", ["FALSE", "", "TRUE"])])
+    antes = _lecturas()
+    modelo.asegurar(hoja)
+    modelo.asegurar(hoja)
+    assert _lecturas() == antes + 1  # sin cambios: solo la revisión, no la hoja
+
+    tabla = modelo.tabla_markdown()
+    assert "| **2** | Informe | ✅ ⬜  | **50%** |" in tabla
+    # La subtarea 2 de "Viaje" está vacía: no existe y no cuenta
+    assert "| **3** | Viaje | ⬜ ✅  | **50%** |" in tabla
+    assert modelo.tabla_markdown() is tabla
+
+
+def test_los_cambios_propios_se_aplican_en_el_sitio(cargar_app):
+    _, hoja, modelo = _modelo(cargar_app, [_fila("Informe", ["TRUE", "FALSE"])])
+    modelo.asegurar(hoja)
+    version = modelo.version
+
+    # AGREGAR: la fila nueva va detrás de la última, sin releer la hoja
+    fila = _fila("Compras", ["FALSE"])
+    hoja.append_rows([fila])
+    assert modelo.agregar(fila) == 3
+    # CHECK / EXTENDER / ESTADO terminan en reemplazar() de la fila entera
+    hoja.batch_update([{"range": "C2", "values": [[True]]}])
+    modelo.reemplazar(2, _fila("Informe", ["TRUE", "TRUE", "FALSE"]))
+    assert modelo.version == version + 2
+    assert modelo.valores(3)[0] == "Compras" and modelo.valores(9) == [""] * 19
+
+    # La revisión cambió por nuestras escrituras: se adopta sin descargar
+    antes = _lecturas()
+    modelo.asegurar(hoja)
+    assert _lecturas() == antes
+    tabla = modelo.tabla_markdown()
+    assert "| **2** | Informe | ✅ ✅ ⬜  | **66%** |" in tabla
+    assert "| **3** | Compras | ⬜  | **0%** |" in tabla
+
+
+def test_una_edicion_ajena_recarga_la_hoja(cargar_app):
+    _, hoja, modelo = _modelo(cargar_app, [_fila("Informe", ["FALSE"])])
+    modelo.asegurar(hoja)
+    version = modelo.version
+    hoja.update_cell(2, 1, "Informe final")  # editada a mano en Sheets
+
+    modelo.asegurar(hoja)
+    assert modelo.version == version + 1
+    assert "| **2** | Informe final |" in modelo.tabla_markdown()
+
+
+def test_la_carga_incluye_lo_que_espera_en_la_cola(cargar_app):
+    _, hoja, modelo = _modelo(cargar_app, [_fila("Informe", ["FALSE", "FALSE"])])
+    modelo.asegurar(hoja, pendientes=[_fila("Nueva", ["FALSE"])],
+                    celdas=[{"range": "C2", "values": [[True]]}])
+    assert modelo.valores(2)[2] == "TRUE"
+    assert modelo.valores(3)[0] == "Nueva"
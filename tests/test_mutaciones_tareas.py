@@ -0,0 +1,121 @@
+import pytest
+
+import falsos
+
+CABECERA = ["Tarea"] + [f"Subtarea {n}" for n in range(1, 16)] + ["", "Estado", "Fecha"]
+NOMBRES = ("N_SUBTAREAS", "COL_ESTADO", "COL_FECHA", "Tarea", "_tarea_desde_fila", "_celda_a1",
+           "ModeloTareas", "MutacionTarea", "_col_letra", "_aplicar_mutaciones",
+           "_hoja_para_mutar", "_operar_tareas")
+
+
+def _fila(titulo, subs, estado="Pendiente"):
+    return [titulo] + subs + [""] * (15 - len(subs)) + ["", estado, "2030-01-01"]
+
+
+class _AlmacenTareas:
+    # TareasSQLite sin base: el modelo solo necesita que exista
+    def cargar(self):
+        return None
+
+    def reemplazar(self, revision, filas):
+        pass
+
+    def guardar(self, n_fila, fila):
+        pass
+
+    def fijar_revision(self, revision):
+        pass
+
+
+class _Cola:
+    def __init__(self, vacia=True):
+        self.vacia = vacia
+        self.celdas = []
+
+    def vaciar(self):
+        return self.vacia
+
+    def estado(self):
+        return {"ultimo_error": None if self.vacia else "APIError: 503"}
+
+    def encolar_celdas(self, destino, celdas):
+        self.celdas += celdas
+
+    def pendientes(self, destino):
+        return []
+
+    def pendientes_celdas(self, destino):
+        return []
+
+
+def _preparar(cargar_app, local=False):
+    app = cargar_app(*NOMBRES)
+    filas = [_fila("Informe", ["TRUE", "FALSE"]),
+             _fila("Lleno", ["FALSE"] * 15),
+             _fila("Viaje", ["FALSE", "", "FALSE"])]
+    hoja = falsos.Libro({"Tareas": [CABECERA] + filas}).hojas["Tareas"]
+    modelo = app.ModeloTareas(_AlmacenTareas() if local else None)
+    modelo.asegurar(hoja)
+    return app, hoja, modelo
+
+
+def test_aplicar_mutaciones_una_lectura_y_una_escritura(cargar_app):
+    app, hoja, modelo = _preparar(cargar_app)
+    M = app.MutacionTarea
+    antes = falsos.foto_contadores()
+    lineas = app._aplicar_mutaciones(hoja, [
+        M("CHECK", 2, 2), M("CHECK", 2, 1), M("CHECK", 4, 2), M("CHECK", 9, 1),
+        M("EXTENDER", 4), M("EXTENDER", 3), M("ESTADO", 2, valor="En curso"),
+    ], modelo)
+    despues = falsos.foto_contadores()
+
+    assert lineas == [
+        "Fila 2: subtarea 2 marcada.",
+        "Fila 2: la subtarea 1 ya estaba marcada.",
+        "⚠️ Fila 4: la subtarea 2 no existe.",
+        "⚠️ Fila 9: no existe esa tarea.",
+        "Fila 4: subtarea 2 agregada.",
+        "⚠️ Fila 3: máximo de 15 subtareas alcanzado.",
+        "Fila 2: estado 'En curso'.",
+    ]
+    assert despues["sheets_lectura"] - antes["sheets_lectura"] == 1
+    assert despues["sheets_escritura"] - antes["sheets_escritura"] == 1
+    assert hoja.filas[1][:3] == ["Informe", "TRUE", "TRUE"] and hoja.filas[1][17] == "En curso"
+    assert hoja.filas[3][:4] == ["Viaje", "FALSE", "FALSE", "FALSE"]
+    # El modelo queda como la hoja
+    assert modelo.valores(2) == hoja.filas[1] and modelo.valores(4) == hoja.filas[3]
+
+
+def test_marcar_todo_no_cambia_el_estado(cargar_app):
+    app, hoja, modelo = _preparar(cargar_app)
+    app._aplicar_mutaciones(hoja, [app.MutacionTarea("CHECK", 2, 2)], modelo)
+    assert hoja.filas[1][17] == "Pendiente"
+
+
+def test_con_almacen_local_se_comprueba_contra_la_hoja(cargar_app):
+    app, hoja, modelo = _preparar(cargar_app, local=True)
+    cola = _Cola()
+    # Alguien marcó a mano la subtarea 1 de "Viaje"; la copia local no lo sabe
+    hoja.update_cell(4, 2, True)
+    lineas = app._aplicar_mutaciones(
+        hoja, [app.MutacionTarea("CHECK", 4, 1), app.MutacionTarea("CHECK", 4, 3)],
+        modelo, cola, {"titulo": "Tareas"})
+    assert lineas == ["Fila 4: la subtarea 1 ya estaba marcada.", "Fila 4: subtarea 3 marcada."]
+    assert cola.celdas == [{"range": "D4", "values": [[True]]}]
+    assert modelo.valores(4)[1:4] == ["TRUE", "", "TRUE"]
+
+
+def test_si_la_cola_no_se_vacia_se_avisa(cargar_app):
+    app, hoja, modelo = _preparar(cargar_app, local=True)
+    # Con almacén local: se sigue contra la copia local, con aviso
+    salida = app._operar_tareas(hoja, "CHECK", [2, 2], _Cola(vacia=False), {}, modelo)
+    assert "subtarea 2 marcada" in salida
+    assert "⚠️ no se pudo guardar lo pendiente (APIError: 503)" in salida
+    salida = app._operar_tareas(None, "ADD_SUB", [4], _Cola(), {}, modelo)
+    assert "⚠️ Sheets sin conexión: comprobado contra la copia local." in salida
+
+    # Solo Sheets: es un error y no se aplica nada
+    app, hoja, modelo = _preparar(cargar_app)
+    with pytest.raises(RuntimeError, match="no se pudo guardar lo pendiente"):
+        app._operar_tareas(hoja, "CHECK", [2, 2], _Cola(vacia=False), {}, modelo)
+    assert hoja.filas[1][2] == "FALSE"
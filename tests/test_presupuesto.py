@@ -0,0 +1,45 @@
+def _items(prefijo, n):
+    # 4 caracteres = 1 token estimado
+    return [f"{prefijo}{i:03d}" for i in range(n)]
+
+
+def test_armar_con_presupuesto_llena_por_prioridad(cargar_app):
+    app = cargar_app("estimar_tokens", "Seccion", "armar_con_presupuesto")
+    S = app.Seccion
+    secciones = [
+        S("#", ["INST"], prioridad=9, obligatoria=True),
+        S("R:", _items("r", 5), prioridad=2, separador=" "),
+        S("P:", _items("p", 5), prioridad=1, max_tokens=2, separador=" "),
+    ]
+    texto, tokens = app.armar_con_presupuesto(secciones, 4)
+    # Primero el perfil (hasta su tope de 2), luego lo reciente hasta llenar;
+    # la obligatoria entra aunque ya no quede sitio. El orden es el de las secciones.
+    assert texto == "#INST\nR:r000 r001\nP:p000 p001"
+    assert tokens == app.estimar_tokens(texto)
+
+
+def test_armar_con_presupuesto_no_salta_items(cargar_app):
+    app = cargar_app("estimar_tokens", "Seccion", "armar_con_presupuesto")
+    S = app.Seccion
+    largo = "x" * 40  # 10 tokens
+    secciones = [S("", ["a001", largo, "a002"], prioridad=1, separador="|"),
+                 S("", _items("b", 3), prioridad=2, separador="|", invertir=True)]
+    texto, _ = app.armar_con_presupuesto(secciones, 4)
+    # El ítem largo no cabe y los siguientes de su sección tampoco entran;
+    # el resto del presupuesto pasa a la siguiente, mostrada al revés
+    assert texto == "a001\nb002|b001|b000"
+
+
+def test_armar_con_presupuesto_min_items_con_prioridad_propia(cargar_app):
+    app = cargar_app("estimar_tokens", "Seccion", "armar_con_presupuesto")
+    S = app.Seccion
+    secciones = [
+        S("H:", _items("h", 6), prioridad=1, min_items=2, prioridad_resto=3, separador=" "),
+        S("T:", _items("t", 3), prioridad=2, separador=" "),
+    ]
+    # Los 2 primeros del historial, luego las tareas y lo que sobre, historial
+    texto, _ = app.armar_con_presupuesto(secciones, 6)
+    assert texto == "H:h000 h001 h002\nT:t000 t001 t002"
+    # Si los mínimos no caben, el resto de la sección tampoco entra después
+    texto, _ = app.armar_con_presupuesto(secciones, 1)
+    assert texto == "H:h000"
@@ -0,0 +1,100 @@
+import datetime
+import threading
+import types
+
+import falsos
+from conftest import url_gemini
+
+
+def _mensaje(rol, texto):
+    return {"role": rol, "content": texto, "mode": "personal"}
+
+
+def test_clave_respuesta_depende_de_conversacion_contexto_y_hora(cargar_app):
+    app = cargar_app("MIN_PALABRAS_RESPUESTA", "CONTEXTO_RESPUESTA", "PATRON_CONSULTA_HORA",
+                     "normalizar_consulta", "_contexto_respuesta", "clave_respuesta")
+    versiones = types.SimpleNamespace(version=0)
+    a_las_10 = datetime.datetime(2030, 1, 1, 10, 5)
+    consulta = "¿Qué tengo pendiente?"
+    previos = [_mensaje("system", "S"), _mensaje("user", "Hola, ¿cómo estás?"),
+               _mensaje("model", "Bien")]
+
+    def clave(mensajes, id_conv="1", ahora=a_las_10):
+        return app.clave_respuesta(consulta, "Asistente", "m", versiones, versiones,
+                                   id_conv, mensajes, ahora)
+
+    base = clave(previos + [_mensaje("user", consulta)])
+    assert base is not None
+    # La misma consulta repetida justo después sigue acertando
+    repetida = previos + [_mensaje("user", consulta), _mensaje("model", "Nada"),
+                          _mensaje("user", "que tengo pendiente")]
+    assert clave(repetida) == base
+    assert clave(previos + [_mensaje("user", consulta)], ahora=a_las_10.replace(minute=55)) == base
+    # Otra conversación, otro contexto u otra hora: otra clave
+    assert clave(previos + [_mensaje("user", consulta)], id_conv="2") != base
+    assert clave([_mensaje("user", "Mañana viajo"), _mensaje("model", "Anotado"),
+                  _mensaje("user", consulta)]) != base
+    assert clave(previos + [_mensaje("user", consulta)], ahora=a_las_10.replace(hour=11)) != base
+    # Lo que depende de la hora exacta no se reutiliza
+    assert app.clave_respuesta("¿Qué hora es ahora?", "Asistente", "m", versiones, versiones,
+                               "1", [], a_las_10) is None
+
+
+def test_cache_contexto_no_crea_prefijos_bajo_el_minimo(cargar_app):
+    app = cargar_app("DescubridorModelo", "estimar_tokens", "CacheContexto")
+    creados = []
+    cache = app.CacheContexto(lambda modelo, key, texto, ttl: creados.append(modelo) or "cachedContents/1")
+
+    assert cache.minimo_tokens("gemini-2.5-flash") == 1024
+    assert cache.minimo_tokens("gemini-2.5-pro") == 4096
+    assert cache.minimo_tokens("gemini-1.5-flash") == 32768
+    assert cache.nombre("gemini-2.5-flash", "k", "x" * 3000) is None
+    assert cache.nombre("gemini-2.5-pro", "k", "x" * 8000) is None
+    assert creados == []
+    cache.nombre("gemini-2.5-flash", "k", "x" * 8000)
+    for hilo in [h for h in threading.enumerate() if h.name == "cache-contexto"]:
+        hilo.join(5)
+    assert creados == ["gemini-2.5-flash"]
+
+
+def _esperar_cache_contexto():
+    for hilo in [h for h in threading.enumerate() if h.name == "cache-contexto"]:
+        hilo.join(5)
+
+
+def test_prefijo_con_perfil_se_cachea_y_se_reutiliza(cargar_app, gemini):
+    # Cabecera + herramientas + el perfil de un usuario real: llega al
+    # mínimo de gemini-2.5-flash, se crea una vez y los turnos lo citan
+    servidor = gemini(respuestas=["Hola"])
+    cliente = cargar_app("Metricas", "LimitadorTokens", "ClienteGemini").ClienteGemini(
+        url_gemini(servidor), 6000)
+    app = cargar_app("DescubridorModelo", "estimar_tokens", "texto_error_gemini",
+                     "crear_contenido_cacheado", "CacheContexto", "con_prefijo",
+                     "llamar_gemini", "INSTRUCCIONES_HERRAMIENTAS", "CABECERA_SISTEMA",
+                     "prefijo_personal", obtener_cliente_gemini=lambda: cliente)
+    cache = app.CacheContexto(lambda modelo, key, texto, ttl: app.crear_contenido_cacheado(
+        cliente, modelo, key, texto, ttl))
+    modelo = "models/gemini-2.5-flash"
+    perfil = [f"2025-03-{d:02d} Prefiere reuniones por la mañana y viajar en tren al "
+              f"trabajo; su proyecto {d} vence a fin de mes" for d in range(1, 29)]
+
+    assert app.prefijo_personal(modelo, perfil[:3], cache, 6000)[1] is False
+    assert app.prefijo_personal("models/gemini-1.5-flash", perfil, cache, 6000)[1] is False
+    prefijo, lleva_perfil = app.prefijo_personal(modelo, perfil, cache, 6000)
+    assert lleva_perfil and perfil[-1] in prefijo
+    assert app.estimar_tokens(app.INSTRUCCIONES_HERRAMIENTAS) < cache.minimo_tokens(modelo)
+
+    antes = falsos.foto_contadores()
+    payload = {"contents": [{"parts": [{"text": "USUARIO: hola"}]}]}
+    nombres = []
+    for _ in range(3):
+        nombre = cache.nombre(modelo, "k", prefijo)
+        nombres.append(nombre)
+        assert app.llamar_gemini(modelo, "k", app.con_prefijo(payload, prefijo, nombre)) \
+            == ("Hola", None)
+        _esperar_cache_contexto()
+    despues = falsos.foto_contadores()
+    assert nombres == [None, "cachedContents/1", "cachedContents/1"]
+    assert despues["gemini_cache_crear"] - antes["gemini_cache_crear"] == 1
+    assert despues["gemini_con_cache"] - antes["gemini_con_cache"] == 2
+    assert servidor.config.cacheados["cachedContents/1"] == prefijo
@@ -0,0 +1,16 @@
+def test_texto_visible_parcial_oculta_marcador_a_medias(cargar_app):
+    app = cargar_app("MARCADORES_CMD", "texto_visible_parcial")
+    visible = app.texto_visible_parcial
+
+    # El prefijo más largo, sea del marcador que sea
+    assert visible("Hola mundo TAREA_C") == "Hola mundo "
+    assert visible("Hola mundo\nCALENDAR_CM") == "Hola mundo\n"
+    assert visible("Anotado.\nMEMORIA_CMD") == "Anotado.\n"
+    assert visible("EMAIL_") == ""
+    # Un comando completo y lo que le sigue no se muestran
+    assert visible("Listo.\nTAREA_CMD: LISTAR") == "Listo.\n"
+    assert visible("Ok CALENDAR_CMD: Cita | 2030-01-01 10:00") == "Ok "
+    # Una mayúscula al final de una palabra no es un marcador
+    assert visible("Hola ABC") == "Hola ABC"
+    assert visible("Vamos al TEATRO") == "Vamos al TEATRO"
+    assert visible("Sin comandos.") == "Sin comandos."
@@ -0,0 +1,35 @@
+import falsos
+
+TEXTO = ("**Hola**. Soy tu asistente. Hoy tienes tres tareas pendientes y una reunión "
+         "a las cinco de la tarde con el equipo de proyectos de ERH. ¿Quieres que te "
+         "recuerde algo más? Puedo [agendarlo](https://calendar.google.com) ahora mismo.")
+
+
+def test_audio_continuo_con_el_motor_falso(cargar_app, tmp_path):
+    app = cargar_app("Metricas", "limpiar_texto_para_audio", "dividir_frases", "cargar_motor_tts",
+                     "CacheAudio", "VozTTS", "texto_a_audio", "audio_continuo",
+                     obtener_voz=lambda: voz)
+    voz = app.VozTTS(app.cargar_motor_tts("falsos:sintetizar"), app.CacheAudio(str(tmp_path)))
+
+    limpio = app.limpiar_texto_para_audio(TEXTO)
+    trozos = app.dividir_frases(limpio)
+    # Frases cortas juntas, ninguna por encima del máximo, sin perder texto
+    assert trozos == [
+        "Hola. Soy tu asistente.",
+        "Hoy tienes tres tareas pendientes y una reunión a las cinco de la tarde con el "
+        "equipo de proyectos de ERH.",
+        "¿Quieres que te recuerde algo más?",
+        "Puedo agendarlo ahora mismo.",
+    ]
+    assert all(len(t) <= 200 for t in app.dividir_frases("palabra " * 100))
+
+    # Un solo MP3 con los trozos en orden aunque el motor los termine desordenados
+    antes = falsos.foto_contadores()["tts_sintetizar"]
+    audio = app.audio_continuo(TEXTO)
+    assert audio == b"".join(f"[es:{t}]".encode("utf-8") for t in trozos)
+    assert falsos.foto_contadores()["tts_sintetizar"] - antes == len(trozos)
+
+    # La segunda vez sale de la caché en disco, sin llamar al motor
+    assert app.audio_continuo(TEXTO) == audio
+    assert falsos.foto_contadores()["tts_sintetizar"] - antes == len(trozos)
+    assert app.audio_continuo("") == b""
@@ -0,0 +1,29 @@
+def test_recortar_ventana_devuelve_lo_quitado_con_cargar_mas(cargar_app, tmp_path):
+    app = cargar_app("RefrescoFondo", "AlmacenLocal", "ChatSQLite", "PerfilSQLite", "TareasSQLite",
+                     "MAX_MENSAJES_SESION", "PAGINA_HISTORIAL", "_a_mensajes",
+                     "cargar_anteriores", "recortar_ventana", MAX_MENSAJES_SESION=6)
+    base = app.AlmacenLocal(str(tmp_path / "asistente.db"))
+    chat = base.chat
+    with base.transaccion() as con:
+        con.execute("INSERT INTO conversaciones (conv, importada) VALUES ('1', 1)")
+        con.executemany("INSERT INTO mensajes (conv, fecha, rol, texto, replicada) "
+                        "VALUES ('1', '2030-01-01 10:00:00', 'user', ?, 1)",
+                        [(f"m{i}",) for i in range(1, 13)])
+
+    filas, cursor = chat.pagina("1", 5)
+    sistema = {"role": "system", "content": "S", "mode": "personal"}
+    ventana = {"messages": [sistema] + app._a_mensajes(filas), "cursor": cursor}
+    assert [m["content"] for m in ventana["messages"][1:]] == ["m8", "m9", "m10", "m11", "m12"]
+
+    ventana["messages"].append({"role": "user", "content": "m13", "mode": "personal"})
+    assert app.recortar_ventana(ventana, chat, "1") == 1
+    assert [m["content"] for m in ventana["messages"]] == ["S", "m9", "m10", "m11", "m12", "m13"]
+    # La página anterior empieza justo donde se recortó
+    assert chat.pagina("1", 3, ventana["cursor"])[0] == [("user", "m6"), ("user", "m7"), ("user", "m8")]
+    assert app.recortar_ventana(ventana, chat, "1") == 0
+
+    # Sin almacén (y con la ventana ya al principio) solo se recorta
+    suelta = {"messages": [sistema] + app._a_mensajes([("user", f"x{i}") for i in range(8)]),
+              "cursor": None}
+    assert app.recortar_ventana(suelta, None, None) == 3
+    assert [m["content"] for m in suelta["messages"]] == ["S", "x3", "x4", "x5", "x6", "x7"]